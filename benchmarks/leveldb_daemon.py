@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the throughput of LevelDB in process and through kvkit.server.
+
+Run from the root of the repository::
+
+    python benchmarks/leveldb_daemon.py [number of documents] [worker processes]
+
+The same operations are timed on the db opened in this process, then
+through a server started as another process, first from this process and
+then from several worker processes at once, which is what the server is
+for. The numbers are operations per second, summed over the workers.
+"""
+
+from __future__ import absolute_import
+
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from kvkit import Document, NumberProperty, StringProperty
+from kvkit.backends import leveldb, leveldb_client
+from kvkit.exceptions import DatabaseError
+
+DIRECTORY = os.environ.get("KVKIT_BENCHMARK_DIR", "dbs/benchmark_leveldb_daemon")
+SOCKET = os.path.join(DIRECTORY, "server.sock")
+
+# Documents per value of the indexed property.
+GROUP_SIZE = 10
+
+# How long each operation is timed for, in seconds.
+DURATION = 2.0
+
+
+class Item(Document):
+  _backend = leveldb
+  _leveldb_options = {"db": os.path.join(DIRECTORY, "items"), "indexdb": os.path.join(DIRECTORY, "items.indexes")}
+
+  group = StringProperty(index=True)
+  n = NumberProperty()
+  payload = StringProperty()
+
+
+class RemoteItem(Document):
+  _backend = leveldb_client
+  _leveldb_client_options = {"socket": SOCKET, "name": "Item"}
+
+  group = StringProperty(index=True)
+  n = NumberProperty()
+  payload = StringProperty()
+
+
+def populate(count):
+  if Item.list_all_keys(limit=1):
+    return
+
+  payload = "x" * 200
+  for start in xrange(0, count, 1000):
+    Item.save_many([Item(key="k{0:09d}".format(i), data={"group": "g{0}".format(i // GROUP_SIZE), "n": i,
+                                                           "payload": payload})
+                    for i in xrange(start, min(start + 1000, count))])
+
+
+def operations(cls, count, rng):
+  def key():
+    return "k{0:09d}".format(rng.randrange(count))
+
+  def save():
+    i = rng.randrange(count)
+    cls(key="k{0:09d}".format(i), data={"group": "g{0}".format(i // GROUP_SIZE), "n": i, "payload": "y" * 200}).save()
+
+  return [
+    ("get", lambda: cls.get(key())),
+    ("get_many 100", lambda: cls.get_many([key() for _ in xrange(100)])),
+    ("index", lambda: list(cls.index("group", "g{0}".format(rng.randrange(count // GROUP_SIZE or 1))))),
+    ("save", save),
+  ]
+
+
+def rate(f):
+  """Runs f for DURATION seconds and returns the calls per second."""
+  calls = 0
+  start = time.time()
+  end = start + DURATION
+  while True:
+    f()
+    calls += 1
+    now = time.time()
+    if now >= end:
+      return calls / (now - start)
+
+
+def bench(cls, count):
+  rng = random.Random(os.getpid())
+  return [(name, rate(f)) for name, f in operations(cls, count, rng)]
+
+
+def bench_workers(count, workers):
+  """Runs the operations through the server in several processes at once
+  and sums up their rates."""
+  pipes = []
+  for _ in xrange(workers):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(read)
+      try:
+        results = bench(RemoteItem, count)
+        os.write(write, " ".join(str(r) for _, r in results))
+      finally:
+        os._exit(0)
+    os.close(write)
+    pipes.append((pid, read))
+
+  totals = None
+  for pid, read in pipes:
+    rates = [float(r) for r in os.read(read, 4096).split()]
+    os.close(read)
+    os.waitpid(pid, 0)
+    totals = rates if totals is None else [a + b for a, b in zip(totals, rates)]
+  return totals
+
+
+def start_server():
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.dirname(os.path.abspath(__file__))]))
+  server = subprocess.Popen([sys.executable, "-m", "kvkit.server", "--socket", SOCKET, "leveldb_daemon:Item"],
+                            env=env)
+  for _ in xrange(100):
+    try:
+      leveldb_client.ping(RemoteItem)
+      return server
+    except DatabaseError:
+      time.sleep(0.1)
+
+  server.terminate()
+  raise RuntimeError("The server did not start.")
+
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+  if not os.path.exists(DIRECTORY):
+    os.makedirs(DIRECTORY)
+
+  populate(count)
+  local = bench(Item, count)
+  leveldb.close_all()
+
+  server = start_server()
+  try:
+    remote = bench(RemoteItem, count)
+    leveldb_client.close_all()
+    many = bench_workers(count, workers)
+  finally:
+    server.terminate()
+    server.wait()
+
+  print "operations per second, {0} documents".format(count)
+  print "{0:<14} {1:>12} {2:>12} {3:>16}".format("operation", "in process", "server", "server x{0}".format(workers))
+  for (name, a), (_, b), c in zip(local, remote, many):
+    print "{0:<14} {1:>12.0f} {2:>12.0f} {3:>16.0f}".format(name, a, b, c)
+
+
+if __name__ == "__main__":
+  main()
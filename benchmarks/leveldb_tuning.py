@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the get and index latency of LevelDB with different options.
+
+Run from the root of the repository::
+
+    python benchmarks/leveldb_tuning.py [number of documents] [value bytes] [directory]
+
+The documents are written once for each bloom filter setting, as the
+filters are stored in the table files when they are written, and then each
+set of options is measured in a fresh process. "get hit" gets existing
+documents, "get miss" gets keys that do not exist, which is what bloom
+filters help with, and "index" looks up a value with a few documents.
+
+For the numbers to mean anything for disk reads, the dataset has to be
+larger than the memory of the machine (or of the cgroup running this), so
+that the OS cannot cache all of it. For example, 20000000 documents of 200
+bytes are about 4GB. Dropping the page cache between runs, as root with
+``echo 3 > /proc/sys/vm/drop_caches``, gives cold numbers as well.
+"""
+
+from __future__ import absolute_import
+
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kvkit import Document, NumberProperty, StringProperty
+from kvkit.backends import leveldb
+from kvkit.exceptions import NotFoundError
+
+# name, options
+CONFIGS = [
+  ("default", {}),
+  ("bloom 10", {"bloom_filter_bits": 10}),
+  ("cache 64MB", {"lru_cache_size": 64 * 1024 * 1024}),
+  ("bloom 10, cache 64MB", {"bloom_filter_bits": 10, "lru_cache_size": 64 * 1024 * 1024}),
+  ("bloom 10, cache 512MB", {"bloom_filter_bits": 10, "lru_cache_size": 512 * 1024 * 1024}),
+]
+
+# Documents per value of the indexed property.
+GROUP_SIZE = 10
+
+SAMPLES = 20000
+
+
+def make_class(directory, options):
+  path = os.path.join(directory, "bloom{0}".format(options.get("bloom_filter_bits", 0)))
+  opts = {"db": path, "indexdb": path + ".indexes"}
+  opts.update(options)
+
+  class Item(Document):
+    _backend = leveldb
+    _leveldb_options = opts
+
+    group = StringProperty(index=True)
+    n = NumberProperty()
+    payload = StringProperty()
+
+  return Item, path
+
+
+def populate(directory, options, count, size):
+  cls, path = make_class(directory, options)
+  cls.open_leveldb_connections()
+  meta = cls._leveldb_meta
+  if meta["db"].get("k{0:012d}".format(count - 1)) is not None:
+    cls.close_leveldb_connections()
+    return
+
+  payload = "x" * size
+  for i in xrange(count):
+    cls(key="k{0:012d}".format(i), data={"group": "g{0}".format(i // GROUP_SIZE), "n": i, "payload": payload}).save()
+    if i % 100000 == 0:
+      sys.stderr.write("{0}: {1}/{2}\n".format(path, i, count))
+
+  # So that all of it is read from table files, not from the memtable.
+  meta["db"].compact_range()
+  meta["indexdb"].compact_range()
+  cls.close_leveldb_connections()
+
+
+def percentiles(latencies):
+  latencies.sort()
+  return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def measure(function, arguments):
+  latencies = []
+  for argument in arguments:
+    start = time.time()
+    function(argument)
+    latencies.append(time.time() - start)
+  return percentiles(latencies)
+
+
+def bench(directory, options, count):
+  cls, _ = make_class(directory, options)
+  rng = random.Random(0)
+  hits = ["k{0:012d}".format(rng.randrange(count)) for _ in xrange(SAMPLES)]
+  misses = ["k{0:012d}x".format(rng.randrange(count)) for _ in xrange(SAMPLES)]
+  groups = ["g{0}".format(rng.randrange(count // GROUP_SIZE or 1)) for _ in xrange(SAMPLES // GROUP_SIZE)]
+
+  def get_miss(key):
+    try:
+      cls.get(key)
+    except NotFoundError:
+      pass
+
+  results = [
+    measure(cls.get, hits),
+    measure(get_miss, misses),
+    measure(lambda group: list(cls.index("group", group)), groups),
+  ]
+  cls.close_leveldb_connections()
+  return results
+
+
+def main():
+  if len(sys.argv) == 5 and sys.argv[1] == "--one":
+    _, options = CONFIGS[int(sys.argv[2])]
+    for p50, p99 in bench(sys.argv[3], options, int(sys.argv[4])):
+      print p50, p99
+    return
+
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  size = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+  directory = sys.argv[3] if len(sys.argv) > 3 else "dbs/benchmark_leveldb_tuning"
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+
+  for _, options in CONFIGS:
+    populate(directory, options, count, size)
+
+  print "latency in microseconds, {0} documents of {1} bytes".format(count, size)
+  print "{0:<24} {1:>16} {2:>16} {3:>16}".format("options", "get hit p50/p99", "get miss p50/p99", "index p50/p99")
+  for i, (name, _) in enumerate(CONFIGS):
+    output = subprocess.check_output([sys.executable, __file__, "--one", str(i), directory, str(count)])
+    cells = []
+    for line in output.splitlines():
+      p50, p99 = (float(x) * 1000000 for x in line.split())
+      cells.append("{0:.0f}/{1:.0f}".format(p50, p99))
+    print "{0:<24} {1:>16} {2:>16} {3:>16}".format(name, *cells)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the memory used by regular and compact (__compact__) documents.
+
+Run from the root of the repository::
+
+    python benchmarks/memory.py [number of documents]
+
+Documents are measured with the slow_memory backend, and with the leveldb
+backend if plyvel is installed, as it keeps the indexes of each loaded
+document. Every other property of the leveldb documents is indexed.
+
+Two numbers are reported for loaded documents. "structure" adds up
+sys.getsizeof of the objects owned by each document instance, not counting
+the values themselves, which are the same in both modes. "rss" is the
+growth of the resident memory of this process while holding all the
+documents, divided by their number, and includes the values. It is only
+measured on Linux.
+"""
+
+from __future__ import absolute_import
+
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kvkit import Document, NumberProperty, StringProperty
+from kvkit.backends import leveldb, slow_memory
+from kvkit.compact import CompactData, EMPTY_SET
+
+BACKENDS = {"slow_memory": slow_memory, "leveldb": leveldb}
+
+
+def make_class(backend, n, compact, directory=None):
+  attrs = {"_backend": backend, "__compact__": compact}
+  if backend is leveldb:
+    attrs["_leveldb_options"] = {"db": os.path.join(directory, "data"),
+                                 "indexdb": os.path.join(directory, "indexes")}
+
+  index = backend is leveldb
+  data = {}
+  for i in xrange(n):
+    name = "p{0}".format(i)
+    if i % 2:
+      attrs[name] = NumberProperty(index=index)
+      data[name] = i
+    else:
+      attrs[name] = StringProperty()
+      data[name] = u"value"
+
+  cls = type("Document{0}{1}".format(n, "Compact" if compact else "Regular"), (Document, ), attrs)
+  return cls, data
+
+
+def structure_bytes(doc):
+  size = sys.getsizeof(doc)
+  # The indexes kept by the leveldb backend are counted on their own, as a
+  # compact document has them in a slot and a regular one in its __dict__.
+  old_indexes = getattr(doc, "_leveldb_old_indexes", None)
+  if old_indexes is not None:
+    size += sys.getsizeof(old_indexes)
+
+  # Asking a compact document for its __dict__ would create it, so look for
+  # it among the objects the document refers to instead.
+  owned = (doc._data, doc._loaded_values, old_indexes)
+  for referent in gc.get_referents(doc):
+    if isinstance(referent, dict) and not any(referent is o for o in owned):
+      size += sys.getsizeof(referent)
+
+  data = doc._data
+  size += sys.getsizeof(data)
+  if isinstance(data, CompactData):
+    size += sys.getsizeof(data._values)
+    if data._extra is not None:
+      size += sys.getsizeof(data._extra)
+
+  for container in (doc._props_to_load, doc._dirty, doc._loaded_values):
+    if container is not None and container is not EMPTY_SET:
+      size += sys.getsizeof(container)
+
+  return size
+
+
+def rss_bytes():
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (IOError, OSError, ValueError):
+    return None
+
+
+def bench(backend, n, compact, count):
+  directory = tempfile.mkdtemp(prefix="kvkit-memory-") if backend is leveldb else None
+  try:
+    cls, data = make_class(backend, n, compact, directory)
+    # Documents are loaded as the backend would, without reading them from
+    # the db, so only the memory they hold is measured.
+    cls(key="warmup").deserialize(dict(data))
+    gc.collect()
+    before = rss_bytes()
+    docs = [cls(key=str(i)).deserialize(dict(data)) for i in xrange(count)]
+    gc.collect()
+    after = rss_bytes()
+
+    structure = structure_bytes(docs[0])
+    rss = None if before is None else float(after - before) / count
+    del docs
+    if backend is leveldb:
+      cls.close_leveldb_connections()
+    return structure, rss
+  finally:
+    if directory is not None:
+      shutil.rmtree(directory)
+
+
+def main():
+  if len(sys.argv) == 6 and sys.argv[1] == "--one":
+    structure, rss = bench(BACKENDS[sys.argv[2]], int(sys.argv[3]), sys.argv[4] == "compact", int(sys.argv[5]))
+    print structure, rss
+    return
+
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  backends = ["slow_memory"]
+  if leveldb.available:
+    backends.append("leveldb")
+
+  print "bytes per loaded document, {0} documents".format(count)
+  print "{0:>11} {1:>6} {2:>8} {3:>10} {4:>10}".format("backend", "props", "mode", "structure", "rss")
+  for backend in backends:
+    for n in (5, 20, 100):
+      for mode in ("regular", "compact"):
+        # A fresh process for each, as freed memory is not given back to the
+        # OS and would be reused by the next run.
+        output = subprocess.check_output([sys.executable, __file__, "--one", backend, str(n), mode, str(count)])
+        structure, rss = output.split()
+        rss = "n/a" if rss == "None" else "{0:.0f}".format(float(rss))
+        print "{0:>11} {1:>6} {2:>8} {3:>10} {4:>10}".format(backend, n, mode, structure, rss)
+
+
+if __name__ == "__main__":
+  main()
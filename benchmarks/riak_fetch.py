@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""Times Riak index queries with different numbers of fetch threads.
+
+Run from the root of the repository::
+
+    python benchmarks/riak_fetch.py [hits] [milliseconds per get]
+
+The bucket is a stand-in that answers every get after the given delay,
+like a round trip to a cluster, so this needs neither a cluster nor the
+riak package. One thread with a read ahead of one is what fetching the
+hits one after the other costs.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kvkit import Document, StringProperty
+from kvkit.backends import riak
+
+# fetch_threads, read_ahead
+CONFIGS = [(1, 1), (4, 8), (8, 16), (16, 32), (32, 64)]
+
+
+class FakeObject(object):
+  def __init__(self, key, data):
+    self.key = key
+    self.data = data
+    self.exists = data is not None
+
+
+class FakeBucket(object):
+  def __init__(self, count, delay):
+    self.keys = ["k{0:06d}".format(i) for i in xrange(count)]
+    self.delay = delay
+
+  def new(self, key):
+    return FakeObject(key, None)
+
+  def get(self, key, **args):
+    time.sleep(self.delay)
+    return FakeObject(key, {"name": "hit"})
+
+  def get_index(self, field, start_value, end_value=None, **args):
+    time.sleep(self.delay)
+    return self.keys
+
+
+def make_class(bucket, threads, read_ahead):
+  class Item(Document):
+    _backend = riak
+    _riak_options = {"bucket": bucket, "fetch_threads": threads, "read_ahead": read_ahead}
+
+    name = StringProperty(index=True)
+
+  return Item
+
+
+def main():
+  hits = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+  delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.002
+  bucket = FakeBucket(hits, delay)
+
+  print "index query with {0} hits, {1:.1f}ms per request".format(hits, delay * 1000)
+  print "{0:>8} {1:>10} {2:>12} {3:>12}".format("threads", "read ahead", "ordered ms", "unordered ms")
+  for threads, read_ahead in CONFIGS:
+    cls = make_class(bucket, threads, read_ahead)
+    times = []
+    for ordered in (True, False):
+      start = time.time()
+      count = len(list(cls.index("name", "hit", ordered=ordered)))
+      times.append((time.time() - start) * 1000)
+      assert count == hits
+    print "{0:>8} {1:>10} {2:>12.0f} {3:>12.0f}".format(threads, read_ahead, *times)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""Times the Riak backend against the stand-in Riak server of the tests.
+
+Run from the root of the repository::
+
+    python benchmarks/riak_throughput.py [documents] [milliseconds per request]
+
+This needs riak-python-client, but no cluster: the server runs in this
+process and waits the given time before answering every request, like a
+round trip to a cluster. Every operation is timed for a while and the
+documents per second and the latency of the calls are printed.
+"""
+
+from __future__ import absolute_import
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kvkit import Document, NumberProperty, StringProperty
+from kvkit.backends import riak
+from kvkit.tests.backends.fake_riak import FakeRiakServer
+
+# Documents per value of the indexed property.
+GROUP_SIZE = 10
+
+# Documents per call of get_many and save_many.
+BATCH_SIZE = 100
+
+# How long each operation is timed for, in seconds.
+DURATION = 2.0
+
+
+def make_class(bucket):
+  class Item(Document):
+    _backend = riak
+    _riak_options = {"bucket": bucket}
+
+    group = StringProperty(index=True)
+    n = NumberProperty()
+
+  return Item
+
+
+def operations(cls, count, rng):
+  def key():
+    return "k{0:09d}".format(rng.randrange(count))
+
+  def new(i):
+    return cls(key="k{0:09d}".format(i), data={"group": "g{0}".format(i // GROUP_SIZE), "n": i})
+
+  return [
+    # name, documents per call, f
+    ("get", 1, lambda: cls.get(key())),
+    ("index", GROUP_SIZE, lambda: list(cls.index("group", "g{0}".format(rng.randrange(count // GROUP_SIZE or 1))))),
+    ("get_many", BATCH_SIZE, lambda: cls.get_many([key() for _ in xrange(BATCH_SIZE)])),
+    ("save", 1, lambda: new(rng.randrange(count)).save()),
+    ("save_many", BATCH_SIZE, lambda: cls.save_many([new(rng.randrange(count)) for _ in xrange(BATCH_SIZE)])),
+  ]
+
+
+def percentile(latencies, p):
+  return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def bench(f):
+  """Runs f for DURATION seconds and returns the sorted times of the calls."""
+  latencies = []
+  end = time.time() + DURATION
+  while True:
+    start = time.time()
+    f()
+    now = time.time()
+    latencies.append(now - start)
+    if now >= end:
+      latencies.sort()
+      return latencies
+
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.001
+
+  server = FakeRiakServer().start()
+  try:
+    cls = make_class(server.client().bucket("items"))
+    cls.save_many(cls(key="k{0:09d}".format(i), data={"group": "g{0}".format(i // GROUP_SIZE), "n": i})
+                  for i in xrange(count))
+    server.latency = latency
+
+    print "{0} documents, {1:.1f}ms per request".format(count, latency * 1000)
+    print "{0:<10} {1:>10} {2:>10} {3:>10}".format("operation", "docs/s", "p50 ms", "p99 ms")
+    for name, docs, f in operations(cls, count, random.Random(0)):
+      latencies = bench(f)
+      rate = len(latencies) * docs / sum(latencies)
+      print "{0:<10} {1:>10.0f} {2:>10.1f} {3:>10.1f}".format(name, rate, percentile(latencies, 0.5) * 1000,
+                                                              percentile(latencies, 0.99) * 1000)
+  finally:
+    server.stop()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the compiled serializers against the generic ones.
+
+Run from the root of the repository::
+
+    python benchmarks/serializers.py [number of iterations]
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kvkit import EmDocument
+from kvkit.properties import (
+    BooleanProperty,
+    DictProperty,
+    ListProperty,
+    NumberProperty,
+    StringProperty
+)
+
+# A mix that looks like a typical document.
+_PROPERTIES = [
+  (StringProperty, "value {0}"),
+  (StringProperty, "another {0}"),
+  (NumberProperty, 1.5),
+  (BooleanProperty, True),
+  (ListProperty, ["a", "b"]),
+  (DictProperty, {"a": 1}),
+]
+
+
+def make_class(n, compiled):
+  attrs = {"COMPILED_SERIALIZERS": compiled}
+  data = {}
+  for i in xrange(n):
+    prop, value = _PROPERTIES[i % len(_PROPERTIES)]
+    name = "p{0}".format(i)
+    attrs[name] = prop()
+    data[name] = value.format(i) if isinstance(value, str) else value
+
+  cls = type("Document{0}{1}".format(n, "Compiled" if compiled else "Generic"), (EmDocument, ), attrs)
+  return cls, data
+
+
+def bench(n, number):
+  results = {}
+  for compiled in (False, True):
+    cls, data = make_class(n, compiled)
+    doc = cls.load(data)
+    results[compiled] = (
+      min(timeit.repeat(doc.serialize, number=number, repeat=3)),
+      min(timeit.repeat(lambda: cls.load(data), number=number, repeat=3)),
+      min(timeit.repeat(doc.is_valid, number=number, repeat=3)),
+    )
+
+  return results
+
+
+def main():
+  number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  print "{0} iterations, best of 3, in seconds".format(number)
+  print "{0:>6} {1:>12} {2:>10} {3:>10} {4:>8}".format("props", "operation", "generic", "compiled", "speedup")
+  for n in (5, 20, 100):
+    results = bench(n, number)
+    for i, operation in enumerate(("serialize", "deserialize", "is_valid")):
+      generic, compiled = results[False][i], results[True][i]
+      print "{0:>6} {1:>12} {2:>10.4f} {3:>10.4f} {4:>7.2f}x".format(n, operation, generic, compiled, generic / compiled)
+
+
+if __name__ == "__main__":
+  main()
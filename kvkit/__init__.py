@@ -22,6 +22,7 @@
 from __future__ import absolute_import
 
 from .emdocument import EmDocument
+from .session import Session
 from .document import Document
 from .properties.standard import *
 from .properties.fancy import *
@@ -19,6 +19,19 @@
 
 # A backend could be a module, a class, whatever.
 
+# Optional. If True, projection queries (``fields=`` on ``Document.get``,
+# ``get_many``, ``index`` and ``list_all``) pass ``fields``, the list of field
+# names wanted, to ``get``, ``get_many``, ``index`` and ``list_all``. The JSON
+# documents returned only need to have those fields. Only set this if the
+# backend can actually skip work for the other fields. Otherwise kvkit picks
+# the fields out itself.
+supports_projection = False
+
+# Optional. The names of the attributes the backend sets on every document,
+# like ``_leveldb_old_indexes``. Compact documents (``__compact__ = True``)
+# get a slot for each, instead of a ``__dict__`` for them.
+document_slots = ()
+
 def init_class(cls):
   """Called right after a class has been initialized.
 
@@ -73,9 +86,15 @@ def index_keys_only(cls, field, start_value, end_value=None, **args):
     end_value: If not None, a range query is done. The range is:
         ``start_value <= matched <= end_value``.
     **args: Any additional keyword arguments passed in at ``Document.index_keys_only``.
+        These include the paging options ``limit``, ``reverse`` and
+        ``continuation``, which are only passed if they are set. Results are
+        ordered by key within the same value. If ``limit`` is set, at most
+        that many results are returned as a ``kvkit.pagination.Page`` whose
+        ``continuation`` resumes the query right after the page. A backend
+        that cannot do ``reverse`` raises NotImplementedError.
 
   Returns:
-    An iterator of keys only.
+    An iterator of keys only, or a Page if ``limit`` is set.
 
   Raises:
     kvkit.exceptions.NotIndexed if not indexed. This is optional, however, as
@@ -87,6 +106,24 @@ def index_keys_only(cls, field, start_value, end_value=None, **args):
   """
   raise NotImplementedError
 
+def index_terms(cls, field, start_value, end_value=None, **args):
+  """Does an index operation and returns the values matched with their keys.
+
+  This is optional. If a backend does not have it, ``Document.index_terms``
+  raises NotImplementedError. It should only read the index, never the
+  documents.
+
+  Args:
+    The same as ``index_keys_only``.
+
+  Returns:
+    An iterator of (value, key) for every index entry in the range, in the
+    order of the index, or a Page of them if ``limit`` is set. A document
+    with several values in the range comes once for each. The values are
+    as stored in the index, which ``Document.index_terms`` converts.
+  """
+  raise NotImplementedError
+
 def index(cls, field, start_value, end_value=None, **args):
   """Does an index operation and returns the documents matched.
 
@@ -94,7 +131,8 @@ def index(cls, field, start_value, end_value=None, **args):
     The same as ``index_keys_only``.
 
   Returns:
-    An iterator for (key, json document, backend representation)
+    An iterator for (key, json document, backend representation), or a Page
+    of them if ``limit`` is set.
 
   Raises:
     kvkit.exceptions.NotIndexed if not indexed.
@@ -115,10 +153,11 @@ def list_all_keys(cls, start_value=None, end_value=None, **args):
     end_value: The end value of the range. The range is
         ``start_value <= v <= end_value``.
     **args: additional keyword arguments passed in from
-        ``Document.list_all_keys``.
+        ``Document.list_all_keys``, including the paging options described
+        in ``index_keys_only``.
 
   Returns:
-    An iterator of all keys.
+    An iterator of all keys, or a Page if ``limit`` is set.
 
   Note:
     This exists because some backends might have optimizations getting only
@@ -133,7 +172,8 @@ def list_all(cls, start_value=None, end_value=None, **args):
     The same as list_all_keys
 
   Returns:
-    An iterator for (key, json document, backend_obj)
+    An iterator for (key, json document, backend_obj), or a Page of them if
+    ``limit`` is set.
 
   Note:
     This could just be loading from list_all_keys. However, it should attempt
@@ -177,6 +217,28 @@ def get(cls, key, **args):
   """
   raise NotImplementedError
 
+def get_many(cls, keys, **args):
+  """Getting many json documents from the backend in one go.
+
+  This is optional. If a backend does not have it, ``Document.get_many``
+  will fall back to calling ``get`` once per key.
+
+  Args:
+    cls: The class of document to get from.
+    keys: A list of keys to get. There could be duplicates.
+    **args: Any additional arguments passed from ``Document.get_many``
+
+  Returns:
+    A list with the same length and order as ``keys``. Each item is
+    (JSON document, backend representation of the object) like ``get``, or
+    None if that key is not found.
+
+  Note:
+    This should attempt to use backend-specific optimizations such as
+    batched reads or concurrent requests.
+  """
+  raise NotImplementedError
+
 def save(self, key, data, **args):
   """Saves a key and a json document into the backend.
 
@@ -191,6 +253,28 @@ def save(self, key, data, **args):
   """
   raise NotImplementedError
 
+def save_many(cls, items, **args):
+  """Saves many documents into the backend in one go.
+
+  This is optional. If a backend does not have it, ``Document.save_many``
+  will fall back to calling ``save`` once per document.
+
+  Args:
+    cls: The class of the documents.
+    items: A list of (document, key, json document), already validated and
+        serialized.
+    **args: The arguments passed from ``Document.save_many``
+
+  Returns:
+    None, or a list of (document, exception) for the documents that could
+    not be saved if the backend writes them one by one and went on with
+    the others. ``Document.save_many`` raises a BatchError with them.
+
+  Note:
+    This should write the whole list as one batch if the backend allows it.
+  """
+  raise NotImplementedError
+
 def delete(cls, key, doc=None, **args):
   """Deletes cls key from the db.
 
@@ -210,6 +294,81 @@ def delete(cls, key, doc=None, **args):
   """
   raise NotImplementedError
 
+def delete_many(cls, keys, **args):
+  """Deletes many keys of cls from the db in one go.
+
+  This is optional. If a backend does not have it, ``Document.delete_many``
+  will fall back to calling ``delete`` once per key.
+
+  Args:
+    cls: The class to delete from
+    keys: A list of keys to delete. There could be duplicates.
+    **args: additional arguments passed in from ``Document.delete_many`` or
+        ``Document.delete_where``.
+
+  Returns:
+    The number of documents removed.
+
+  Note:
+    Keys that do not exist in the backend are ignored. Index entries for the
+    removed documents must be cleaned up without loading every document if
+    at all possible.
+  """
+  raise NotImplementedError
+
+def rebuild_indexes(cls, **args):
+  """Rebuilds the indexes of a class from all of its documents.
+
+  This is optional. Without it, ``Document.rebuild_indexes`` raises
+  NotImplementedError.
+
+  Args:
+    cls: The document class.
+    **args: The arguments passed from ``Document.rebuild_indexes``.
+
+  Returns:
+    The number of documents indexed.
+
+  Note:
+    Queries should keep working during the rebuild, with the old indexes.
+  """
+  raise NotImplementedError
+
+def verify_indexes(cls, repair=False, **args):
+  """Checks the indexes of a class against its documents.
+
+  This is optional. Without it, ``Document.verify_indexes`` raises
+  NotImplementedError.
+
+  Args:
+    cls: The document class.
+    repair: If True, fix the problems found.
+    **args: The arguments passed from ``Document.verify_indexes``.
+
+  Returns:
+    A report of the problems found, such as
+    ``kvkit.backends.leveldb.IndexReport``.
+  """
+  raise NotImplementedError
+
+def snapshot(cls):
+  """Pins a consistent view of the db for reads of a class.
+
+  This is optional. Without it, ``Document.snapshot`` raises
+  NotImplementedError.
+
+  Args:
+    cls: The document class.
+
+  Returns:
+    A context manager. While it is active in a thread, every ``get``,
+    ``get_many``, ``index``, ``index_keys_only``, ``list_all`` and
+    ``list_all_keys`` of cls in that thread reads from the view as it was
+    when it was entered. Entering it again while it is active keeps the
+    same view.
+  """
+  raise NotImplementedError
+
 def post_deserialize(self, data):
   """Runs after deserializing an object.
 
@@ -233,6 +392,10 @@ class BackendBase(object):
   Used for a class based approach. All documentations are the same as above,
   except the first argument is now ``self``, which refers to the class backend
   object.
+
+  Optional operations such as ``get_many`` are not defined here as kvkit
+  checks for their existence before using them. Define them in your subclass
+  if your backend supports them.
   """
   def init_class(self, cls):
     pass
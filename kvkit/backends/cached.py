@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+"""This backend wraps another backend with a read-through LRU cache.
+
+The cache holds the JSON documents by (class name, key) and is updated on
+save and invalidated on delete, so it is only correct if every write goes
+through this process. Use it for read heavy classes::
+
+    from kvkit.backends import cached, riak
+
+    class User(Document):
+      _backend = cached.CachedBackend(riak, max_entries=10000, ttl=60)
+
+The backend representation of the objects (like RiakObject) is not cached.
+Documents read from the cache get a new one from the wrapped backend's
+``clear_document``, as documents that were never saved do.
+
+Projection queries (``fields=``) are answered from the cache by copying only
+the requested fields instead of the whole document. Index queries with
+``fields`` go to the wrapped backend with them if it supports projection,
+so a covering index still answers them, and their results are not cached.
+"""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import threading
+import time
+
+try:
+  import ujson as json
+except ImportError:
+  try:
+    import simplejson as json
+  except ImportError:
+    import json
+
+from .base import BackendBase
+from ..exceptions import NotFoundError
+from ..helpers import mediocre_copy
+from ..pagination import Page
+
+
+def _copy(data, fields=None):
+  if fields is None:
+    return mediocre_copy(data)
+  return dict((name, mediocre_copy(data[name])) for name in fields if name in data)
+
+
+class LRUCache(object):
+  """A thread safe LRU cache bounded by entries and/or bytes with a TTL.
+
+  The size of a value in bytes is estimated by the length of its JSON dump,
+  which is only computed if max_bytes is set.
+  """
+
+  def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """Gets a value from the cache. Returns None if it is not there."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      value, expires_at, size = entry
+      if expires_at is not None and expires_at < time.time():
+        self.bytes -= size
+        self.misses += 1
+        return None
+
+      # Reinserting moves it to the most recently used end.
+      self._entries[key] = entry
+      self.hits += 1
+      return value
+
+  def peek(self, key):
+    """Gets a value without counting it as a lookup or refreshing it."""
+    entry = self._entries.get(key)
+    if entry is None or (entry[1] is not None and entry[1] < time.time()):
+      return None
+    return entry[0]
+
+  def put(self, key, value):
+    size = len(json.dumps(value)) if self.max_bytes is not None else 0
+    expires_at = time.time() + self.ttl if self.ttl is not None else None
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.bytes -= old[2]
+
+      self._entries[key] = (value, expires_at, size)
+      self.bytes += size
+
+      while self._entries and \
+            ((self.max_entries is not None and len(self._entries) > self.max_entries) or \
+             (self.max_bytes is not None and self.bytes > self.max_bytes)):
+        _, (_, _, evicted_size) = self._entries.popitem(last=False)
+        self.bytes -= evicted_size
+        self.evictions += 1
+
+  def discard(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self.bytes -= entry[2]
+
+  def discard_if(self, predicate):
+    """Discards every entry whose key matches the predicate."""
+    with self._lock:
+      for key in [k for k in self._entries if predicate(k)]:
+        self.bytes -= self._entries.pop(key)[2]
+
+  def clear(self):
+    with self._lock:
+      self._entries = OrderedDict()
+      self.bytes = 0
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      "entries": len(self._entries),
+      "bytes": self.bytes,
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+      "hit_ratio": float(self.hits) / lookups if lookups else 0.0,
+    }
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class CachedBackend(BackendBase):
+  """Wraps a backend with a read-through LRU cache of documents.
+
+  Any operation this class does not define, including the optional ones,
+  goes straight to the wrapped backend.
+  """
+
+  supports_projection = True
+
+  def __init__(self, backend, max_entries=10000, max_bytes=None, ttl=None,
+               cache_indexes=False, max_index_entries=1000):
+    """Initializes a new cached backend.
+
+    Args:
+      backend: The backend to wrap, such as kvkit.backends.riak.
+      max_entries: The maximum number of documents to cache. None for no
+          limit. Defaults to 10000.
+      max_bytes: The maximum size of the cached documents in bytes, measured
+          as JSON. None for no limit, which is the default.
+      ttl: The number of seconds an entry stays valid for. None, the
+          default, keeps entries until they are evicted or invalidated.
+      cache_indexes: If True, the results of index_keys_only are cached too
+          and invalidated when any indexed field of that class changes.
+          Defaults to False.
+      max_index_entries: The maximum number of index results to cache.
+          Defaults to 1000.
+    """
+    self.backend = backend
+    self.documents = LRUCache(max_entries, max_bytes, ttl)
+    self.indexes = LRUCache(max_index_entries, None, ttl) if cache_indexes else None
+
+  def __getattr__(self, name):
+    return getattr(self.backend, name)
+
+  def stats(self):
+    """Gets the cache statistics.
+
+    Returns:
+      A dictionary with the stats of the "documents" cache and the "indexes"
+      cache (None if index caching is off). Each contains entries, bytes,
+      hits, misses, evictions, and hit_ratio.
+    """
+    return {
+      "documents": self.documents.stats(),
+      "indexes": self.indexes.stats() if self.indexes is not None else None,
+    }
+
+  def clear_cache(self):
+    """Empties the caches. Statistics are kept."""
+    self.documents.clear()
+    if self.indexes is not None:
+      self.indexes.clear()
+
+  def _invalidate_indexes(self, cls, old, new):
+    if self.indexes is None or not cls._indexes:
+      return
+
+    if old is not None and new is not None:
+      for name in cls._indexes:
+        if old.get(name) != new.get(name):
+          break
+      else:
+        return # No indexed field changed.
+
+    self.indexes.discard_if(lambda k: k[0] == cls.__name__)
+
+  def init_class(self, cls):
+    self.backend.init_class(cls)
+
+  def init_document(self, doc, **args):
+    self.backend.init_document(doc, **args)
+
+  def clear_document(self, doc, **args):
+    self.backend.clear_document(doc, **args)
+
+  def post_deserialize(self, doc, data):
+    self.backend.post_deserialize(doc, data)
+
+  def get(self, cls, key, fields=None, **args):
+    data = self.documents.get((cls.__name__, key))
+    if data is None:
+      data, backend_obj = self.backend.get(cls, key, **args)
+      self.documents.put((cls.__name__, key), mediocre_copy(data))
+      return data, backend_obj
+
+    return _copy(data, fields), None
+
+  def get_many(self, cls, keys, fields=None, **args):
+    found = {}
+    for key in keys:
+      data = self.documents.get((cls.__name__, key))
+      if data is not None:
+        found[key] = (_copy(data, fields), None)
+
+    keys_to_get = [key for key in keys if key not in found]
+    if keys_to_get:
+      if hasattr(self.backend, "get_many"):
+        results = self.backend.get_many(cls, keys_to_get, **args)
+      else:
+        results = []
+        for key in keys_to_get:
+          try:
+            results.append(self.backend.get(cls, key, **args))
+          except NotFoundError:
+            results.append(None)
+
+      for key, result in zip(keys_to_get, results):
+        if result is not None:
+          found[key] = result
+          self.documents.put((cls.__name__, key), mediocre_copy(result[0]))
+
+    return [found.get(key) for key in keys]
+
+  def index_keys_only(self, cls, field, start_value, end_value=None, **args):
+    if self.indexes is None:
+      return self.backend.index_keys_only(cls, field, start_value, end_value, **args)
+
+    cache_key = (cls.__name__, field, start_value, end_value, repr(sorted(args.items())))
+    cached = self.indexes.get(cache_key)
+    if cached is None:
+      keys = self.backend.index_keys_only(cls, field, start_value, end_value, **args)
+      cached = (list(keys), getattr(keys, "continuation", None), isinstance(keys, Page))
+      self.indexes.put(cache_key, cached)
+
+    keys, continuation, paged = cached
+    if paged:
+      return Page(keys, continuation)
+    return list(keys)
+
+  def _cache_results(self, cls, results):
+    for key, data, backend_obj in results:
+      self.documents.put((cls.__name__, key), mediocre_copy(data))
+      yield key, data, backend_obj
+
+  def _cached_results(self, cls, results):
+    if isinstance(results, Page):
+      return Page(self._cache_results(cls, results), results.continuation)
+    return self._cache_results(cls, results)
+
+  def _projected(self, fields, args):
+    """Adds the fields of a projection query to the args if the backend can
+    answer it, such as from a covering index. Its results hold only those
+    fields and are not cached."""
+    if fields is not None and getattr(self.backend, "supports_projection", False):
+      args["fields"] = fields
+      return True
+    return False
+
+  def index(self, cls, field, start_value, end_value=None, fields=None, **args):
+    if self._projected(fields, args):
+      return self.backend.index(cls, field, start_value, end_value, **args)
+    return self._cached_results(cls, self.backend.index(cls, field, start_value, end_value, **args))
+
+  def list_all_keys(self, cls, start_value=None, end_value=None, **args):
+    return self.backend.list_all_keys(cls, start_value, end_value, **args)
+
+  def list_all(self, cls, start_value=None, end_value=None, fields=None, **args):
+    if self._projected(fields, args):
+      return self.backend.list_all(cls, start_value, end_value, **args)
+    return self._cached_results(cls, self.backend.list_all(cls, start_value, end_value, **args))
+
+  def save(self, doc, key, data, **args):
+    cls = doc.__class__
+    old = self.documents.peek((cls.__name__, key))
+    self.backend.save(doc, key, data, **args)
+    self.documents.put((cls.__name__, key), mediocre_copy(data))
+    self._invalidate_indexes(cls, old, data)
+
+  def save_many(self, cls, items, **args):
+    olds = [self.documents.peek((cls.__name__, key)) for _, key, _ in items]
+
+    failed = None
+    if hasattr(self.backend, "save_many"):
+      failed = self.backend.save_many(cls, items, **args)
+    else:
+      for doc, key, data in items:
+        self.backend.save(doc, key, data, **args)
+
+    failed_docs = set(id(doc) for doc, _ in failed or ())
+    for (doc, key, data), old in zip(items, olds):
+      if id(doc) in failed_docs:
+        # What is stored is not known anymore.
+        self.documents.discard((cls.__name__, key))
+        self._invalidate_indexes(cls, old, None)
+      else:
+        self.documents.put((cls.__name__, key), mediocre_copy(data))
+        self._invalidate_indexes(cls, old, data)
+    return failed
+
+  def delete(self, cls, key, doc=None, **args):
+    self.documents.discard((cls.__name__, key))
+    self._invalidate_indexes(cls, None, None)
+    self.backend.delete(cls, key, doc=doc, **args)
+
+  def delete_many(self, cls, keys, **args):
+    keys = list(keys)
+    for key in keys:
+      self.documents.discard((cls.__name__, key))
+    self._invalidate_indexes(cls, None, None)
+
+    if hasattr(self.backend, "delete_many"):
+      return self.backend.delete_many(cls, keys, **args)
+
+    for key in keys:
+      self.backend.delete(cls, key, **args)
+    return len(keys)
@@ -15,13 +15,89 @@
 # along with kvkit. If not, see <http://www.gnu.org/licenses/>.
 """This backend uses leveldb to store data.
 
-Note that leveldb can only have one process accessing it. Therefore this might
-not be a good idea if you need multiprocesses.
+Note that leveldb can only have one process accessing it. If you need
+multiprocesses, run ``kvkit.server`` as that process and use the
+``kvkit.backends.leveldb_client`` backend in the others.
+
+The dbs of a class are opened when it is first used, not when it is
+defined, so importing the models does no disk I/O. A process forked after
+that, such as a worker of a pre-fork server, opens its own handles again on
+first use instead of using the ones of its parent, but LevelDB still only
+lets one of them have a db open. ``close_all()`` in the parent before
+forking and ``open_all()`` or ``cls.warmup_leveldb()`` in each child (for
+example from the server's post-fork hook) control when that happens.
+``open_latencies()`` has how long opening each class took. Set ``"lazy":
+False`` in ``_leveldb_options`` to open the dbs when the class is defined.
+
+Every class uses the db and the index db at the paths given as ``"db"``
+and ``"indexdb"`` in its ``_leveldb_options``. Alternatively, many classes
+can share a single db with ``"shared"``::
+
+    class BlogPost(Document):
+      _backend = leveldb
+      _leveldb_options = {"shared": "/var/lib/blog/db"}
+
+Each class then keeps its documents and indexes under its own prefix, which
+is the class name unless ``"prefix"`` is given. The db is opened once for
+all of them, and the data and the indexes of a save or a delete are
+committed together in one write. Set ``"sync": True`` to have every write
+flushed to disk before it returns.
+
+The entries of a property with ``covering=[...]`` hold the values of those
+properties. ``Document.index`` with ``fields`` that are all covered reads
+them from the index instead of loading the documents. Rebuild the indexes
+after changing ``covering``. ``Document.index_terms`` only needs the index
+entries, which have the values of their property, for any indexed property.
+
+The options of ``plyvel.DB`` listed in ``DB_OPTIONS`` can be given in
+``_leveldb_options`` as well, such as ``"lru_cache_size"`` (the size of the
+block cache in bytes), ``"bloom_filter_bits"``, ``"write_buffer_size"``,
+``"block_size"`` and ``"compression"``. They apply to all the dbs of the
+class, and ``"db_options"`` and ``"indexdb_options"`` can override them for
+one of them::
+
+    _leveldb_options = {
+      "db": "/var/lib/blog/posts",
+      "indexdb": "/var/lib/blog/posts.indexes",
+      "lru_cache_size": 512 * 1024 * 1024,
+      "db_options": {"bloom_filter_bits": 10},
+    }
+
+A db is only opened once per process, so classes with the same paths, like
+subclasses inheriting ``_leveldb_options``, share it. They must all give it
+the same options.
+
+Reads inside ``Document.snapshot()`` use LevelDB snapshots. In a shared db
+one snapshot covers both the documents and the indexes. With separate dbs,
+the index db is snapshotted just before the db, so an index entry can point
+to a document deleted in between; such documents are skipped.
+
+The indexes of a class can be rebuilt from its documents with
+``Document.rebuild_indexes()``, or with ``python -m kvkit.reindex`` while
+nothing else has the db open. The new index is built next to the current
+one, which keeps answering queries until it is swapped in at the end.
+Documents written by the same process during a rebuild are indexed in both.
+An index db used by several classes, such as a class and its subclasses,
+can only be rebuilt or repaired in a process that opens just one of them,
+like ``python -m kvkit.reindex``, and only from the class that has all the
+indexes.
+
+Index dbs created with an older layout of the index entries must be rebuilt
+from the documents first. Set ``"rebuild_indexes": True`` in
+``_leveldb_options`` to do so when they are opened.
 """
 
 from __future__ import absolute_import
 
+from contextlib import contextmanager
 from copy import copy
+from itertools import chain
+import os
+import shutil
+import struct
+import threading
+import time
+import weakref
 try:
   import ujson as json
 except ImportError:
@@ -33,90 +109,587 @@ except ImportError:
 try:
   import plyvel
 except ImportError:
-  import warning
+  import warnings
   available = False
   warnings.warn("LevelDB not available as plyvel is not installed.")
 else:
   available = True
 
 from ..exceptions import NotFoundError
+from ..helpers import external_sort
+from ..pagination import Page, decode_continuation, paginate
+
+# Projection queries on covering indexes are answered from the index. For
+# the others, the full documents are returned and kvkit picks the fields.
+supports_projection = True
+
+# The indexes of a document as last loaded or saved, to know which entries
+# to remove when it is saved again.
+document_slots = ("_leveldb_old_indexes", )
+
+
+# Each indexed (field, value, key) is its own entry in the index db,
+# "<field>\x00<encoded value><key>", with an empty value, or the JSON of the
+# covered values for a covering index. Writing or removing one is a single
+# put or delete, and queries are range scans. The encoded values sort in the
+# same order as the values themselves and each ends where the key begins, so
+# the entries are ordered by value, then by key.
+_SEP = "\x00"
+
+# The encoded values start with their type. All numbers, including
+# datetimes, which are stored as seconds since the epoch, sort before all
+# strings.
+_NUMBER = "\x10"
+_STRING = "\x20"
+
+# Strings end with a terminator, and a \x00 in a string is escaped to
+# \x00\xff, so "a" sorts before both "a\x00" and "ab" and no string is a prefix
+# of the encoding of another.
+_STRING_END = "\x00\x01"
+
+_SIGN_BIT = 1 << 63
+_ALL_BITS = (1 << 64) - 1
+
+# Marks the layout of the index db. Version 1, which had no marker, stored
+# a JSON list of all the keys for each "<field>~<value>". Version 2 had the
+# values as plain strings, so numbers sorted as text.
+_VERSION_KEY = "\x00version"
+_INDEX_VERSION = "3"
+
+# In a shared db, the index of a class alternates between the "<prefix>\x00i"
+# and "<prefix>\x00j" prefixes with every rebuild. This key has the current
+# one.
+_INDEX_NAME_KEY = "\x00g"
+
+
+def _encode_value(value):
+  """Encodes an index value so the byte order of the encodings is the order
+  of the values."""
+  if isinstance(value, (int, long, float)):
+    # Integers become doubles so they compare with floats, as NumberProperty
+    # queries are made with floats. Adding 0.0 turns -0.0 into 0.0.
+    bits = struct.unpack(">Q", struct.pack(">d", float(value) + 0.0))[0]
+    # Flipping the sign bit puts positive numbers after negative ones, and
+    # flipping all the bits of negative numbers reverses their order.
+    bits = bits ^ _ALL_BITS if bits & _SIGN_BIT else bits | _SIGN_BIT
+    return _NUMBER + struct.pack(">Q", bits)
+
+  if isinstance(value, unicode):
+    value = value.encode("utf-8")
+  elif not isinstance(value, str):
+    value = str(value)
+  return _STRING + value.replace("\x00", "\x00\xff") + _STRING_END
+
+
+def _index_prefix(field, value):
+  return field + _SEP + _encode_value(value)
+
+
+def _index_entry(field, value, key):
+  return _index_prefix(field, value) + str(key)
+
+
+def _entry_key(entry, field):
+  """Gets the document key from an index entry of a field."""
+  start = len(field) + 1
+  if entry[start] == _NUMBER:
+    return entry[start + 9:]
+  return entry[entry.index(_STRING_END, start + 1) + len(_STRING_END):]
+
+
+def _entry_value(entry, field):
+  """Gets the value from an index entry of a field, undoing _encode_value.
+  Numbers come back as floats and strings as unicode."""
+  start = len(field) + 1
+  if entry[start] == _NUMBER:
+    bits = struct.unpack(">Q", entry[start + 1:start + 9])[0]
+    bits = bits ^ _SIGN_BIT if bits & _SIGN_BIT else bits ^ _ALL_BITS
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+  value = entry[start + 1:entry.index(_STRING_END, start + 1)]
+  return value.replace("\x00\xff", "\x00").decode("utf-8")
+
+
+# The options of plyvel.DB that can be given in _leveldb_options.
+DB_OPTIONS = (
+  "lru_cache_size",
+  "bloom_filter_bits",
+  "write_buffer_size",
+  "block_size",
+  "block_restart_interval",
+  "max_file_size",
+  "max_open_files",
+  "compression",
+  "paranoid_checks",
+)
+
+# Open dbs by absolute path, as [db, number of classes using it, options].
+_open_dbs = {}
+_open_dbs_lock = threading.Lock()
+# The process the dbs in _open_dbs were opened by.
+_open_dbs_pid = os.getpid()
+
+# The handles opened by the parent of this process before it forked. They
+# are never used or closed here, as closing them would write to the files
+# the parent has open, only kept so garbage collection does not close them.
+_inherited_dbs = []
+
+# Held while opening or closing the dbs of a class. It is reentrant as
+# opening can read and rebuild the indexes, which gets the dbs again.
+_connect_lock = threading.RLock()
+
+# The classes using this backend, to open or close them all.
+_classes = weakref.WeakSet()
+
+# The number of queries and snapshots reading each index db, by db, and the
+# rebuilt index dbs waiting for them to be done to replace it, as
+# _IndexTargets by the db they replace.
+_index_readers = {}
+_pending_swaps = {}
+_index_readers_lock = threading.Lock()
+
+
+def _db_options(cls, name):
+  """Gets the plyvel.DB options of the "db", "indexdb" or "shared" db of a
+  class."""
+  options = dict((k, v) for k, v in cls._leveldb_options.iteritems() if k in DB_OPTIONS)
+  options.update(cls._leveldb_options.get(name + "_options", {}))
+  return options
+
+
+def _forget_parent_dbs():
+  """Sets aside the dbs in _open_dbs if they are from the parent process.
+  Must be called with _open_dbs_lock held."""
+  global _open_dbs_pid
+  pid = os.getpid()
+  if pid != _open_dbs_pid:
+    _inherited_dbs.extend(entry[0] for entry in _open_dbs.itervalues())
+    _open_dbs.clear()
+    _open_dbs_pid = pid
+
+
+def _open_db(path, options):
+  """Opens the db at a path, or gets it if it is already open.
+
+  Raises:
+    ValueError if it is already open with other options.
+  """
+  path = os.path.abspath(path)
+  with _open_dbs_lock:
+    _forget_parent_dbs()
+    entry = _open_dbs.get(path)
+    if entry is None:
+      entry = _open_dbs[path] = [plyvel.DB(path, create_if_missing=True, **options), 0, options]
+    elif entry[2] != options:
+      raise ValueError("The LevelDB at '{0}' is already open with other options.".format(path))
+    entry[1] += 1
+    return entry[0]
+
+
+def _release_db(path):
+  """Closes the db at a path if this was its last user."""
+  path = os.path.abspath(path)
+  with _open_dbs_lock:
+    _forget_parent_dbs()
+    entry = _open_dbs[path]
+    entry[1] -= 1
+    if entry[1] == 0:
+      entry[0].close()
+      del _open_dbs[path]
+
+
+def _db_users(path):
+  with _open_dbs_lock:
+    _forget_parent_dbs()
+    entry = _open_dbs.get(os.path.abspath(path))
+    return 0 if entry is None else entry[1]
+
+
+def _connected(cls):
+  """Gets the _leveldb_meta of a class, opening its dbs first if this
+  process has not opened them yet."""
+  meta = cls._leveldb_meta
+  if meta.get("pid") != os.getpid():
+    with _connect_lock:
+      # The thread opening the dbs gets them while it checks the indexes.
+      if meta.get("pid") != os.getpid() and not meta.get("opening"):
+        cls.open_leveldb_connections()
+  return meta
+
+
+def _data_db(cls):
+  return _connected(cls)["db"]
+
+
+def _index_db(cls):
+  return _connected(cls).get("indexdb")
+
+
+# The _Views of the classes with an active snapshot, in each thread.
+_local = threading.local()
+
+
+def _current_view(cls):
+  views = getattr(_local, "views", None)
+  return views.get(cls) if views else None
+
+
+def _data_reader(cls):
+  """Gets what reads of documents should go to: the snapshot if there is an
+  active one, or the db."""
+  view = _current_view(cls)
+  return _data_db(cls) if view is None else view.data
+
+
+def _acquire_index(cls):
+  """Gets the index db of a class to read it. It is not swapped for a
+  rebuilt one until it is given back with _release_index."""
+  meta = _connected(cls)
+  with _index_readers_lock:
+    db = meta.get("indexdb")
+    if db is not None:
+      _index_readers[db] = _index_readers.get(db, 0) + 1
+  return db
+
+
+def _release_index(db):
+  with _index_readers_lock:
+    readers = _index_readers.pop(db) - 1
+    if readers:
+      _index_readers[db] = readers
+      return
+    target = _pending_swaps.get(db)
+
+  if target is not None:
+    target.finish_swap()
+
+
+@contextmanager
+def _index_reader(cls):
+  """Gets what index queries should read: the snapshot if there is an active
+  one, or the db."""
+  view = _current_view(cls)
+  if view is not None:
+    yield view.index
+    return
+
+  db = _acquire_index(cls)
+  try:
+    yield db
+  finally:
+    _release_index(db)
+
+
+class _PrefixedIterator(object):
+  """Strips the prefix from the keys of a snapshot iterator."""
+  def __init__(self, it, length, include_value):
+    self._it = it
+    self._length = length
+    self._include_value = include_value
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._it.close()
+    return False
+
+  def __iter__(self):
+    length = self._length
+    if self._include_value:
+      for key, value in self._it:
+        yield key[length:], value
+    else:
+      for key in self._it:
+        yield key[length:]
 
 
-index_key = lambda f, v: "{0}~{1}".format(f, v)
+class _PrefixedSnapshot(object):
+  """The keys of a prefixed db in a snapshot of the db it is in.
+
+  plyvel can only snapshot a prefixed db on its own, so this is how the
+  data and the indexes of a class in a shared db are read from the same
+  snapshot.
+  """
+  __slots__ = ("_snapshot", "_prefix", "_end")
+
+  def __init__(self, snapshot, prefix):
+    self._snapshot = snapshot
+    self._prefix = prefix
+    # The first key past all the ones starting with the prefix.
+    self._end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+  def get(self, key):
+    return self._snapshot.get(self._prefix + key)
+
+  def iterator(self, start=None, stop=None, include_start=True, include_stop=False, reverse=False,
+               include_value=True):
+    if start is None:
+      start, include_start = self._prefix, True
+    else:
+      start = self._prefix + start
+
+    if stop is None:
+      stop, include_stop = self._end, False
+    else:
+      stop = self._prefix + stop
+
+    it = self._snapshot.iterator(start=start, stop=stop, include_start=include_start,
+                                 include_stop=include_stop, reverse=reverse,
+                                 include_value=include_value)
+    return _PrefixedIterator(it, len(self._prefix), include_value)
+
+
+class _View(object):
+  """Snapshots of the data and the index db of a class."""
+  def __init__(self, cls):
+    meta = _connected(cls)
+    self._indexdb = idb = _acquire_index(cls)
+    shared = meta.get("shared")
+    if shared is not None:
+      root = shared.snapshot()
+      self._snapshots = (root, )
+      self.data = _PrefixedSnapshot(root, _data_db(cls).prefix)
+      self.index = None if idb is None else _PrefixedSnapshot(root, idb.prefix)
+    else:
+      # The indexes are written after the data, so every entry in the index
+      # snapshot has its document in the data snapshot, unless it was
+      # deleted in between.
+      self.index = None if idb is None else idb.snapshot()
+      self.data = _data_db(cls).snapshot()
+      self._snapshots = (self.data, ) if self.index is None else (self.data, self.index)
+
+  def close(self):
+    for snapshot in self._snapshots:
+      snapshot.close()
+    if self._indexdb is not None:
+      _release_index(self._indexdb)
+
+
+@contextmanager
+def snapshot(cls):
+  views = getattr(_local, "views", None)
+  if views is None:
+    views = _local.views = {}
+
+  if cls in views:
+    yield
+    return
+
+  views[cls] = view = _View(cls)
+  try:
+    yield
+  finally:
+    del views[cls]
+    view.close()
+
+
+class _PrefixedBatch(object):
+  """Writes to a prefixed db through a write batch of the db it is in."""
+  __slots__ = ("_wb", "_prefix")
+
+  def __init__(self, wb, prefix):
+    self._wb = wb
+    self._prefix = prefix
+
+  def put(self, key, value):
+    self._wb.put(self._prefix + key, value)
+
+  def delete(self, key):
+    self._wb.delete(self._prefix + key)
+
+
+@contextmanager
+def _writing(cls):
+  """Serializes the writes of a class with the steps of an index rebuild.
+
+  Yields the rebuild in progress, if any, which the changes to the indexes
+  must also be given to.
+  """
+  meta = _connected(cls)
+  with meta["write_lock"]:
+    yield meta.get("rebuild")
+
+
+class _Batch(object):
+  """The writes of one operation to the data and the index db of a class.
+
+  ``data`` and ``index`` (None without an index db) take puts and deletes.
+  If the class is in a shared db, they go into one write batch and are
+  committed atomically. Otherwise the data is written before the indexes.
+  """
+  def __init__(self, cls):
+    meta = _connected(cls)
+    sync = cls._leveldb_options.get("sync", False)
+    idb = _index_db(cls)
+    shared = meta.get("shared")
+    if shared is not None:
+      wb = shared.write_batch(sync=sync)
+      self._batches = (wb, )
+      self.data = _PrefixedBatch(wb, _data_db(cls).prefix)
+      self.index = None if idb is None else _PrefixedBatch(wb, idb.prefix)
+    else:
+      self.data = _data_db(cls).write_batch(sync=sync)
+      self.index = None if idb is None else idb.write_batch(sync=sync)
+      self._batches = (self.data, ) if self.index is None else (self.data, self.index)
+
+  def write(self):
+    for wb in self._batches:
+      wb.write()
 
 
 def clear_document(self, **args):
-  self.__dict__["_leveldb_old_indexes"] = {}
+  self._leveldb_old_indexes = {}
 
 
 def get(cls, key, **args):
   key = str(key)
 
-  value = cls._leveldb_meta["db"].get(key)
+  value = _data_reader(cls).get(key)
   if value is None:
     raise NotFoundError
 
   return json.loads(value), None
 
 
+def get_many(cls, keys, **args):
+  keys = [str(key) for key in keys]
+
+  # One snapshot so all the reads are consistent with each other, and sorted
+  # access so we walk the sstables in order.
+  view = _current_view(cls)
+  reader = _data_db(cls).snapshot() if view is None else view.data
+  values = {}
+  for key in sorted(set(keys)):
+    value = reader.get(key)
+    if value is not None:
+      values[key] = json.loads(value)
+
+  if view is None:
+    reader.close()
+
+  return [(values[key], None) if key in values else None for key in keys]
+
+
 def _ensure_indexdb_exists(cls):
-  if not cls._leveldb_meta.get("indexdb"):
+  if not _index_db(cls):
     raise RuntimeError("DB for indexes are not defined for class '{0}'.".format(cls.__name__))
 
 
-def index(cls, field, start_value, end_value=None, **args):
-  _ensure_indexdb_exists(cls)
+def _iterator_args(start, stop, reverse, last=None, include_last=False, include_stop=True):
+  """Builds the arguments for a db iterator over [start, stop] that resumes
+  after (or at, if include_last) the last position when it is not None."""
+  args = {"start": start, "stop": stop, "include_stop": include_stop, "reverse": reverse}
+  if last is not None:
+    if reverse:
+      args["stop"] = last
+      args["include_stop"] = include_last
+    else:
+      args["start"] = last
+      args["include_start"] = include_last
+  return args
+
+
+def _index_entries(cls, field, start_value, end_value, reverse=False, continuation=None, include_value=False,
+                   include_term=False):
+  """Yields (position, document key) for all the documents matching an index
+  query, resuming after the continuation. With include_value, the key is
+  (document key, value of the entry) instead. With include_term, it is
+  (indexed value, document key)."""
+  last = None
+  if continuation is not None:
+    try:
+      last = str(decode_continuation(continuation)).decode("hex")
+    except (TypeError, UnicodeEncodeError):
+      raise ValueError("Invalid continuation '{0}'.".format(continuation))
+
+  start = _index_prefix(field, start_value)
+  # Keys are ASCII, so this sorts after all the entries with the end value
+  # and before any with a greater one.
+  stop = _index_prefix(field, start_value if end_value is None else end_value) + "\xff"
+
+  iterator_args = _iterator_args(start, stop, reverse, last, include_stop=False)
+  with _index_reader(cls) as reader, reader.iterator(include_value=include_value, **iterator_args) as it:
+    for item in it:
+      # The positions are in hex as the entries are not necessarily UTF-8.
+      if include_value:
+        yield item[0].encode("hex"), (_entry_key(item[0], field), item[1])
+      elif include_term:
+        yield item.encode("hex"), (_entry_value(item, field), _entry_key(item, field))
+      else:
+        yield item.encode("hex"), _entry_key(item, field)
 
-  indexdb = cls._leveldb_meta["indexdb"]
-  if end_value is None:
-    ik = index_key(field, start_value)
-    v = indexdb.get(ik)
 
-    if v is None:
-      keys = []
-    else:
-      keys = json.loads(v)
+def _unique_entries(entries, with_values=False):
+  # to avoid awkward scenarios where two index values have the same obj
+  keys_iterated = set()
+  for position, item in entries:
+    key = item[0] if with_values else item
+    if key not in keys_iterated:
+      keys_iterated.add(key)
+      yield position, item
 
-    for k in keys:
-      v, o = get(cls, k)
-      yield k, v, o
 
-  else:
-    it = indexdb.iterator(start=index_key(field, start_value),
-                          stop=index_key(field, end_value),
-                          include_stop=True,
-                          include_key=False)
-    # to avoid awkward scenarios where two index values have the same obj
-    keys_iterated = set()
-    for keys in it:
-      for k in json.loads(keys):
-        if k not in keys_iterated:
-          keys_iterated.add(k)
-          v, o = get(cls, k)
-          yield k, v, o
-
-
-def index_keys_only(cls, field, start_value, end_value=None, **args):
+def _covered_documents(cls, entries):
+  reader = None
+  for position, (key, value) in entries:
+    if value:
+      yield position, (key, json.loads(value), None)
+      continue
+
+    # Written before the property was made covering.
+    if reader is None:
+      reader = _data_reader(cls)
+    value = reader.get(key)
+    if value is not None:
+      yield position, (key, json.loads(value), None)
+
+
+def _covered_index(cls, field, start_value, end_value, limit=None, reverse=False, continuation=None, **args):
+  entries = _index_entries(cls, field, start_value, end_value, reverse, continuation, include_value=True)
+  if end_value is not None:
+    entries = _unique_entries(entries, with_values=True)
+
+  return paginate(_covered_documents(cls, entries), limit)
+
+
+def index(cls, field, start_value, end_value=None, fields=None, **args):
+  covered = cls._leveldb_meta["covering"].get(field)
+  if fields is not None and covered and set(fields).issubset(covered):
+    _ensure_indexdb_exists(cls)
+    return _covered_index(cls, field, start_value, end_value, **args)
+
+  keys = index_keys_only(cls, field, start_value, end_value, **args)
+  if isinstance(keys, Page):
+    results = get_many(cls, keys)
+    return Page([(k, r[0], r[1]) for k, r in zip(keys, results) if r is not None], keys.continuation)
+
+  return _get_each(_data_reader(cls), keys)
+
+
+def _get_each(reader, keys):
+  # Documents removed since the index was read are skipped, like get_many
+  # does for pages.
+  for key in keys:
+    value = reader.get(str(key))
+    if value is not None:
+      yield key, json.loads(value), None
+
+
+def index_keys_only(cls, field, start_value, end_value=None, limit=None, reverse=False, continuation=None, **args):
   _ensure_indexdb_exists(cls)
 
-  indexdb = cls._leveldb_meta["indexdb"]
-  if end_value is None:
-    ik = index_key(field, start_value)
-    v = indexdb.get(ik)
-    if v is None:
-      return []
-    else:
-      return json.loads(indexdb.get(ik))
-  else:
-    all_keys = []
-    it = indexdb.iterator(start=index_key(field, start_value),
-                          stop=index_key(field, end_value),
-                          include_stop=True,
-                          include_key=False)
-    for keys in it:
-      all_keys.extend(json.loads(keys))
+  entries = _index_entries(cls, field, start_value, end_value, reverse, continuation)
+  if end_value is not None:
+    entries = _unique_entries(entries)
+
+  return paginate(entries, limit)
 
-    return list(set(all_keys))
+
+def index_terms(cls, field, start_value, end_value=None, limit=None, reverse=False, continuation=None, **args):
+  """Reads the values with the keys from the index entries alone."""
+  _ensure_indexdb_exists(cls)
+  entries = _index_entries(cls, field, start_value, end_value, reverse, continuation, include_term=True)
+  return paginate(entries, limit)
 
 
 def init_class(cls):
@@ -124,104 +697,249 @@ def init_class(cls):
     # must be in test mode
     return
 
-  setattr(cls, "_leveldb_meta", {})
+  setattr(cls, "_leveldb_meta", {
+    "write_lock": threading.Lock(),
+    # indexed field => the names of the properties it covers
+    "covering": dict((name, cls._meta[name]._covering) for name in cls._indexes if cls._meta[name]._covering),
+  })
+  _classes.add(cls)
 
   def open_connections(cls):
+    with _connect_lock:
+      meta = cls._leveldb_meta
+      pid = os.getpid()
+      if meta.get("pid") == pid:
+        return
+
+      if "pid" in meta:
+        # Opened by the parent process. Its handles, its lock and any rebuild
+        # it was running are not this process'.
+        _forget_connections(meta)
+        meta["write_lock"] = threading.Lock()
+        meta.pop("rebuild", None)
+
+      start = time.time()
+      meta["opening"] = True
+      try:
+        _open_connections(cls, meta)
+        meta["pid"] = pid
+      except:
+        close_connections(cls)
+        raise
+      finally:
+        del meta["opening"]
+      meta["open_latency"] = time.time() - start
 
-    db = cls._leveldb_options.get("db")
-    indexdb = cls._leveldb_options.get("indexdb")
+  def close_connections(cls):
+    with _connect_lock:
+      meta = cls._leveldb_meta
+      if meta.get("pid") == os.getpid():
+        with _index_readers_lock:
+          target = _pending_swaps.get(meta.get("indexdb"))
+        # The queries still reading the old indexes end here either way.
+        if target is not None:
+          target.finish_swap(force=True)
+
+      paths = meta.pop("paths", ())
+      pid = meta.pop("pid", None)
+      _forget_connections(meta)
+      # The handles of the parent process are left alone.
+      if pid is None or pid == os.getpid():
+        for path in paths:
+          _release_db(path)
+
+  def warmup(cls, fill_cache=False):
+    """Opens the dbs of the class now rather than on first use.
+
+    Args:
+      fill_cache: If True, also reads all the documents and the index
+          entries once, which loads them into the OS cache and as much as
+          fits into the block cache.
+    """
+    meta = _connected(cls)
+    if fill_cache:
+      for db in (meta["db"], meta.get("indexdb")):
+        if db is not None:
+          with db.iterator() as it:
+            for _ in it:
+              pass
+
+  cls.open_leveldb_connections = classmethod(open_connections)
+  cls.close_leveldb_connections = classmethod(close_connections)
+  cls.warmup_leveldb = classmethod(warmup)
+
+  if not cls._leveldb_options.get("lazy", True):
+    cls.open_leveldb_connections()
+
+
+def _open_connections(cls, meta):
+  shared = cls._leveldb_options.get("shared")
+  db = cls._leveldb_options.get("db")
+  indexdb = cls._leveldb_options.get("indexdb")
+  # The paths of the dbs opened, to release them when closing.
+  meta["paths"] = paths = []
+  if shared is not None:
+    if isinstance(shared, basestring):
+      root = _open_db(shared, _db_options(cls, "shared"))
+      paths.append(shared)
+    else:
+      root = shared
+    prefix = str(cls._leveldb_options.get("prefix", cls.__name__))
+    meta["shared"] = root
+    meta["prefix"] = prefix
+    # Class names cannot have a \x00, so no prefix is the start of another.
+    meta["db"] = root.prefixed_db(prefix + "\x00d")
+    meta["indexdb"] = root.prefixed_db(prefix + "\x00" + (root.get(prefix + _INDEX_NAME_KEY) or "i"))
+  else:
     if isinstance(db, basestring):
-      cls._leveldb_meta["db"] = plyvel.DB(db, create_if_missing=True)
+      meta["db"] = _open_db(db, _db_options(cls, "db"))
+      paths.append(db)
 
     if isinstance(indexdb, basestring):
-      cls._leveldb_meta["indexdb"] = plyvel.DB(indexdb, create_if_missing=True)
+      if not _db_users(indexdb):
+        _finish_swap(indexdb)
+      meta["indexdb"] = _open_db(indexdb, _db_options(cls, "indexdb"))
+      paths.append(indexdb)
 
-  def close_connections(cls):
-    if cls._leveldb_meta.get("db"):
-      cls._leveldb_meta["db"].close()
+  if shared is not None or isinstance(indexdb, basestring):
+    _check_index_version(cls)
 
-    if cls._leveldb_meta.get("indexdb"):
-      cls._leveldb_meta["indexdb"].close()
 
-  cls.open_leveldb_connections = classmethod(open_connections)
-  cls.open_leveldb_connections()
+def _forget_connections(meta):
+  # The prefixed dbs are only views of the shared one.
+  for name in ("shared", "prefix", "db", "indexdb", "paths", "pid", "open_latency"):
+    meta.pop(name, None)
 
-  cls.close_leveldb_connections = classmethod(close_connections)
 
+def open_all():
+  """Opens the dbs of every class that uses this backend."""
+  for cls in list(_classes):
+    cls.open_leveldb_connections()
 
-def init_document(self, **args):
-  pass
 
+def close_all():
+  """Closes the dbs of every class that uses this backend. They are opened
+  again when the classes are next used."""
+  for cls in list(_classes):
+    cls.close_leveldb_connections()
 
-def list_all(cls, start_value=None, end_value=None, **args):
-  with cls._leveldb_meta["db"].iterator(start=start_value, stop=end_value, include_stop=True) as it:
-    for key, value in it:
-      yield key, json.loads(value), None
 
+def open_latencies():
+  """Gets how long opening the dbs of each class took in this process.
 
-def list_all_keys(cls, start_value=None, end_value=None, **args):
-  with cls._leveldb_meta["db"].iterator(start=start_value, stop=end_value, include_value=False, include_stop=True) as it:
-    for key in it:
-      yield key
+  Returns:
+    A dictionary of the open classes to seconds, including checking and
+    rebuilding their indexes if that was needed.
+  """
+  pid = os.getpid()
+  return dict((cls, cls._leveldb_meta["open_latency"]) for cls in list(_classes)
+              if cls._leveldb_meta.get("pid") == pid)
 
-def _build_indexes(cls, data):
-  indexes = {}
-  for name in cls._indexes:
-    indexes[name] = copy(data.get(name))
-  return indexes
 
-def _figure_out_index_writes(idb, key, old, new):
-  # Here be the dragons... Actually it is not /that/ bad.
-  # If there is two copies of the same object and both saved without knowing
-  # each other, that would be disastrous.
+def init_document(self, **args):
+  pass
 
-  wb = idb.write_batch()
 
-  def add_index(field, value):
-    if value is None:
-      return # value is already none.. Do not index.
+def _list_all_entries(cls, start_value, end_value, reverse, continuation, include_value):
+  last = None
+  if continuation is not None:
+    last = decode_continuation(continuation).encode("utf-8")
 
-    keys = idb.get(index_key(field, value), [])
-    if key not in keys:
-      keys.append(key)
-      wb.put(index_key(field, value), json.dumps(keys))
+  iterator_args = _iterator_args(start_value, end_value, reverse, last)
+  with _data_reader(cls).iterator(include_value=include_value, **iterator_args) as it:
+    for item in it:
+      yield (item[0] if include_value else item), item
 
 
-  def remove_index(field, value):
-    keys = idb.get(index_key(field, value))
-    if keys is None:
-      return # Already removed
+def list_all(cls, start_value=None, end_value=None, limit=None, reverse=False, continuation=None, **args):
+  entries = _list_all_entries(cls, start_value, end_value, reverse, continuation, True)
+  entries = ((key, (key, json.loads(value), None)) for key, (_, value) in entries)
+  return paginate(entries, limit)
 
-    keys = json.loads(keys)
 
-    try:
-      keys.remove(key)
-    except ValueError:
-      return # Already removed
+def list_all_keys(cls, start_value=None, end_value=None, limit=None, reverse=False, continuation=None, **args):
+  entries = _list_all_entries(cls, start_value, end_value, reverse, continuation, False)
+  return paginate(entries, limit)
 
-    if len(keys) == 0:
-      wb.delete(index_key(field, value))
-    else:
-      wb.put(index_key(field, value), json.dumps(keys))
+def _build_indexes(cls, data, fields=None):
+  indexes = {}
+  for name in (cls._indexes if fields is None else fields):
+    indexes[name] = copy(data.get(name))
+  return indexes
+
+def _document_index_changes(doc, key, data):
+  """Figures out the index changes for saving a document and remembers the
+  new indexes on the document.
+
+  Only the indexed fields modified since the document was loaded are diffed.
+  The entries of covering indexes whose covered properties were modified
+  are written again.
+  """
+  old_indexes = doc._leveldb_old_indexes
+  dirty = doc.dirty_fields()
+  fields = [name for name in doc.__class__._indexes if name in dirty]
+
+  new_indexes = dict(old_indexes)
+  new_indexes.update(_build_indexes(doc.__class__, data, fields))
+  doc._leveldb_old_indexes = new_indexes
+
+  old = dict((name, old_indexes[name]) for name in fields if name in old_indexes)
+  new = dict((name, new_indexes[name]) for name in fields)
+  changes = _index_changes(key, old, new)
+
+  refresh = {}
+  for name, covered in doc.__class__._leveldb_meta["covering"].iteritems():
+    # Values of the field that did not change keep their entries otherwise.
+    if name in new_indexes and any(n in dirty for n in covered):
+      refresh[name] = new_indexes[name]
+
+  if refresh:
+    changes = chain(changes, _index_changes(key, {}, refresh))
+  return changes
+
+
+def _covering_values(cls, data):
+  """Gets the values of the entries of the covering indexes of a document.
+
+  Returns:
+    None if the class has no covering indexes, or {field: JSON of the
+    covered values}.
+  """
+  covering = cls._leveldb_meta["covering"]
+  if not covering:
+    return None
+
+  return dict((field, json.dumps(dict((name, data.get(name)) for name in covered)))
+              for field, covered in covering.iteritems())
+
+def _index_changes(key, old, new):
+  """Figures out the index entries to add and remove for a document.
+
+  Yields (add, field, value, key) where add is True for an addition and False
+  for a removal.
+  """
+  # Here be the dragons... Actually it is not /that/ bad.
+  # If there is two copies of the same object and both saved without knowing
+  # each other, that would be disastrous.
 
   for field, value in old.iteritems():
     if isinstance(value, (list, tuple)):
       old_values = set(value)
-      new_values = set(new.get(field, []))
+      new_values = set(new.get(field) or [])
 
       for v in (old_values - new_values):
-        remove_index(field, v)
+        yield False, field, v, key
       for v in (new_values - old_values):
-        add_index(field, v)
+        yield True, field, v, key
     else:
       if field not in new:
-        remove_index(field, value)
+        yield False, field, value, key
       else:
         if value != new[field]:
-          remove_index(field, value)
-          # None values should be handled by add_index and
-          # it should simply return.
-          add_index(field, new[field])
+          yield False, field, value, key
+          # None values are handled by _figure_out_index_writes and will
+          # simply be skipped.
+          yield True, field, new[field], key
 
   # Now we need to take a look at the new dictionary and make sure to add
   # anything that we missed. We already noted the change in field as well as
@@ -229,57 +947,661 @@ def _figure_out_index_writes(idb, key, old, new):
 
   for field, value in new.iteritems():
     if field not in old:
-      # TODO: refactor
       if isinstance(value, (list, tuple)):
         for v in value:
-          add_index(field, v)
+          yield True, field, v, key
       else:
-        add_index(field, value)
+        yield True, field, value, key
 
-  return wb
 
-def save(self, key, data, **args):
-  key = key.encode("ascii")
-  index_writebatch = None
-  if self._leveldb_meta.get("indexdb"):
-    new_indexes = _build_indexes(self.__class__, data)
-    index_writebatch = _figure_out_index_writes(self._leveldb_meta["indexdb"],
-                                                key,
-                                                self._leveldb_old_indexes,
-                                                new_indexes)
-    # BUG: (?) Is it possible to fail something so badly that the _old_indexes
-    # never gets flushed? Hopefully not.
-    self._leveldb_old_indexes = new_indexes
+def _figure_out_index_writes(wb, changes, values=None):
+  """Adds the writes for index changes to a write batch.
 
-  self._leveldb_meta["db"].put(key, json.dumps(data))
+  Every change is a put or a delete of its own entry, so nothing is read
+  and saving documents that share index values does not conflict.
 
-  if index_writebatch:
-    index_writebatch.write()
+  Args:
+    wb: A write batch for the index db, or the index part of a _Batch.
+    changes: An iterator of changes as yielded by _index_changes.
+    values: {document key: result of _covering_values} for the documents
+        added to covering indexes.
+  """
+  for add, field, value, key in changes:
+    if value is None:
+      continue # None values are not indexed.
 
+    if add:
+      covered = values.get(key) if values else None
+      wb.put(_index_entry(field, value, key), covered.get(field, "") if covered else "")
+    else:
+      wb.delete(_index_entry(field, value, key))
+
+
+def _is_empty(db):
+  with db.iterator(include_value=False) as it:
+    for _ in it:
+      return False
+  return True
+
+
+def _clear(db, batch_size=10000):
+  wb = db.write_batch()
+  with db.iterator(include_value=False) as it:
+    for i, key in enumerate(it, 1):
+      wb.delete(key)
+      if i % batch_size == 0:
+        wb.write()
+        wb = db.write_batch()
+  wb.write()
+
+
+def _finish_swap(path):
+  """Completes a swap of index dbs that was interrupted by a crash.
+
+  The new db is only renamed to path once it is complete, so if path is
+  missing it is the rebuilt one.
+  """
+  if not os.path.exists(path) and os.path.exists(path + ".rebuild"):
+    os.rename(path + ".rebuild", path)
+  if os.path.exists(path) and os.path.exists(path + ".old"):
+    shutil.rmtree(path + ".old")
+
+
+def _ensure_sole_index_user(cls, action):
+  """Raises ValueError if other classes use the index db of a class. Their
+  entries would be lost, as only the documents and the indexes of this
+  class are known."""
+  path = cls._leveldb_options.get("indexdb")
+  if isinstance(path, basestring) and _db_users(path) > 1:
+    raise ValueError("Cannot {0} the indexes of '{1}': the index db at '{2}' is used by other classes too. "
+                     "Do it in a process that only opens this class.".format(action, cls.__name__, path))
+
+
+class _IndexTarget(object):
+  """The index db a rebuild writes to, and how to swap it in.
+
+  For index dbs opened from a path, this is a new db next to it. In a shared
+  db, it is the other one of the two index prefixes of the class. Otherwise,
+  the index db is cleared and rebuilt in place.
+  """
+  def __init__(self, cls):
+    self._meta = meta = _connected(cls)
+    self._path = cls._leveldb_options.get("indexdb")
+    self._options = _db_options(cls, "indexdb")
+    self._old = None
+
+    if meta.get("shared") is not None:
+      self._name = "j" if meta["indexdb"].prefix.endswith("i") else "i"
+      self.db = meta["shared"].prefixed_db(meta["prefix"] + "\x00" + self._name)
+      # Left over from an interrupted rebuild.
+      _clear(self.db)
+    elif isinstance(self._path, basestring):
+      with _index_readers_lock:
+        if meta["indexdb"] in _pending_swaps:
+          raise RuntimeError("The indexes of '{0}' were just rebuilt and are waiting for the queries of the old "
+                             "ones to be done.".format(cls.__name__))
+      if os.path.exists(self._path + ".rebuild"):
+        shutil.rmtree(self._path + ".rebuild")
+      self.db = plyvel.DB(self._path + ".rebuild", create_if_missing=True, **self._options)
+    else:
+      self.db = meta["indexdb"]
+      _clear(self.db)
+
+  def swap(self):
+    """Makes the target the index db of the class. Must be called with the
+    write lock held.
+
+    Returns:
+      False if queries or snapshots are still reading the old index db. It
+      cannot be moved while open, so the swap is done by finish_swap when
+      the last of them is done, and until then both dbs are written.
+    """
+    meta = self._meta
+    self.db.put(_VERSION_KEY, _INDEX_VERSION)
+    if meta.get("shared") is not None:
+      self._old = meta["indexdb"]
+      meta["shared"].put(meta["prefix"] + _INDEX_NAME_KEY, self._name)
+      meta["indexdb"] = self.db
+    elif isinstance(self._path, basestring):
+      with _index_readers_lock:
+        if meta["indexdb"] in _index_readers:
+          _pending_swaps[meta["indexdb"]] = self
+          return False
+        self._move()
+    return True
+
+  def finish_swap(self, force=False):
+    """Does a swap that was waiting for the readers of the old index db, if
+    there are none left or if force is True, and removes the old index."""
+    meta = self._meta
+    with meta["write_lock"]:
+      with _index_readers_lock:
+        old = meta.get("indexdb")
+        if _pending_swaps.get(old) is not self or (old in _index_readers and not force):
+          return
+        del _pending_swaps[old]
+        self._move()
+        del meta["rebuild"]
+    self.cleanup()
+
+  def _move(self):
+    # Nothing must read the old index db, as the path of its files changes.
+    meta = self._meta
+    self.db.close()
+    _release_db(self._path)
+    os.rename(self._path, self._path + ".old")
+    os.rename(self._path + ".rebuild", self._path)
+    meta["indexdb"] = _open_db(self._path, self._options)
+
+  def cleanup(self):
+    """Removes the old index once nothing uses it anymore."""
+    if self._old is not None:
+      _clear(self._old)
+    elif isinstance(self._path, basestring):
+      shutil.rmtree(self._path + ".old", ignore_errors=True)
+
+  def discard(self):
+    if self._meta.get("shared") is not None:
+      _clear(self.db)
+    elif isinstance(self._path, basestring):
+      self.db.close()
+      shutil.rmtree(self._path + ".rebuild")
+
+
+class _Rebuild(object):
+  """An index rebuild in progress.
+
+  The rebuild writes the entries of the documents in a snapshot. The
+  documents written after the snapshot have all their entries written to
+  the target right away, and are skipped when the entries from the snapshot
+  are written.
+  """
+  def __init__(self, target):
+    self.target = target
+    self.written = set()
+
+  def dual_write(self, changes):
+    """Writes the entries of documents that were just written.
+
+    Args:
+      changes: A list of (key, old indexes, new indexes, covering values)
+          with all the indexed fields. The old entries are removed in case
+          they were already written from the snapshot.
+    """
+    wb = self.target.db.write_batch()
+    for key, old, new, covered in changes:
+      self.written.add(key)
+      _figure_out_index_writes(wb, _index_changes(key, old, {}))
+      _figure_out_index_writes(wb, _index_changes(key, {}, new), {key: covered})
+    wb.write()
+
+  def write_entries(self, entries):
+    """Writes (entry, value) pairs from the snapshot."""
+    wb = self.target.db.write_batch()
+    for entry, value in entries:
+      if self.written and _entry_key(entry, entry[:entry.index(_SEP)]) in self.written:
+        continue
+      wb.put(entry, value)
+    wb.write()
+
+
+def _document_entries(cls, key, data):
+  """Yields (entry, value) for all the index entries of a document."""
+  covered = _covering_values(cls, data) or {}
+  for add, field, v, _ in _index_changes(key, {}, _build_indexes(cls, data)):
+    if v is not None:
+      yield _index_entry(field, v, key), covered.get(field, "")
+
+
+def _snapshot_entries(cls, view, progress, batch_size):
+  start = time.time()
+  count = 0
+  with view.data.iterator() as it:
+    for key, value in it:
+      for item in _document_entries(cls, key, json.loads(value)):
+        yield item
+
+      count += 1
+      if progress is not None and count % batch_size == 0:
+        progress("read", count, time.time() - start)
+
+  if progress is not None:
+    progress("read", count, time.time() - start)
+
+
+def rebuild_indexes(cls, batch_size=10000, memory_limit=64 * 1024 * 1024, tmpdir=None, progress=None):
+  """Rebuilds the index db of a class from its documents.
+
+  The documents are read from a snapshot, and their index entries are sorted
+  with external_sort before they are written, which is the fastest way to
+  load them into LevelDB. The new index only replaces the current one at the
+  end, and the documents saved or deleted meanwhile through this process
+  are indexed in both. If queries are still reading an index db opened from
+  a path then, it is replaced once the last of them is done.
+
+  Args:
+    cls: The document class, with the connections open.
+    batch_size: The number of entries per write, and of documents between
+        progress reports.
+    memory_limit: About how many bytes of entries to sort in memory before
+        spilling them to temporary files.
+    tmpdir: Where to put those files. Defaults to the system's.
+    progress: If not None, called with (stage, count, seconds elapsed)
+        as the rebuild goes. The stage is "read" with the number of
+        documents read, then "write" with the number of entries written.
+
+  Returns:
+    The number of documents indexed.
+
+  Raises:
+    ValueError if other classes opened in this process use the same index
+    db, as their entries would be lost.
+  """
+  _ensure_indexdb_exists(cls)
+  _ensure_sole_index_user(cls, "rebuild")
+  meta = cls._leveldb_meta
+
+  with meta["write_lock"]:
+    rebuild = meta["rebuild"] = _Rebuild(_IndexTarget(cls))
+    # Taken with the lock held so every write after it goes to the rebuild.
+    view = _View(cls)
+
+  read = [0]
+  def counting(stage, count, elapsed):
+    read[0] = count
+    if progress is not None:
+      progress(stage, count, elapsed)
+
+  try:
+    try:
+      # This reads all the documents before it returns.
+      entries = external_sort(_snapshot_entries(cls, view, counting, batch_size), memory_limit, tmpdir,
+                              sizeof=lambda item: len(item[0]) + len(item[1]))
+    finally:
+      view.close()
+
+    start = time.time()
+    batch = []
+    count = 0
+    for entry in entries:
+      batch.append(entry)
+      if len(batch) == batch_size:
+        with meta["write_lock"]:
+          rebuild.write_entries(batch)
+        count += len(batch)
+        batch = []
+        if progress is not None:
+          progress("write", count, time.time() - start)
+
+    with meta["write_lock"]:
+      rebuild.write_entries(batch)
+      if progress is not None:
+        progress("write", count + len(batch), time.time() - start)
+      swapped = rebuild.target.swap()
+      if swapped:
+        del meta["rebuild"]
+  except:
+    with meta["write_lock"]:
+      if meta.get("rebuild") is rebuild:
+        del meta["rebuild"]
+        rebuild.target.discard()
+    raise
+
+  if swapped:
+    rebuild.target.cleanup()
+  return read[0]
+
+
+class IndexReport(object):
+  """The result of verify_indexes.
+
+  The problems are counted per field, as {field: number of entries}.
+
+  Attributes:
+    documents: The number of documents checked.
+    entries: The number of entries in the index.
+    missing: Entries that should be in the index but are not.
+    stale: Entries for documents that do not exist, do not have the value
+        anymore, or for fields that are not indexed.
+    duplicate: Extra entries for a document on a field that is not a list,
+        which should have only one, besides the entry of its value.
+    outdated: Entries of covering indexes with the wrong covered values.
+    repaired: The number of entries written or removed to fix the above.
+    elapsed: The number of seconds it took.
+  """
+  KINDS = ("missing", "stale", "duplicate", "outdated")
+
+  def __init__(self):
+    self.documents = 0
+    self.entries = 0
+    self.missing = {}
+    self.stale = {}
+    self.duplicate = {}
+    self.outdated = {}
+    self.repaired = 0
+    self.elapsed = 0.0
+
+  @property
+  def ok(self):
+    """True if no problems were found."""
+    return not (self.missing or self.stale or self.duplicate or self.outdated)
+
+  @property
+  def rate(self):
+    """The number of documents checked per second."""
+    return self.documents / self.elapsed if self.elapsed > 0 else 0.0
+
+  def count(self, kind, field):
+    counts = getattr(self, kind)
+    counts[field] = counts.get(field, 0) + 1
+
+
+def _unique_sorted(items):
+  # A list property can have the same value twice.
+  last = None
+  for item in items:
+    if item[0] != last:
+      last = item[0]
+      yield item
+
+
+def _merge_entries(expected, actual):
+  """Merge-joins two sorted iterators of (entry, value) and yields (kind,
+  entry) for every difference, with kind as in IndexReport."""
+  e = next(expected, None)
+  a = next(actual, None)
+  while e is not None or a is not None:
+    if a is None or (e is not None and e[0] < a[0]):
+      yield "missing", e[0]
+      e = next(expected, None)
+    elif e is None or a[0] < e[0]:
+      yield "stale", a[0]
+      a = next(actual, None)
+    else:
+      if e[1] != a[1] and (not e[1] or not a[1] or json.loads(e[1]) != json.loads(a[1])):
+        yield "outdated", e[0]
+      e = next(expected, None)
+      a = next(actual, None)
+
+
+def _repair(cls, entries):
+  """Fixes entries found by verify_indexes.
+
+  The documents are read again with the write lock held, so an entry is
+  written or removed according to what is in the db now, not in the
+  snapshot that was verified.
+  """
+  db = _data_db(cls)
+  with _writing(cls):
+    wanted = {}
+    wb = _index_db(cls).write_batch()
+    for entry in entries:
+      key = _entry_key(entry, entry[:entry.index(_SEP)])
+      if key not in wanted:
+        value = db.get(key)
+        wanted[key] = {} if value is None else dict(_document_entries(cls, key, json.loads(value)))
+
+      if entry in wanted[key]:
+        wb.put(entry, wanted[key][entry])
+      else:
+        wb.delete(entry)
+    wb.write()
+
+  return len(entries)
+
+
+def verify_indexes(cls, repair=False, batch_size=10000, memory_limit=64 * 1024 * 1024, tmpdir=None,
+                   progress=None):
+  """Checks the index db of a class against its documents.
+
+  The index entries that the documents should have are sorted with
+  external_sort and merge-joined with a scan of the index, both from the
+  same snapshot, so memory use is bounded by memory_limit.
+
+  Args:
+    cls: The document class, with the connections open.
+    repair: If True, fix the problems found in batches.
+    batch_size: The number of fixes per write, and of documents or entries
+        between progress reports.
+    memory_limit: About how many bytes of entries to sort in memory before
+        spilling them to temporary files.
+    tmpdir: Where to put those files. Defaults to the system's.
+    progress: If not None, called with (stage, count, seconds elapsed)
+        as it goes. The stage is "read" with the number of documents read,
+        then "check" with the number of index entries checked.
+
+  Returns:
+    An IndexReport.
+
+  Raises:
+    ValueError if repair is True and other classes opened in this process
+    use the same index db, as their entries would be removed.
+  """
+  _ensure_indexdb_exists(cls)
+  if repair:
+    _ensure_sole_index_user(cls, "repair")
+  report = IndexReport()
+  start = time.time()
+
+  def counting(stage, count, elapsed):
+    report.documents = count
+    if progress is not None:
+      progress(stage, count, elapsed)
+
+  def index_entries(it):
+    for entry, value in it:
+      if entry.startswith(_SEP):
+        continue # The version marker.
+      report.entries += 1
+      if progress is not None and report.entries % batch_size == 0:
+        progress("check", report.entries, time.time() - start)
+      yield entry, value
+
+  view = _View(cls)
+  try:
+    expected = external_sort(_snapshot_entries(cls, view, counting, batch_size), memory_limit, tmpdir,
+                             sizeof=lambda item: len(item[0]) + len(item[1]))
+
+    fixes = []
+    with view.index.iterator() as it:
+      for kind, entry in _merge_entries(_unique_sorted(expected), index_entries(it)):
+        field = entry[:entry.index(_SEP)]
+        if kind == "stale":
+          key = _entry_key(entry, field)
+          value = view.data.get(key)
+          if value is not None and field in cls._indexes:
+            current = json.loads(value).get(field)
+            # Without the entry of its current value, the document was
+            # indexed with an old one instead.
+            if current is not None and not isinstance(current, (list, tuple)):
+              if view.index.get(_index_entry(field, current, key)) is not None:
+                kind = "duplicate"
+
+        report.count(kind, field)
+        if repair:
+          fixes.append(entry)
+          if len(fixes) == batch_size:
+            report.repaired += _repair(cls, fixes)
+            fixes = []
+
+    if fixes:
+      report.repaired += _repair(cls, fixes)
+  finally:
+    view.close()
+
+  if progress is not None:
+    progress("check", report.entries, time.time() - start)
+
+  report.elapsed = time.time() - start
+  return report
+
+
+def _check_index_version(cls):
+  indexdb = _index_db(cls)
+  version = indexdb.get(_VERSION_KEY)
+  if version == _INDEX_VERSION:
+    return
+
+  if version is None and _is_empty(indexdb):
+    indexdb.put(_VERSION_KEY, _INDEX_VERSION)
+    return
+
+  if cls._leveldb_options.get("rebuild_indexes"):
+    rebuild_indexes(cls)
+    return
+
+  raise RuntimeError("The index db for class '{0}' uses an old layout. Set \"rebuild_indexes\" "
+                     "in _leveldb_options to rebuild it.".format(cls.__name__))
+
+
+def save(self, key, data, **args):
+  key = key.encode("ascii")
+  cls = self.__class__
+  with _writing(cls) as rebuild:
+    old_indexes = self._leveldb_old_indexes
+    batch = _Batch(cls)
+    covered = _covering_values(cls, data)
+    if batch.index is not None:
+      # BUG: (?) Is it possible to fail something so badly that the _old_indexes
+      # never gets flushed? Hopefully not.
+      _figure_out_index_writes(batch.index, _document_index_changes(self, key, data), {key: covered})
+
+    batch.data.put(key, json.dumps(data))
+    batch.write()
+    if rebuild is not None:
+      rebuild.dual_write([(key, old_indexes, _build_indexes(cls, data), covered)])
+
+
+def save_many(cls, items, **args):
+  with _writing(cls) as rebuild:
+    batch = _Batch(cls)
+    changes = []
+    values = {}
+    written = []
+    for doc, key, data in items:
+      key = key.encode("ascii")
+      covered = values[key] = _covering_values(cls, data)
+      if rebuild is not None:
+        written.append((key, doc._leveldb_old_indexes, _build_indexes(cls, data), covered))
+      if batch.index is not None:
+        changes.extend(_document_index_changes(doc, key, data))
+
+      batch.data.put(key, json.dumps(data))
+
+    if batch.index is not None:
+      _figure_out_index_writes(batch.index, changes, values)
+
+    batch.write()
+    if rebuild is not None:
+      rebuild.dual_write(written)
+
+
+def write_many(cls, items):
+  """Saves JSON documents by key without their Document instances.
+
+  The index changes are found by reading the stored documents, instead of
+  from what the instances remember of when they were loaded. This is for
+  writers that only have the JSON, like ``kvkit.server``.
+
+  Args:
+    cls: The document class.
+    items: A list of (key, json document).
+  """
+  db = _data_db(cls)
+  with _writing(cls) as rebuild:
+    batch = _Batch(cls)
+    changes = []
+    values = {}
+    written = []
+    # The documents written earlier in the batch, which are not in the db yet.
+    pending = {}
+    for key, data in items:
+      key = key.encode("ascii")
+      covered = values[key] = _covering_values(cls, data)
+      if batch.index is not None:
+        stored = pending.get(key)
+        if stored is None:
+          value = db.get(key)
+          stored = None if value is None else json.loads(value)
+        pending[key] = data
+
+        old_indexes = {} if stored is None else _build_indexes(cls, stored)
+        new_indexes = _build_indexes(cls, data)
+        changes.append(_index_changes(key, old_indexes, new_indexes))
+        # Values that did not change keep their entries, with the old covered
+        # values.
+        if stored is not None and covered != _covering_values(cls, stored):
+          refresh = dict((name, new_indexes[name]) for name in cls._leveldb_meta["covering"])
+          changes.append(_index_changes(key, {}, refresh))
+        if rebuild is not None:
+          written.append((key, old_indexes, new_indexes, covered))
+
+      batch.data.put(key, json.dumps(data))
+
+    if batch.index is not None:
+      _figure_out_index_writes(batch.index, chain.from_iterable(changes), values)
+
+    batch.write()
+    if rebuild is not None:
+      rebuild.dual_write(written)
 
-def delete(cls, key, doc=None, **args):
 
+def delete(cls, key, doc=None, **args):
   # There is an inherit danger to use delete_key without knowing about the
-  # indexes. This is why in the leveldb delete, we always will load it first.
+  # indexes. This is why in the leveldb delete, we always will read the stored
+  # document first to find out its indexes.
   if doc is None:
-    try:
-      doc = cls.get(key)
-    except NotFoundError:
-      return
+    delete_many(cls, [key])
+    return
+
+  key = str(key)
+  with _writing(cls) as rebuild:
+    old_indexes = doc._leveldb_old_indexes
+    batch = _Batch(cls)
+    if batch.index is not None:
+      _figure_out_index_writes(batch.index, _index_changes(key, old_indexes, {}))
+      doc._leveldb_old_indexes = {}
+
+    batch.data.delete(key)
+    batch.write()
+    if rebuild is not None:
+      rebuild.dual_write([(key, old_indexes, {}, None)])
+
+
+def delete_many(cls, keys, **args):
+  db = _data_db(cls)
+
+  with _writing(cls) as rebuild:
+    batch = _Batch(cls)
+    count = 0
+    changes = []
+    written = []
+    for key in sorted(set(str(key) for key in keys)):
+      value = db.get(key)
+      if value is None:
+        continue
+
+      # We only need the raw values of the indexed fields, so there is no need
+      # to construct the documents.
+      if batch.index is not None:
+        old_indexes = _build_indexes(cls, json.loads(value))
+        changes.extend(_index_changes(key, old_indexes, {}))
+        if rebuild is not None:
+          written.append((key, old_indexes, {}, None))
+
+      batch.data.delete(key)
+      count += 1
+
+    if batch.index is not None:
+      _figure_out_index_writes(batch.index, changes)
 
-  index_writebatch = None
-  if doc._leveldb_meta.get("indexdb"):
-    index_writebatch = _figure_out_index_writes(doc._leveldb_meta["indexdb"],
-                                                key,
-                                                doc._leveldb_old_indexes,
-                                                {})
-    doc._leveldb_old_indexes = {}
+    batch.write()
+    if rebuild is not None:
+      rebuild.dual_write(written)
 
-  doc._leveldb_meta["db"].delete(key)
-  if index_writebatch:
-    index_writebatch.write()
+  return count
 
 
 def post_deserialize(self, data):
-  if self._leveldb_meta.get("indexdb"):
+  if _index_db(self.__class__):
     self._leveldb_old_indexes = _build_indexes(self.__class__, data)
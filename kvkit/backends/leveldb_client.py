@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+"""This backend sends everything to a ``kvkit.server`` over a Unix socket.
+
+The server owns the LevelDB dbs, so any number of processes, like the
+workers of a web server, can use the same documents::
+
+    class BlogPost(Document):
+      _backend = leveldb_client
+      _leveldb_client_options = {"socket": "/var/run/blog.sock"}
+
+The server must serve a class with the same name, or with the name given
+as ``"name"``. It indexes the documents, so the properties of the two
+classes should match.
+
+The connections to a server are pooled, and a connection is opened the
+first time a thread needs one and none is free. At most ``"pool_size"``
+(default 8) idle connections are kept. ``get_many``, ``save_many`` and
+``delete_many`` send their keys in requests of ``"batch_size"`` (default
+1000) documents, each one before waiting for the answer to the previous
+one. Each request is written atomically by the server, but a call with
+more documents than that is not. Query results are streamed, so iterating
+over the results of a query without a ``limit`` holds a connection until
+it is done. Waiting for the server to answer, or to read a request, fails
+with a DatabaseError after ``"timeout"`` (default 60) seconds. Set it to
+None to wait forever.
+
+Snapshots, rebuilding and verifying the indexes are not available through
+the server. Do them in the server process.
+"""
+
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+import os
+import socket
+import sys
+import threading
+
+from ..exceptions import DatabaseError, NotFoundError, NotIndexed
+from ..pagination import Page
+from ..server import ERROR, MORE, read_frame, write_frame
+
+# The fields of projection queries are sent to the server, which only sends
+# those back.
+supports_projection = True
+
+# The errors of the server raised as themselves. Any other is raised as a
+# DatabaseError.
+_ERRORS = {
+  "NotFoundError": NotFoundError,
+  "NotIndexed": NotIndexed,
+  "ValueError": ValueError,
+  "NotImplementedError": NotImplementedError,
+}
+
+
+class _Connection(object):
+  """A connection to the server, used by one thread at a time."""
+  def __init__(self, path, timeout):
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.settimeout(timeout)
+    try:
+      self._sock.connect(path)
+    except socket.error as e:
+      self._sock.close()
+      raise DatabaseError("Cannot connect to the kvkit server at '{0}': {1}".format(path, e))
+
+    self._rfile = self._sock.makefile("rb", 64 * 1024)
+    self._wfile = self._sock.makefile("wb", 64 * 1024)
+    self._next_id = 0
+    # The ids of the requests sent and not fully answered, in order.
+    self._pending = []
+    # Set when the connection cannot be trusted to be in sync anymore.
+    self.broken = False
+
+  @property
+  def idle(self):
+    return not self._pending and not self.broken
+
+  def send(self, op, name, args):
+    """Sends a request. It is buffered until flush or receive."""
+    self._next_id += 1
+    self._pending.append(self._next_id)
+    try:
+      write_frame(self._wfile, (self._next_id, op, name, args))
+    except (socket.error, ValueError) as e:
+      self.broken = True
+      raise DatabaseError("Cannot send a request to the kvkit server: {0}".format(e))
+
+  def receive(self):
+    """Reads the next response to the oldest request not fully answered.
+
+    Returns:
+      (status, value), where status is MORE for a chunk of query results.
+
+    Raises:
+      The error of the server, if it answered with one.
+    """
+    try:
+      self._wfile.flush()
+      response = read_frame(self._rfile)
+    except (IOError, ValueError, EOFError) as e:
+      self.broken = True
+      raise DatabaseError("Cannot read a response from the kvkit server: {0}".format(e))
+
+    if response is None:
+      self.broken = True
+      raise DatabaseError("The kvkit server closed the connection.")
+
+    request_id, status, value = response
+    if request_id != self._pending[0]:
+      self.broken = True
+      raise DatabaseError("Got a response to request {0} instead of {1}.".format(request_id, self._pending[0]))
+
+    if status != MORE:
+      self._pending.pop(0)
+
+    if status == ERROR:
+      name, message = value
+      if name in _ERRORS:
+        raise _ERRORS[name](message)
+      raise DatabaseError(u"{0}: {1}".format(name, message))
+    return status, value
+
+  def close(self):
+    self.broken = True
+    for f in (self._rfile, self._wfile, self._sock):
+      try:
+        f.close()
+      except socket.error:
+        pass
+
+
+class _Pool(object):
+  """The idle connections to one server in this process."""
+  def __init__(self, path, size, timeout):
+    self.path = path
+    self.size = size
+    self.timeout = timeout
+    self._idle = []
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def connection(self):
+    with self._lock:
+      conn = self._idle.pop() if self._idle else None
+    if conn is None:
+      conn = _Connection(self.path, self.timeout)
+
+    try:
+      yield conn
+    finally:
+      # A connection left with responses to read, like one of a query that
+      # was not iterated to the end, is closed.
+      self._put_back(conn)
+
+  def _put_back(self, conn):
+    if conn.idle:
+      with self._lock:
+        if len(self._idle) < self.size:
+          self._idle.append(conn)
+          return
+    conn.close()
+
+  def close(self):
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for conn in idle:
+      conn.close()
+
+
+# The pools by socket path, and the process they belong to. A forked child
+# starts over, as its parent's connections would mix the responses of both.
+_pools = {}
+_pools_pid = os.getpid()
+_pools_lock = threading.Lock()
+
+
+def _pool(cls):
+  global _pools, _pools_pid
+  options = cls._leveldb_client_options
+  path = os.path.abspath(options["socket"])
+  with _pools_lock:
+    if _pools_pid != os.getpid():
+      # Closing the sockets here does not close them in the parent.
+      for pool in _pools.itervalues():
+        pool.close()
+      _pools = {}
+      _pools_pid = os.getpid()
+
+    pool = _pools.get(path)
+    if pool is None:
+      pool = _pools[path] = _Pool(path, options.get("pool_size", 8), options.get("timeout", 60))
+    return pool
+
+
+def close_all():
+  """Closes the idle connections of this process."""
+  with _pools_lock:
+    pools = _pools.values() if _pools_pid == os.getpid() else []
+  for pool in pools:
+    pool.close()
+
+
+def _name(cls):
+  return cls._leveldb_client_options.get("name", cls.__name__)
+
+
+def _batch_size(cls):
+  return cls._leveldb_client_options.get("batch_size", 1000)
+
+
+def _call(cls, op, *args):
+  """Sends one request and returns the value of its response."""
+  with _pool(cls).connection() as conn:
+    conn.send(op, _name(cls), args)
+    return conn.receive()[1]
+
+
+def _call_many(cls, op, batches, *args):
+  """Sends a request for every batch, each one before reading the response
+  to the one before it, so the server works on the next batch meanwhile.
+
+  No more requests are sent ahead than that. The server answers in order,
+  so with all of them sent first it would stop reading once the responses
+  it writes fill the socket, and this would never finish sending. As
+  either the requests (save_many) or the responses (get_many) are small,
+  one of each fits in the socket buffers.
+
+  Returns:
+    The list of the values of the responses.
+  """
+  name = _name(cls)
+  with _pool(cls).connection() as conn:
+    results = []
+    error = None
+    for i in xrange(len(batches) + 1):
+      if i < len(batches):
+        conn.send(op, name, (batches[i], ) + args)
+      if i == 0:
+        continue
+
+      # All the responses are read, even after an error, so the connection
+      # can be used again.
+      try:
+        results.append(conn.receive()[1])
+      except Exception:
+        if conn.broken:
+          raise
+        error = error or sys.exc_info()
+
+    if error is not None:
+      raise error[0], error[1], error[2]
+    return results
+
+
+def _batches(cls, items):
+  size = _batch_size(cls)
+  return [items[i:i + size] for i in xrange(0, len(items), size)] or [[]]
+
+
+def _stream(cls, op, args, end):
+  """Yields the results of a query as they arrive. The continuation of the
+  page is put in end[0] at the end."""
+  with _pool(cls).connection() as conn:
+    conn.send(op, _name(cls), args)
+    while True:
+      status, value = conn.receive()
+      if status != MORE:
+        end[0] = value
+        return
+
+      for item in value:
+        yield item
+
+
+def _query(cls, op, args, kwargs, transform=None):
+  end = [None]
+  results = _stream(cls, op, args + (kwargs, ), end)
+  if transform is not None:
+    results = (transform(item) for item in results)
+
+  if kwargs.get("limit") is None:
+    return results
+
+  items = list(results)
+  return Page(items, end[0])
+
+
+def _document(item):
+  key, data = item
+  return key, data, None
+
+
+def init_class(cls):
+  pass
+
+
+def init_document(self, **args):
+  pass
+
+
+def clear_document(self, **args):
+  pass
+
+
+def post_deserialize(self, data):
+  pass
+
+
+def get(cls, key, **args):
+  return _call(cls, "get", key, args), None
+
+
+def get_many(cls, keys, **args):
+  keys = list(keys)
+  results = []
+  for values in _call_many(cls, "get_many", _batches(cls, keys), args):
+    results.extend(None if data is None else (data, None) for data in values)
+  return results
+
+
+def save(self, key, data, **args):
+  _call(self.__class__, "save_many", [(key, data)])
+
+
+def save_many(cls, items, **args):
+  items = [(key, data) for _, key, data in items]
+  if items:
+    _call_many(cls, "save_many", _batches(cls, items))
+
+
+def delete(cls, key, doc=None, **args):
+  _call(cls, "delete_many", [key])
+
+
+def delete_many(cls, keys, **args):
+  keys = list(keys)
+  if not keys:
+    return 0
+  return sum(_call_many(cls, "delete_many", _batches(cls, keys)))
+
+
+def index(cls, field, start_value, end_value=None, **args):
+  return _query(cls, "index", (field, start_value, end_value), args, _document)
+
+
+def index_keys_only(cls, field, start_value, end_value=None, **args):
+  return _query(cls, "index_keys_only", (field, start_value, end_value), args)
+
+
+def index_terms(cls, field, start_value, end_value=None, **args):
+  return _query(cls, "index_terms", (field, start_value, end_value), args)
+
+
+def list_all(cls, start_value=None, end_value=None, **args):
+  return _query(cls, "list_all", (start_value, end_value), args, _document)
+
+
+def list_all_keys(cls, start_value=None, end_value=None, **args):
+  return _query(cls, "list_all_keys", (start_value, end_value), args)
+
+
+def ping(cls):
+  """Checks that the server of a class is up.
+
+  Raises:
+    DatabaseError if it cannot be reached.
+  """
+  _call(cls, "ping")
@@ -17,10 +17,55 @@
 """This backend uses Riak to store data.
 
 For more information about Riak, checkout https://basho.com/riak/.
+
+``index`` and ``list_all`` fetch the objects of the keys found concurrently
+with a pool of threads for each class. At most ``"read_ahead"`` fetches are
+in flight for a query, so iterating slowly over a large result does not
+flood the cluster or pile up objects in memory. The results are in key
+order, unless ``ordered=False`` is passed to the query, in which case they
+come as the fetches complete. Keys whose object was deleted after the index
+query are skipped.
+
+The keys of index queries are streamed from Riak in pages of
+``"index_page_size"`` keys, so a query over millions of keys starts
+returning right away and uses the same memory as a small one. A document
+with several values of a ``ListProperty`` in the range of a query is only
+returned once if those values are next to each other in the index, and
+once for each of them otherwise. Pass ``limit`` to get a page, in which
+every document is only once, with a ``continuation`` to resume the query
+from. ``Document.index_terms`` asks Riak for the values with the keys
+(``return_terms``) and fetches no object at all.
+
+``Document.save_many`` and ``Batch`` store documents with the same threads,
+with at most ``"store_window"`` stores in flight. A document that cannot be
+stored does not stop the others: ``Document.save_many`` raises a BatchError
+with the failures once the rest are stored. ``store_counters`` counts what
+was stored and how long it took. Unless the bucket allows siblings, or
+``"return_body"`` says otherwise, stores do not ask Riak for the object
+back.
+
+The options go in ``_riak_options``::
+
+    class BlogPost(Document):
+      _backend = riak
+      _riak_options = {
+        "bucket": client.bucket("posts"),
+        "fetch_threads": 8, # default
+        "read_ahead": 16, # default, two per thread
+        "index_page_size": 1000, # default
+        "store_window": 16, # default, two per thread
+      }
 """
 
 from __future__ import absolute_import
 
+from collections import deque
+import os
+import Queue
+import sys
+import threading
+import time
+
 try:
   import riak
 except ImportError:
@@ -32,16 +77,27 @@ else:
 
 from ..document import Document
 from ..exceptions import ValidationError, NotFoundError, NotIndexed
-from ..properties import StringProperty, ListProperty, ReferenceProperty, NumberProperty
+from ..pagination import Page
+from ..session import current_session
+from ..properties import StringProperty, ListProperty, ReferenceProperty, NumberProperty, DateTimeProperty
 
 def clear_document(self, **args):
-  self._backend_object = self.__class__._riak_options["bucket"].new(self.key)
+  self._backend_obj = self.__class__._riak_options["bucket"].new(self.key)
 
 
 def delete(cls, key, doc=None, **args):
   cls._riak_options["bucket"].delete(key, **args)
 
 
+def delete_many(cls, keys, **args):
+  # Riak does not tell us if the key existed, so we count the deletes sent.
+  count = 0
+  for key in set(keys):
+    delete(cls, key, **args)
+    count += 1
+  return count
+
+
 def get(cls, key, **args):
   robj = cls._riak_options["bucket"].get(key, **args)
   if not robj.exists:
@@ -50,13 +106,216 @@ def get(cls, key, **args):
   return robj.data, robj
 
 
-def index(cls, field, start_value, end_value=None, **args):
-  for key in index_keys_only(cls, field, start_value, end_value, **args):
-    data, ro = get(cls, key)
-    yield key, data, ro
-
+def get_many(cls, keys, **args):
+  # multiget fetches concurrently with a thread pool but returns the objects
+  # in the order they complete.
+  robjs = {}
+  for robj in cls._riak_options["bucket"].multiget(list(set(keys)), **args):
+    if isinstance(robj, tuple):
+      # Failures are reported as (bucket, key, exception)
+      raise robj[-1]
+    robjs[robj.key] = robj
+
+  results = []
+  for key in keys:
+    robj = robjs.get(key)
+    if robj is None or not robj.exists:
+      results.append(None)
+    else:
+      results.append((robj.data, robj))
+
+  return results
+
+
+class _FetchPool(object):
+  """Worker threads that run fetches for the queries of a class."""
+  def __init__(self, size):
+    self.pid = os.getpid()
+    self._tasks = Queue.Queue()
+    for _ in xrange(size):
+      thread = threading.Thread(target=self._work)
+      thread.daemon = True
+      thread.start()
+
+  def _work(self):
+    while True:
+      f, arg, results, i = self._tasks.get()
+      try:
+        results.put((i, f(arg), None))
+      except Exception:
+        results.put((i, None, sys.exc_info()))
+
+  def submit(self, f, arg, results, i):
+    """Runs f(arg) in a worker, which puts (i, result, exc_info or None) on
+    the results queue."""
+    self._tasks.put((f, arg, results, i))
+
+
+_fetch_pools_lock = threading.Lock()
+
+
+def _fetch_pool(cls):
+  meta = cls._riak_meta
+  pool = meta.get("fetch_pool")
+  # The threads of the parent do not exist in a forked child.
+  if pool is None or pool.pid != os.getpid():
+    with _fetch_pools_lock:
+      pool = meta.get("fetch_pool")
+      if pool is None or pool.pid != os.getpid():
+        pool = meta["fetch_pool"] = _FetchPool(cls._riak_options.get("fetch_threads", 8))
+  return pool
+
+
+class _Window(object):
+  """Runs functions in a fetch pool and gives their results back, with
+  a bound on the number of them submitted and not given back."""
+  def __init__(self, pool, size):
+    self.size = size
+    self._pool = pool
+    self._results = Queue.Queue()
+    self._submitted = 0
+    self._in_flight = deque()
+    # Done out of order and waiting for the ones before them.
+    self._done = {}
+
+  def __len__(self):
+    return len(self._in_flight)
+
+  @property
+  def full(self):
+    return len(self._in_flight) >= self.size
+
+  def submit(self, f, arg):
+    """Runs f(arg) in the pool and returns the number it is known by."""
+    i = self._submitted
+    self._pool.submit(f, arg, self._results, i)
+    self._in_flight.append(i)
+    self._submitted += 1
+    return i
+
+  def next(self, ordered=True):
+    """Waits for a function to be done.
+
+    Returns:
+      (number, result, exc_info or None) of the oldest function submitted
+      if ordered, or of the next one done otherwise.
+    """
+    while not (ordered and self._in_flight[0] in self._done):
+      i, result, error = self._results.get()
+      if not ordered:
+        self._in_flight.remove(i)
+        return i, result, error
+      self._done[i] = (result, error)
+
+    i = self._in_flight.popleft()
+    result, error = self._done.pop(i)
+    return i, result, error
+
+
+def _fetch(cls, key):
+  return key, cls._riak_options["bucket"].get(key)
+
+
+def _fetch_each(cls, keys, ordered=True):
+  """Fetches the objects of keys with the fetch pool of a class.
+
+  Yields (key, json document, RiakObject) for the objects that exist, in
+  the order of the keys if ordered, or as they are fetched otherwise.
+  """
+  read_ahead = cls._riak_options.get("read_ahead", 2 * cls._riak_options.get("fetch_threads", 8))
+  window = _Window(_fetch_pool(cls), read_ahead)
+  fetch = lambda key: _fetch(cls, key)
+  keys = iter(keys)
+
+  while True:
+    while not window.full:
+      key = next(keys, None)
+      if key is None:
+        break
+      window.submit(fetch, key)
+
+    if not window:
+      return
+
+    _, result, error = window.next(ordered)
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+    key, robj = result
+    if robj.exists:
+      yield key, robj.data, robj
+
+
+def index(cls, field, start_value, end_value=None, ordered=True, **args):
+  keys = index_keys_only(cls, field, start_value, end_value, **args)
+  if isinstance(keys, Page):
+    return Page(_fetch_each(cls, keys, ordered), keys.continuation)
+
+  return _fetch_each(cls, keys, ordered)
+
+
+def _unique_adjacent(keys):
+  # A document matches a range query once for every value of a ListProperty
+  # in the range. Riak sends those in a row when the values are next to each
+  # other, so only the last key is kept to keep memory flat.
+  last = None
+  for key in keys:
+    if key != last:
+      last = key
+      yield key
+
+
+def _stream_keys(cls, field, start_value, end_value, max_results, continuation, end, args, return_terms=False):
+  """Yields the keys of one page of an index query as Riak sends them, or
+  (value, key) if return_terms is True. The continuation of the page is put
+  in end[0] at the end."""
+  bucket = cls._riak_options["bucket"]
+  if not hasattr(bucket, "stream_index"):
+    # riak-python-client before 2.0 cannot stream.
+    page = bucket.get_index(field, start_value, end_value, return_terms=return_terms, max_results=max_results,
+                            continuation=continuation, **args)
+    for key in page:
+      yield key
+    end[0] = page.continuation
+    return
 
-def index_keys_only(cls, field, start_value, end_value=None, **args):
+  page = bucket.stream_index(field, start_value, end_value, return_terms=return_terms, max_results=max_results,
+                             continuation=continuation, **args)
+  chunks = iter(page)
+  try:
+    for chunk in chunks:
+      # The results arrive in lists, one per message of the stream.
+      if isinstance(chunk, list):
+        for key in chunk:
+          yield key
+      else:
+        yield chunk
+  finally:
+    # The page gives its connection back when its iteration ends, which
+    # this makes happen right away if the results were not read to the end.
+    # Closing the page itself would give it back a second time, while
+    # another thread might be using it.
+    chunks.close()
+  end[0] = page.continuation
+
+
+def _stream_pages(cls, field, start_value, end_value, continuation, args, return_terms=False):
+  """Yields the keys of an index query page after page, so that neither
+  Riak nor this process has to hold all of them at once."""
+  page_size = cls._riak_options.get("index_page_size", 1000)
+  while True:
+    end = [None]
+    for key in _stream_keys(cls, field, start_value, end_value, page_size, continuation, end, args, return_terms):
+      yield key
+
+    continuation = end[0]
+    if continuation is None:
+      return
+
+
+def _riak_index_query(cls, field, start_value, end_value):
+  """Maps a field and the values of a query to the Riak index they are
+  stored in."""
   if field not in ("$bucket", "$key"):
     if field not in cls._indexes:
       raise NotIndexed("Field '%field' not indexed.")
@@ -67,16 +326,57 @@ def index_keys_only(cls, field, start_value, end_value=None, **args):
       elif isinstance(cls._meta[field], NumberProperty):
         if cls._meta[field].integer:
           field += "_int"
+          # The values of queries come as floats, which Riak refuses for
+          # integer indexes.
+          start_value = int(start_value)
+          if end_value is not None:
+            end_value = int(end_value)
         else:
           field += "_bin"
+      elif isinstance(cls._meta[field], DateTimeProperty):
+        field += "_int"
+        start_value = int(start_value)
+        if end_value is not None:
+          end_value = int(end_value)
+
+  return field, start_value, end_value
+
+
+def index_keys_only(cls, field, start_value, end_value=None, limit=None, reverse=False, continuation=None, **args):
+  if reverse:
+    raise NotImplementedError("Riak cannot query secondary indexes in reverse.")
+
+  field, start_value, end_value = _riak_index_query(cls, field, start_value, end_value)
+
+  # Riak does the paging for us with max_results and its own continuation.
+  if limit is not None:
+    end = [None]
+    keys = []
+    # A page is in memory anyway, so a document is only in it once.
+    seen = set()
+    for key in _stream_keys(cls, field, start_value, end_value, limit, continuation, end, args):
+      if key not in seen:
+        seen.add(key)
+        keys.append(key)
+    return Page(keys, end[0])
+
+  return _unique_adjacent(_stream_pages(cls, field, start_value, end_value, continuation, args))
+
+
+def index_terms(cls, field, start_value, end_value=None, limit=None, reverse=False, continuation=None, **args):
+  """Queries an index with return_terms, so the values come with the keys
+  and no object is fetched."""
+  if reverse:
+    raise NotImplementedError("Riak cannot query secondary indexes in reverse.")
+
+  field, start_value, end_value = _riak_index_query(cls, field, start_value, end_value)
+
+  if limit is not None:
+    end = [None]
+    terms = list(_stream_keys(cls, field, start_value, end_value, limit, continuation, end, args, True))
+    return Page(terms, end[0])
 
-  index_page = cls._riak_options["bucket"].get_index(field, start_value, end_value, return_terms=False, **args)
-  keys_iterated = set()
-  for key in index_page:
-    if key in keys_iterated:
-      continue
-    keys_iterated.add(key)
-    yield key
+  return _stream_pages(cls, field, start_value, end_value, continuation, args, True)
 
 
 def init_class(cls):
@@ -91,15 +391,15 @@ def init_class(cls):
   def add_link(self, obj, tag=None):
     if isinstance(obj, Document):
       # Assuming the foreign object's backend is riak.
-      obj = obj._backend_object
-    self._backend_object.add_link(obj, tag)
+      obj = obj._backend_obj
+    self._backend_obj.add_link(obj, tag)
     return self
 
   def get_links(self):
-    return self._backend_object.links
+    return self._backend_obj.links
 
   def set_links(self, value):
-    self._backend_object.links = value
+    self._backend_obj.links = value
 
   cls.add_link = add_link
   cls.links = property(get_links, set_links)
@@ -109,39 +409,216 @@ def init_document(self, **args):
   pass
 
 
+def _all_keys_query(start_value, end_value):
+  # $bucket matches every key whatever its value, so ranges use $key.
+  if end_value is None:
+    return "$bucket", "_" if start_value is None else start_value, None
+  return "$key", "" if start_value is None else start_value, end_value
+
+
 def list_all_keys(cls, start_value=None, end_value=None, **args):
-  if start_value is None:
-    start_value = "_"
-  return index_keys_only(cls, "$bucket", start_value, end_value, **args)
+  field, start_value, end_value = _all_keys_query(start_value, end_value)
+  return index_keys_only(cls, field, start_value, end_value, **args)
 
 
 def list_all(cls, start_value=None, end_value=None, **args):
-  if start_value is None:
-    start_value = "_"
-  return index(cls, "$bucket", start_value, end_value, **args)
-
+  """Lists the objects of a class. Takes ``ordered`` like ``index``."""
+  field, start_value, end_value = _all_keys_query(start_value, end_value)
+  return index(cls, field, start_value, end_value, **args)
 
-def save(self, key, data, **args):
-  # See https://github.com/basho/riak-python-client/pull/287
-  self._backend_object.key = key.encode("ascii")
-  self._backend_object.data = data
 
+def _riak_indexes(cls, data):
   indexes = set()
-  for name in self.__class__._indexes:
-    if isinstance(self._meta[name], (StringProperty, ReferenceProperty)):
+  for name in cls._indexes:
+    if isinstance(cls._meta[name], (StringProperty, ReferenceProperty)):
       indexes.add((name + "_bin", data[name]))
-    elif isinstance(self._meta[name], ListProperty):
+    elif isinstance(cls._meta[name], ListProperty):
       field = name + "_bin"
       for value in data[name]:
         indexes.add((field, value))
-    elif isinstance(self._meta[name], NumberProperty):
-      if self._meta[name].integer:
+    elif isinstance(cls._meta[name], NumberProperty):
+      if cls._meta[name].integer:
         indexes.add((name + "_int", data[name]))
       else:
         indexes.add((name + "_bin", str(data[name])))
+    elif isinstance(cls._meta[name], DateTimeProperty):
+      if data[name] is not None:
+        indexes.add((name + "_int", int(data[name])))
+  return list(indexes)
+
+
+def _store_args(cls, args):
+  """Adds return_body=False to the arguments of a store when the object
+  Riak sends back is not needed.
+
+  That object is read by Riak after the write, only to give the document
+  the new vclock of its RiakObject. Without siblings, a later store does
+  not need a vclock that is up to date, so this is skipped unless the
+  bucket allows siblings. ``"return_body"`` in the options overrides it.
+  """
+  if "return_body" in args:
+    return args
+
+  meta = cls._riak_meta
+  return_body = cls._riak_options.get("return_body", meta.get("return_body"))
+  if return_body is None:
+    # Asks the bucket once. Unknown means siblings are possible.
+    return_body = meta["return_body"] = getattr(cls._riak_options["bucket"], "allow_mult", True) is not False
+
+  if return_body:
+    return args
+  return dict(args, return_body=False)
+
+
+def _store(item):
+  doc, key, data, args = item
+  # See https://github.com/basho/riak-python-client/pull/287
+  doc._backend_obj.key = key.encode("ascii")
+  doc._backend_obj.data = data
+  doc._backend_obj.indexes = _riak_indexes(doc.__class__, data)
+  doc._backend_obj.store(**args)
+
+
+def save(self, key, data, **args):
+  _store((self, key, data, _store_args(self.__class__, args)))
+
+
+_counters_lock = threading.Lock()
+
+
+def store_counters(cls):
+  """Counts the stores of a class sent by ``save_many`` and Batch.
+
+  Returns:
+    A dict with the number of documents "stored", the number that
+    "failed" and the "seconds" spent waiting for them.
+  """
+  with _counters_lock:
+    return dict(cls._riak_meta.get("store_counters", {"stored": 0, "failed": 0, "seconds": 0.0}))
+
+
+def _count_stores(cls, stored, failed, seconds):
+  with _counters_lock:
+    counters = cls._riak_meta.setdefault("store_counters", {"stored": 0, "failed": 0, "seconds": 0.0})
+    counters["stored"] += stored
+    counters["failed"] += failed
+    counters["seconds"] += seconds
+
+
+class Batch(object):
+  """Stores documents of a class concurrently.
+
+  A document given to ``save`` is validated and sent to a thread of the
+  fetch pool of the class right away. At most ``"store_window"`` (default
+  16, two per fetch thread) stores are in flight, and ``save`` waits for
+  one to finish when there are that many. A document that cannot be
+  stored does not stop the others. Leaving the ``with`` block waits for
+  all of them::
+
+      with riak.Batch(BlogPost) as batch:
+        for post in posts:
+          batch.save(post)
+
+      for post, error in batch.failed:
+        ...
+
+  Attributes:
+    stored: The number of documents stored.
+    failed: A list of (document, exception) for the documents that could
+        not be stored.
+    seconds: The time spent between the first save and the end of the
+        last store.
+  """
+  def __init__(self, cls, **args):
+    """Args:
+      cls: The class of the documents.
+      **args: The arguments of every store, like ``w``.
+    """
+    self.cls = cls
+    self.stored = 0
+    self.failed = []
+    self.seconds = 0.0
+    self._args = _store_args(cls, args)
+    options = cls._riak_options
+    self._window = _Window(_fetch_pool(cls), options.get("store_window", 2 * options.get("fetch_threads", 8)))
+    # The documents in flight by the number of their store.
+    self._docs = {}
+    self._started = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.flush()
+    return False
+
+  @property
+  def rate(self):
+    """The documents stored per second."""
+    return self.stored / self.seconds if self.seconds else 0.0
+
+  def save(self, doc):
+    """Validates a document and sends it to be stored.
+
+    Raises:
+      ValidationError
+    """
+    self._add(doc, doc.key, doc.serialize(only_validate_dirty=True), True)
+    return doc
+
+  def _add(self, doc, key, data, document=False):
+    """Sends a document already serialized to be stored. If document, it
+    is marked as saved like ``Document.save`` does once it is."""
+    if self._started is None:
+      self._started = time.time()
+
+    # The RiakObject of a document is not stored by two threads at once.
+    while self._window.full or any(other is doc for other, _ in self._docs.itervalues()):
+      self._collect()
+
+    i = self._window.submit(_store, (doc, key, data, self._args))
+    self._docs[i] = (doc, document)
+
+  def flush(self):
+    """Waits for the stores in flight."""
+    while self._window:
+      self._collect()
+
+    if self._started is not None:
+      seconds = time.time() - self._started
+      self.seconds += seconds
+      self._started = None
+      _count_stores(self.cls, 0, 0, seconds)
+
+  def _collect(self):
+    i, _, error = self._window.next(ordered=False)
+    doc, document = self._docs.pop(i)
+    if error is None:
+      self.stored += 1
+      _count_stores(self.cls, 1, 0, 0)
+      if document:
+        doc._mark_clean(saved=True)
+        session = current_session()
+        if session is not None:
+          session.add(doc)
+    else:
+      self.failed.append((doc, error[1]))
+      _count_stores(self.cls, 0, 1, 0)
+
+
+def save_many(cls, items, **args):
+  """Stores the documents concurrently, like Batch.
+
+  Returns:
+    A list of (document, exception) for the documents that could not be
+    stored.
+  """
+  batch = Batch(cls, **args)
+  for doc, key, data in items:
+    batch._add(doc, key, data)
+  batch.flush()
+  return batch.failed
 
-  self._backend_object.indexes = list(indexes)
-  self._backend_object.store(**args)
 
 def post_deserialize(self, data):
   pass
@@ -27,6 +27,7 @@ from __future__ import absolute_import
 import bisect
 
 from ..exceptions import NotFoundError
+from ..pagination import Page, decode_continuation, paginate
 
 # Yay globals are terrible.
 _db = {}
@@ -43,6 +44,22 @@ def cleardb():
 # test while you test.
 # But seriously. I kinda need that right now.
 
+def _paginate(items, position, limit=None, reverse=False, continuation=None, **args):
+  if reverse:
+    items = items[::-1]
+
+  if continuation is not None:
+    last = decode_continuation(continuation)
+    if reverse:
+      items = [item for item in items if position(item) < last]
+    else:
+      items = [item for item in items if position(item) > last]
+
+  if limit is None:
+    return items
+
+  return paginate(((position(item), item) for item in items), limit)
+
 def init_class(cls):
   pass
 
@@ -64,13 +81,32 @@ def index(cls, field, start_value, end_value=None, **args):
             kvs.append((k, v, None))
             break
 
-  return sorted(kvs)
+  return _paginate(sorted(kvs), lambda kv: kv[0], **args)
 
 def index_keys_only(cls, field, start_value, end_value=None, **args):
   kvs = index(cls, field, start_value, end_value, **args)
-  return [k for k, _, _ in kvs]
+  keys = [k for k, _, _ in kvs]
+  if isinstance(kvs, Page):
+    return Page(keys, kvs.continuation)
+  return keys
 
-def list_all_keys(cls, start_value=None, end_value=None, **args):
+def index_terms(cls, field, start_value, end_value=None, **args):
+  terms = []
+  for k, v in _db.iteritems():
+    if field in v and _buckets[k] == cls.__name__:
+      if not isinstance(v[field], (list, tuple)):
+        vfield = [v[field]]
+      else:
+        vfield = v[field]
+      # A value in a list twice is only indexed once.
+      for fv in set(vfield):
+        if fv >= start_value:
+          if (end_value is None and fv == start_value) or fv <= end_value:
+            terms.append((fv, k))
+
+  return _paginate(sorted(terms), lambda term: list(term), **args)
+
+def _all_keys(cls, start_value=None, end_value=None):
   keys = sorted([k for k in _db.keys() if _buckets[k] == cls.__name__])
   if start_value:
     try:
@@ -91,8 +127,12 @@ def list_all_keys(cls, start_value=None, end_value=None, **args):
   else:
     return keys
 
+def list_all_keys(cls, start_value=None, end_value=None, **args):
+  return _paginate(_all_keys(cls, start_value, end_value), lambda k: k, **args)
+
 def list_all(cls, start_value=None, end_value=None, **args):
-  return [(k, _db[k], None) for k in list_all_keys(cls, start_value, end_value, **args) if _buckets[k] == cls.__name__]
+  kvs = [(k, _db[k], None) for k in _all_keys(cls, start_value, end_value)]
+  return _paginate(kvs, lambda kv: kv[0], **args)
 
 def clear_document(self):
   pass
@@ -106,10 +146,23 @@ def get(cls, key, **args):
   except KeyError:
     raise NotFoundError
 
+def get_many(cls, keys, **args):
+  results = []
+  for key in keys:
+    if _buckets.get(key) == cls.__name__:
+      results.append((_db[key], None))
+    else:
+      results.append(None)
+  return results
+
 def save(self, key, data, **args):
   _db[key] = data
   _buckets[key] = self.__class__.__name__
 
+def save_many(cls, items, **args):
+  for doc, key, data in items:
+    save(doc, key, data, **args)
+
 def delete(cls, key, **args):
   try:
     del _db[key]
@@ -117,5 +170,13 @@ def delete(cls, key, **args):
   except KeyError:
     pass
 
+def delete_many(cls, keys, **args):
+  count = 0
+  for key in set(keys):
+    if _buckets.get(key) == cls.__name__:
+      delete(cls, key, **args)
+      count += 1
+  return count
+
 def post_deserialize(self, data):
   pass
\ No newline at end of file
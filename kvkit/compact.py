@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: kvkit.compact
+    :synopsis: Storage for documents with ``__compact__ = True``.
+
+.. moduleauthor:: Shuhao Wu <shuhao@shuhaowu.com>
+
+A compact document keeps its attributes in ``__slots__`` instead of a
+``__dict__``, and its data in a CompactData instead of a dictionary. The
+values of the defined properties are kept in a list, at the position of the
+property in the class. Attributes that are not defined properties go into a
+dictionary that is only created when the first one is set.
+"""
+
+from __future__ import absolute_import
+
+from itertools import izip
+
+# Marks a defined property that has no value, as opposed to a value of None.
+MISSING = object()
+
+# Shared by all the documents with nothing to load on demand or nothing
+# dirty, so they do not each need an empty set.
+EMPTY_SET = frozenset()
+
+# The attributes every document sets. key and _backend_obj are only used by
+# Document but are cheap enough to have on EmDocument too.
+DOCUMENT_SLOTS = ("key", "_backend_obj", "_data", "_props_to_load", "_dirty", "_loaded_values")
+
+
+class CompactData(object):
+  """A dictionary like object with a fixed layout for the defined properties.
+
+  Only the dictionary methods that kvkit uses are implemented. Use
+  ``data_class`` to make one for a document class.
+  """
+  __slots__ = ("_values", "_extra")
+
+  _names = ()
+  _positions = {}
+
+  def __init__(self):
+    self._values = [MISSING] * len(self._names)
+    self._extra = None
+
+  def __getitem__(self, name):
+    i = self._positions.get(name)
+    if i is None:
+      if self._extra is None:
+        raise KeyError(name)
+      return self._extra[name]
+
+    value = self._values[i]
+    if value is MISSING:
+      raise KeyError(name)
+    return value
+
+  def __setitem__(self, name, value):
+    i = self._positions.get(name)
+    if i is None:
+      if self._extra is None:
+        self._extra = {}
+      self._extra[name] = value
+    else:
+      self._values[i] = value
+
+  def __delitem__(self, name):
+    i = self._positions.get(name)
+    if i is None:
+      if self._extra is None:
+        raise KeyError(name)
+      del self._extra[name]
+    elif self._values[i] is MISSING:
+      raise KeyError(name)
+    else:
+      self._values[i] = MISSING
+
+  def __contains__(self, name):
+    i = self._positions.get(name)
+    if i is None:
+      return self._extra is not None and name in self._extra
+    return self._values[i] is not MISSING
+
+  def get(self, name, default=None):
+    i = self._positions.get(name)
+    if i is None:
+      return default if self._extra is None else self._extra.get(name, default)
+
+    value = self._values[i]
+    return default if value is MISSING else value
+
+  def __len__(self):
+    length = len(self._values) - self._values.count(MISSING)
+    return length + len(self._extra) if self._extra else length
+
+  def iteritems(self):
+    for name, value in izip(self._names, self._values):
+      if value is not MISSING:
+        yield name, value
+
+    if self._extra:
+      for item in self._extra.iteritems():
+        yield item
+
+  def iterkeys(self):
+    for name, _ in self.iteritems():
+      yield name
+
+  def itervalues(self):
+    for _, value in self.iteritems():
+      yield value
+
+  __iter__ = iterkeys
+
+  def items(self):
+    return list(self.iteritems())
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def values(self):
+    return list(self.itervalues())
+
+  def __eq__(self, other):
+    return dict(self.iteritems()) == dict(other.iteritems() if hasattr(other, "iteritems") else other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return repr(dict(self.iteritems()))
+
+
+def data_class(clsname, names):
+  """Makes the CompactData class for a document class.
+
+  Args:
+    clsname: The name of the document class.
+    names: The names of the defined properties, in the order of their
+        positions.
+
+  Returns:
+    A subclass of CompactData.
+  """
+  names = tuple(names)
+  return type(clsname + "Data", (CompactData, ), {
+    "__slots__": (),
+    "_names": names,
+    "_positions": dict((name, i) for i, name in enumerate(names)),
+  })
+
+
+def slots_for(parents, extra=()):
+  """Gets the __slots__ a compact class needs given its parents.
+
+  Slots the parents already have are left out, and so are __dict__ and
+  __weakref__ if a parent already has them. The __dict__ slot is still there
+  for attributes that are set rarely, but it is only created when the first
+  one is set.
+
+  Args:
+    parents: The base classes of the new class.
+    extra: Names of other attributes set on every instance, like the ones
+        from a backend (see ``document_slots`` in ``kvkit.backends.base``).
+  """
+  existing = set()
+  has_dict = has_weakref = False
+  for parent in parents:
+    for klass in parent.__mro__:
+      slots = klass.__dict__.get("__slots__", ())
+      existing.update((slots, ) if isinstance(slots, basestring) else slots)
+      if klass is not object and "__slots__" not in klass.__dict__:
+        has_dict = has_weakref = True
+
+  slots = []
+  for name in DOCUMENT_SLOTS + tuple(extra):
+    if name not in existing and name not in slots:
+      slots.append(name)
+  if not has_dict and "__dict__" not in existing:
+    slots.append("__dict__")
+  if not has_weakref and "__weakref__" not in existing:
+    slots.append("__weakref__")
+  return tuple(slots)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: kvkit.compiler
+    :synopsis: Generates serialize, deserialize and is_valid for each document
+               class.
+
+.. moduleauthor:: Shuhao Wu <shuhao@shuhaowu.com>
+
+The generic versions in EmDocument look up every property in ``_meta`` and
+call ``validate``, ``to_db`` and ``from_db`` through bound methods, even
+though most of these do nothing. Like namedtuple, this writes out the source
+of functions specialized for one class when the class is created, with one
+block per property. Conversions that are the identity and validations that
+always pass are left out, and the ones from the standard properties are
+inlined.
+"""
+
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+from .compact import EMPTY_SET, MISSING, CompactData
+from .properties.standard import (
+    BaseProperty,
+    BooleanProperty,
+    DictProperty,
+    ListProperty,
+    NumberProperty,
+    StringProperty
+)
+
+CompiledSerializers = namedtuple("CompiledSerializers", "serialize deserialize is_valid source")
+
+
+def _inherits(prop, method, owner):
+  """Checks if prop uses owner's version of the method."""
+  if method in prop.__dict__:
+    return False
+  return getattr(type(prop), method).im_func is getattr(owner, method).im_func
+
+
+def _to_db_expression(prop, i):
+  if _inherits(prop, "to_db", BaseProperty):
+    return None
+
+  if _inherits(prop, "to_db", StringProperty):
+    return "None if value is None else unicode(value)"
+
+  if _inherits(prop, "to_db", BooleanProperty):
+    return "None if value is None else bool(value)"
+
+  if _inherits(prop, "to_db", NumberProperty):
+    return "None if value is None else {0}(value)".format("int" if prop.integer else "float")
+
+  return "to_db_{0}(value)".format(i)
+
+
+def _from_db_expression(prop, i):
+  if _inherits(prop, "from_db", BaseProperty):
+    return None
+  return "from_db_{0}(value)".format(i)
+
+
+def _validate_expression(prop, i):
+  # BaseProperty.validate always passes if the value is not required and
+  # there are no custom validators.
+  trivial = not prop.required and not prop._validators
+
+  if trivial and _inherits(prop, "validate", BaseProperty):
+    return None
+
+  if trivial and _inherits(prop, "validate", ListProperty):
+    return "value is None or isinstance(value, (tuple, list))"
+
+  if trivial and _inherits(prop, "validate", DictProperty):
+    return "value is None or isinstance(value, dict)"
+
+  return "validate_{0}(value)".format(i)
+
+
+def _serialize_extras(doc, data, restricted, d):
+  for name, value in data.iteritems():
+    if name in doc._meta or name in restricted:
+      continue
+    if doc.DEFINED_PROPERTIES_ONLY:
+      doc._undefined_property_error(name)
+    d[name] = value
+
+
+def _deserialize_extras(doc, data):
+  for name, value in data.iteritems():
+    if name not in doc._meta:
+      doc.__setattr__(name, value)
+
+
+def compile_serializers(cls):
+  """Generates the serialize, deserialize and is_valid functions for a class.
+
+  The generated deserialize writes to ``_data`` directly instead of going
+  through ``__setattr__``, so nothing is generated for classes that
+  override ``__setattr__`` (or have a property called key).
+
+  Args:
+    cls: The EmDocument/Document class, with ``_meta`` set.
+
+  Returns:
+    A CompiledSerializers, whose functions take the document as the first
+    argument, or None if the class cannot be compiled.
+  """
+  for klass in cls.__mro__:
+    if "__setattr__" in klass.__dict__:
+      if klass.__name__ != "EmDocument":
+        return None
+      break
+
+  if "key" in cls._meta:
+    return None
+
+  compact = issubclass(cls._data_class, CompactData)
+  props = sorted(cls._meta.iteritems())
+  count = len(props)
+
+  namespace = {
+    "_MISSING": MISSING,
+    "_EMPTY_SET": EMPTY_SET,
+    "_serialize_extras": _serialize_extras,
+    "_deserialize_extras": _deserialize_extras,
+  }
+
+  # Compact documents keep the values in a list by position (see
+  # kvkit.compact), so the generated code indexes that list directly.
+  if compact:
+    get_value = "  value = values[{1}]"
+    serialize = [
+      "def serialize(self, restricted, to_validate):",
+      "  data = self._data",
+      "  values = data._values",
+      "  d = {}",
+    ]
+    is_valid = [
+      "def is_valid(self):",
+      "  data = self._data",
+      "  values = data._values",
+    ]
+    target = "    target[{1}] = value"
+    deserialize = [
+      "def deserialize(self, data):",
+      "  target = self._data._values",
+    ]
+  else:
+    get_value = "  value = data.get({0}, _MISSING)"
+    serialize = [
+      "def serialize(self, restricted, to_validate):",
+      "  data = self._data",
+      "  d = {}",
+      "  missing = 0",
+    ]
+    is_valid = [
+      "def is_valid(self):",
+      "  data = self._data",
+    ]
+    target = "    target[{0}] = value"
+    deserialize = [
+      "def deserialize(self, data):",
+      "  target = self._data",
+    ]
+
+  deserialize.append("  missing = 0")
+  load_on_demand = any(prop.load_on_demand for _, prop in props)
+  if load_on_demand:
+    deserialize.append("  props_to_load = set()")
+
+  for i, (name, prop) in enumerate(props):
+    literal = repr(name)
+    to_db = _to_db_expression(prop, i)
+    from_db = _from_db_expression(prop, i)
+    validate = _validate_expression(prop, i)
+
+    namespace["to_db_{0}".format(i)] = prop.to_db
+    namespace["from_db_{0}".format(i)] = prop.from_db
+    namespace["validate_{0}".format(i)] = prop.validate
+
+    serialize.append(get_value.format(literal, i))
+    if compact:
+      serialize.append("  if value is not _MISSING and {0} not in restricted:".format(literal))
+    else:
+      serialize.append("  if value is _MISSING:")
+      serialize.append("    missing += 1")
+      serialize.append("  elif {0} not in restricted:".format(literal))
+    if validate is not None:
+      serialize.append("    if {0} in to_validate and not ({1}):".format(literal, validate))
+      serialize.append("      self._validation_error({0}, value)".format(literal))
+    serialize.append("    d[{0}] = {1}".format(literal, to_db or "value"))
+
+    deserialize.append("  value = data.get({0}, _MISSING)".format(literal))
+    deserialize.append("  if value is _MISSING:")
+    deserialize.append("    missing += 1")
+    deserialize.append("  else:")
+    if prop.load_on_demand:
+      deserialize.append("    props_to_load.add({0})".format(literal))
+    elif from_db is not None:
+      deserialize.append("    value = {0}".format(from_db))
+    if hasattr(prop, "on_set"):
+      namespace["on_set_{0}".format(i)] = prop.on_set
+      deserialize.append("    value = on_set_{0}(value)".format(i))
+    deserialize.append(target.format(literal, i))
+
+    is_valid.append(get_value.format(literal, i))
+    is_valid.append("  if value is _MISSING:")
+    is_valid.append("    self._attribute_not_found({0})".format(literal))
+    if validate is not None:
+      is_valid.append("  if not ({0}):".format(validate))
+      is_valid.append("    return False")
+
+  # Attributes that are not defined properties are rare, so they are only
+  # looked for if there are more keys than defined properties found. Compact
+  # documents keep them apart already.
+  if compact:
+    serialize.append("  if data._extra:")
+    serialize.append("    _serialize_extras(self, data._extra, restricted, d)")
+  else:
+    serialize.append("  if len(data) + missing > {0}:".format(count))
+    serialize.append("    _serialize_extras(self, data, restricted, d)")
+  serialize.append("  return d")
+
+  deserialize.append("  if len(data) + missing > {0}:".format(count))
+  deserialize.append("    _deserialize_extras(self, data)")
+  if load_on_demand:
+    deserialize.append("  self._props_to_load = props_to_load or _EMPTY_SET")
+  else:
+    deserialize.append("  self._props_to_load = _EMPTY_SET")
+  deserialize.append("  self._mark_clean()")
+  deserialize.append("  return self")
+
+  if compact:
+    is_valid.append("  if self.DEFINED_PROPERTIES_ONLY and data._extra:")
+  else:
+    is_valid.append("  if self.DEFINED_PROPERTIES_ONLY and len(data) > {0}:".format(count))
+  is_valid.append("    return False")
+  is_valid.append("  return True")
+
+  source = "\n\n".join("\n".join(lines) for lines in (serialize, deserialize, is_valid)) + "\n"
+  exec compile(source, "<kvkit serializers for {0}>".format(cls.__name__), "exec") in namespace
+
+  return CompiledSerializers(namespace["serialize"], namespace["deserialize"], namespace["is_valid"], source)
@@ -35,8 +35,11 @@ except ImportError:
 from uuid import uuid1
 
 from .emdocument import EmDocument, EmDocumentMetaclass
-from .exceptions import NotFoundError
-from .properties import NumberProperty
+from .exceptions import BatchError, NotFoundError
+from .pagination import Page, paging_args
+from .projection import document_to_record, to_record
+from .properties import DateTimeProperty, NumberProperty
+from .session import current_session
 
 class DocumentMetaclass(EmDocumentMetaclass):
   def __new__(cls, clsname, parents, attrs):
@@ -48,26 +51,134 @@ class DocumentMetaclass(EmDocumentMetaclass):
       c._backend.init_class(c)
     return c
 
+  @staticmethod
+  def _backend_slots(parents, attrs):
+    backend = attrs.get("_backend")
+    if backend is None:
+      backend = next((p._backend for p in parents if hasattr(p, "_backend")), None)
+    return getattr(backend, "document_slots", ())
+
 class Document(EmDocument):
   __metaclass__ = DocumentMetaclass
+  __slots__ = ()
+
+  @classmethod
+  def _projection_args(cls, fields, args):
+    # Backends that can leave out the other fields get them in the args.
+    fields = list(fields)
+    if getattr(cls._backend, "supports_projection", False):
+      args["fields"] = fields
+    return fields
 
   @classmethod
-  def get(cls, key, **args):
+  def get(cls, key, fields=None, **args):
     """Gets an object from the db given a key.
 
+    If a Session is active, the instance already loaded in that session is
+    returned instead.
+
     Args:
       key: The key
+      fields: If not None, a list of field names. Instead of a document, a
+          read only record (a namedtuple) with the key and only these
+          fields is returned. Only these fields are converted from the db.
 
     Returns:
-      The document.
+      The document, or a record if fields is given.
 
     Raises:
       NotFoundError if not found.
     """
+    session = current_session()
+    if session is not None:
+      doc = session.get(cls, key)
+      if doc is not None:
+        return doc if fields is None else document_to_record(doc, fields)
+
+    if fields is not None:
+      fields = cls._projection_args(fields, args)
+      value, _ = cls._backend.get(cls, key, **args)
+      return to_record(cls, fields, key, value)
+
     doc = cls(key=key)
     doc.reload(**args)
+    if session is not None:
+      session.add(doc)
     return doc
 
+  @classmethod
+  def get_many(cls, keys, missing="skip", fields=None, **args):
+    """Gets many objects from the db given a list of keys.
+
+    This is usually more efficient than calling get for each key as the
+    backend can batch the reads. Documents already loaded in the active
+    Session are not read again.
+
+    Args:
+      keys: A list/iterator of keys.
+      missing: What to do with keys that are not found. "skip" leaves them
+          out of the result, "none" puts a None in their place, and "raise"
+          raises a NotFoundError. Defaults to "skip".
+      fields: If not None, records with only these fields are returned
+          instead of documents. See ``get``.
+
+    Returns:
+      A list of documents (or records) in the same order as the keys.
+
+    Raises:
+      NotFoundError if missing is "raise" and a key is not found.
+    """
+    if missing not in ("skip", "none", "raise"):
+      raise ValueError("missing must be one of 'skip', 'none', or 'raise', not '{0}'.".format(missing))
+
+    keys = list(keys)
+    docs = {}
+    session = current_session()
+    if session is not None:
+      for key in keys:
+        doc = session.get(cls, key)
+        if doc is not None:
+          docs[key] = doc if fields is None else document_to_record(doc, fields)
+
+    if fields is not None:
+      fields = cls._projection_args(fields, args)
+
+    keys_to_get = [key for key in keys if key not in docs]
+    if hasattr(cls._backend, "get_many"):
+      results = cls._backend.get_many(cls, keys_to_get, **args)
+    else:
+      results = []
+      for key in keys_to_get:
+        try:
+          results.append(cls._backend.get(cls, key, **args))
+        except NotFoundError:
+          results.append(None)
+
+    for key, result in zip(keys_to_get, results):
+      if result is None or key in docs:
+        continue
+
+      value, backend_obj = result
+      if fields is not None:
+        docs[key] = to_record(cls, fields, key, value)
+        continue
+
+      doc = cls(key=key, backend_obj=backend_obj)
+      docs[key] = doc.deserialize(value)
+      if session is not None:
+        session.add(doc)
+
+    ordered_docs = []
+    for key in keys:
+      if key in docs:
+        ordered_docs.append(docs[key])
+      elif missing == "raise":
+        raise NotFoundError("Key '{0}' not found.".format(key))
+      elif missing == "none":
+        ordered_docs.append(None)
+
+    return ordered_docs
+
   @classmethod
   def get_or_new(cls, key, **args):
     """Gets an object from the db given a key. If fails, create one.
@@ -88,7 +199,8 @@ class Document(EmDocument):
       return cls(key=key)
 
   @classmethod
-  def index_keys_only(cls, field, start_value, end_value=None, **args):
+  def index_keys_only(cls, field, start_value, end_value=None, limit=None,
+                      reverse=False, continuation=None, **args):
     """Uses the index to find document keys.
 
     Args:
@@ -102,22 +214,63 @@ class Document(EmDocument):
           it will match exact with start_value. Otherwise the range is
           start_value <= value <= end_value
 
+      limit: If not None, only a page of at most this many keys is
+          returned.
+
+      reverse: If True, iterate from the end of the range. Not all
+          backends support this.
+
+      continuation: The continuation of a previous page to resume from.
+
     Returns:
       A list/iterator of keys that matches the query in arbitrary order
-      that depends on the backend.
+      that depends on the backend. If limit is given, a Page, which is a
+      list with a continuation attribute for the next page.
     """
+    args.update(paging_args(limit, reverse, continuation))
+
     if field == "$bucket":
-      return cls._backend.list_all_keys(cls)
+      return cls._backend.list_all_keys(cls, **args)
     elif field == "$key":
       return cls._backend.list_all_keys(cls, start_value, end_value, **args)
 
-    if isinstance(cls._meta[field], NumberProperty):
-      start_value = float(start_value)
-      if end_value is not None:
-        end_value = float(end_value)
-
+    start_value, end_value = cls._index_query_values(field, start_value, end_value)
     return cls._backend.index_keys_only(cls, field, start_value, end_value, **args)
 
+  @classmethod
+  def index_terms(cls, field, start_value, end_value=None, limit=None,
+                  reverse=False, continuation=None, **args):
+    """Uses the index to find the values of a field and their documents,
+    without loading the documents.
+
+    This is for queries that only need the indexed values, like counting the
+    documents per value of a range or drawing a timeline.
+
+    Args:
+      The same as ``index_keys_only``.
+
+    Returns:
+      An iterator of (value, key) in the order of the index. A document with
+      several values of a ListProperty in the range comes once for each of
+      them. If limit is given, a Page of them.
+
+    Raises:
+      NotImplementedError if the backend cannot read the values of its
+      indexes.
+    """
+    if not hasattr(cls._backend, "index_terms"):
+      raise NotImplementedError("The backend of '{0}' cannot read index values.".format(cls.__name__))
+
+    args.update(paging_args(limit, reverse, continuation))
+    start_value, end_value = cls._index_query_values(field, start_value, end_value)
+    terms = cls._backend.index_terms(cls, field, start_value, end_value, **args)
+
+    convert = cls._index_term_converter(field)
+    results = ((convert(value), key) for value, key in terms)
+    if isinstance(terms, Page):
+      return Page(results, terms.continuation)
+    return results
+
   @classmethod
   def delete_key(cls, key, **args):
     """Deletes a document with a key from the database.
@@ -129,46 +282,128 @@ class Document(EmDocument):
       This is usually more efficient than YourDocument(key).delete() as
       that involves a get operation.
     """
-    return cls._backend.delete(cls.__class__, key, **args)
+    session = current_session()
+    if session is not None:
+      session.discard(cls, key)
+    return cls._backend.delete(cls, key, **args)
 
   @classmethod
-  def list_all_keys(cls, start_value=None, end_value=None, **args):
+  def delete_many(cls, keys, batch_size=500, **args):
+    """Deletes many documents with the given keys from the database.
+
+    Keyword arguments are passed to the backend.
+
+    Args:
+      keys: A list/iterator of keys to be deleted.
+      batch_size: The number of keys to delete at once. Defaults to 500.
+
+    Returns:
+      The number of documents removed. If the backend cannot tell, this is
+      the number of keys given.
+    """
+    count = 0
+    batch = []
+    for key in keys:
+      batch.append(key)
+      if len(batch) >= batch_size:
+        count += cls._delete_batch(batch, **args)
+        batch = []
+
+    if batch:
+      count += cls._delete_batch(batch, **args)
+
+    return count
+
+  @classmethod
+  def delete_where(cls, field, start_value, end_value=None, batch_size=500, **args):
+    """Deletes all the documents that matches an index query.
+
+    The keys are streamed from ``index_keys_only`` and deleted in batches,
+    so the documents are never loaded. Keyword arguments are passed to the
+    backend's delete.
+
+    Args:
+      field: the property/field name.
+      start_value: The same as ``index_keys_only``.
+      end_value: The same as ``index_keys_only``.
+      batch_size: The number of keys to delete at once. Defaults to 500.
+
+    Returns:
+      The number of documents removed.
+    """
+    keys = cls.index_keys_only(field, start_value, end_value)
+    return cls.delete_many(keys, batch_size=batch_size, **args)
+
+  @classmethod
+  def _delete_batch(cls, batch, **args):
+    session = current_session()
+    if session is not None:
+      for key in batch:
+        session.discard(cls, key)
+
+    if hasattr(cls._backend, "delete_many"):
+      return cls._backend.delete_many(cls, batch, **args)
+
+    for key in batch:
+      cls._backend.delete(cls, key, **args)
+    return len(batch)
+
+  @classmethod
+  def list_all_keys(cls, start_value=None, end_value=None, limit=None,
+                    reverse=False, continuation=None, **args):
     """List all the keys from the db.
 
     Args:
       start_value: if specified, it will be the start of a range.
       end_value: if specified, it will be the end of a range.
+      limit: If not None, only a page of at most this many keys is
+          returned.
+      reverse: If True, iterate from the end of the range. Not all
+          backends support this.
+      continuation: The continuation of a previous page to resume from.
 
     Returns:
       allkeys[start_value:] if only start_value is given,
       allkeys[start_value:end_value+1] if end_value is given. The +1 is
       largely a metaphor, as it will return all the values that ==
-      end_value.
+      end_value. If limit is given, a Page of these.
     """
+    args.update(paging_args(limit, reverse, continuation))
     return cls._backend.list_all_keys(cls, start_value=start_value, end_value=end_value, **args)
 
   @classmethod
-  def list_all(cls, start_value=None, end_value=None, **args):
+  def list_all(cls, start_value=None, end_value=None, limit=None,
+               reverse=False, continuation=None, fields=None, **args):
     """List all the objects.
 
     Args:
       start_value: if specified, it will be the start of a range.
       end_value: if specified, it will be the end of a range.
+      limit: If not None, only a page of at most this many documents is
+          returned.
+      reverse: If True, iterate from the end of the range. Not all
+          backends support this.
+      continuation: The continuation of a previous page to resume from.
+      fields: If not None, records with only these fields are returned
+          instead of documents. See ``get``.
 
     Returns:
       A generator with the following properties:
       allobjs[start_value:] if only start_value is given,
       allobjs[start_value:end_value+1] if end_value is given. The +1 is
       largely a metaphor, as it will return all the values that ==
-      end_value.
+      end_value. If limit is given, a Page of these.
     """
-    kvs = cls._backend.list_all(cls, start_value, end_value, **args)
-    for k, v, backend_obj in kvs:
-      yield cls(key=k, data=v, backend_obj=backend_obj)
+    args.update(paging_args(limit, reverse, continuation))
+    if fields is not None:
+      fields = cls._projection_args(fields, args)
 
+    kvs = cls._backend.list_all(cls, start_value, end_value, **args)
+    return cls._load_documents(kvs, fields)
 
   @classmethod
-  def index(cls, field, start_value, end_value=None, **args):
+  def index(cls, field, start_value, end_value=None, limit=None,
+            reverse=False, continuation=None, fields=None, **args):
     """Uses the index to find documents that matches.
 
     Args:
@@ -182,25 +417,139 @@ class Document(EmDocument):
           it will match exact with start_value. Otherwise the range is
           start_value <= value <= end_value
 
+      limit: If not None, only a page of at most this many documents is
+          returned.
+
+      reverse: If True, iterate from the end of the range. Not all
+          backends support this.
+
+      continuation: The continuation of a previous page to resume from.
+
+      fields: If not None, records with only these fields are returned
+          instead of documents. See ``get``.
+
     Returns:
       An iterator of loaded documents. Loaded at each iteration to save
-      time and space.
+      time and space. If limit is given, a Page of loaded documents.
     """
+    args.update(paging_args(limit, reverse, continuation))
+    if fields is not None:
+      fields = cls._projection_args(fields, args)
+
     kvs = []
     if field == "$bucket":
-      kvs = cls._backend.list_all(cls)
+      kvs = cls._backend.list_all(cls, **args)
     elif field == "$key":
       kvs = cls._backend.list_all(cls, start_value, end_value, **args)
     else:
-      if isinstance(cls._meta[field], NumberProperty):
-        start_value = float(start_value)
-        if end_value is not None:
-          end_value = float(end_value)
-
+      start_value, end_value = cls._index_query_values(field, start_value, end_value)
       kvs = cls._backend.index(cls, field, start_value, end_value, **args)
 
-    for key, value, backend_obj in kvs:
-      yield cls(key=key, backend_obj=backend_obj).deserialize(value)
+    return cls._load_documents(kvs, fields)
+
+  @classmethod
+  def rebuild_indexes(cls, **args):
+    """Rebuilds the indexes of this class from all of its documents.
+
+    Use this after adding ``index=True`` to a property that already has
+    values, or if the indexes are out of sync. See ``kvkit.reindex`` for a
+    command line version.
+
+    Args:
+      **args: Passed to the backend. For LevelDB, see
+          ``kvkit.backends.leveldb.rebuild_indexes``.
+
+    Returns:
+      The number of documents indexed.
+
+    Raises:
+      NotImplementedError if the backend cannot rebuild indexes.
+    """
+    if not hasattr(cls._backend, "rebuild_indexes"):
+      raise NotImplementedError("The backend of '{0}' cannot rebuild indexes.".format(cls.__name__))
+    return cls._backend.rebuild_indexes(cls, **args)
+
+  @classmethod
+  def verify_indexes(cls, repair=False, **args):
+    """Checks the indexes of this class against its documents.
+
+    Args:
+      repair: If True, fix the problems that are found.
+      **args: Passed to the backend. For LevelDB, see
+          ``kvkit.backends.leveldb.verify_indexes``.
+
+    Returns:
+      A report of the problems found, which depends on the backend.
+
+    Raises:
+      NotImplementedError if the backend cannot verify indexes.
+    """
+    if not hasattr(cls._backend, "verify_indexes"):
+      raise NotImplementedError("The backend of '{0}' cannot verify indexes.".format(cls.__name__))
+    return cls._backend.verify_indexes(cls, repair=repair, **args)
+
+  @classmethod
+  def snapshot(cls):
+    """Pins a consistent view of the database for reads.
+
+    Inside the ``with`` statement, all the gets, index queries and list_all
+    calls of this class in the current thread, including the gets done by
+    ``index``, see the documents as they were when it started, even if they
+    are written to meanwhile::
+
+        with BlogPost.snapshot():
+          for post in BlogPost.index("tags", "a", "z"):
+            export(post)
+
+    Documents already loaded in a Session are still returned from it.
+
+    Returns:
+      A context manager.
+
+    Raises:
+      NotImplementedError if the backend does not support snapshots.
+    """
+    if not hasattr(cls._backend, "snapshot"):
+      raise NotImplementedError("The backend of '{0}' does not support snapshots.".format(cls.__name__))
+    return cls._backend.snapshot(cls)
+
+  @classmethod
+  def _index_query_values(cls, field, start_value, end_value):
+    """Converts the values of an index query to what is stored in the db, so
+    numbers are compared as numbers and datetimes as seconds since the
+    epoch."""
+    prop = cls._meta[field]
+    if isinstance(prop, NumberProperty):
+      start_value = float(start_value)
+      if end_value is not None:
+        end_value = float(end_value)
+    elif isinstance(prop, DateTimeProperty):
+      start_value = prop.to_db(start_value)
+      end_value = prop.to_db(end_value)
+
+    return start_value, end_value
+
+  @classmethod
+  def _index_term_converter(cls, field):
+    """Gets the function that turns a value read from an index back into a
+    value of the property, as backends store numbers and datetimes in
+    their own way."""
+    prop = cls._meta[field]
+    if isinstance(prop, NumberProperty):
+      return int if prop.integer else float
+    elif isinstance(prop, DateTimeProperty):
+      return lambda value: prop.from_db(float(value))
+    return lambda value: value
+
+  @classmethod
+  def _load_documents(cls, kvs, fields=None):
+    if fields is None:
+      docs = (cls(key=key, backend_obj=backend_obj).deserialize(value) for key, value, backend_obj in kvs)
+    else:
+      docs = (to_record(cls, fields, key, value) for key, value, _ in kvs)
+    if isinstance(kvs, Page):
+      return Page(docs, kvs.continuation)
+    return docs
 
   def __init__(self, key=lambda: uuid1().hex, data={}, backend_obj=None, **args):
     """Initializes a new document.
@@ -222,11 +571,11 @@ class Document(EmDocument):
     if not isinstance(key, basestring):
       raise TypeError("Key must be a string, not {0}".format(key))
 
-    self.__dict__["key"] = key
+    object.__setattr__(self, "key", key)
     EmDocument.__init__(self, data)
 
     if backend_obj is not None:
-      self.__dict__["_backend_obj"] = backend_obj
+      object.__setattr__(self, "_backend_obj", backend_obj)
 
     self._backend.init_document(self, **args)
 
@@ -247,7 +596,10 @@ class Document(EmDocument):
       NotFoundError
     """
     value, backend_obj = self._backend.get(self.__class__, self.key, **args)
-    self._backend_obj = backend_obj
+    # Backends that return no object, like the cached backend on a hit,
+    # leave the one made by clear_document.
+    if backend_obj is not None:
+      self._backend_obj = backend_obj
     self.deserialize(value)
     return self
 
@@ -269,10 +621,16 @@ class Document(EmDocument):
     self._backend.post_deserialize(self, data)
     return self
 
-  def save(self, **args):
+  def save(self, only_if_dirty=False, **args):
     """Saves an object into the db.
 
-    Keyword arguments are passed to the backend.
+    Only the properties modified since the document was loaded are
+    validated. Keyword arguments are passed to the backend.
+
+    Args:
+      only_if_dirty: If True and nothing has been modified since the
+          document was loaded or last saved, this does nothing. Defaults
+          to False.
 
     Returns:
       self
@@ -280,10 +638,82 @@ class Document(EmDocument):
     Raises:
       ValidationError
     """
-    value = self.serialize()
+    if only_if_dirty and not self.is_dirty():
+      return self
+
+    value = self.serialize(only_validate_dirty=True)
     self._backend.save(self, self.key, value, **args)
+    self._mark_clean(saved=True)
+    session = current_session()
+    if session is not None:
+      session.add(self)
     return self
 
+  @classmethod
+  def save_many(cls, docs, batch_size=500, **args):
+    """Saves many objects into the db in batches.
+
+    This is usually a lot more efficient than calling save on each document
+    as the backend can write a batch at once. Keyword arguments are passed to
+    the backend.
+
+    Args:
+      docs: A list/iterator of documents of this class.
+      batch_size: The number of documents to serialize and write at once.
+          Defaults to 500.
+
+    Returns:
+      The number of documents saved.
+
+    Raises:
+      ValidationError. The batch containing the invalid document is not
+      written, but batches before it are.
+      BatchError if the backend could not save some of the documents. It
+      goes on with the others and raises once they are all written.
+    """
+    count = 0
+    failed = []
+    batch = []
+    for doc in docs:
+      batch.append((doc, doc.key, doc.serialize(only_validate_dirty=True)))
+      if len(batch) >= batch_size:
+        count += cls._save_batch(batch, failed, **args)
+        batch = []
+
+    if batch:
+      count += cls._save_batch(batch, failed, **args)
+
+    if failed:
+      raise BatchError(failed, count)
+    return count
+
+  @classmethod
+  def _save_batch(cls, batch, failed, **args):
+    """Writes a batch, adds the documents not saved to failed and returns
+    the number saved."""
+    batch_failed = None
+    if hasattr(cls._backend, "save_many"):
+      batch_failed = cls._backend.save_many(cls, batch, **args)
+    else:
+      for doc, key, value in batch:
+        cls._backend.save(doc, key, value, **args)
+
+    saved = batch
+    if batch_failed:
+      failed.extend(batch_failed)
+      failed_docs = set(id(doc) for doc, _ in batch_failed)
+      saved = [item for item in batch if id(item[0]) not in failed_docs]
+
+    for doc, key, value in saved:
+      doc._mark_clean(saved=True)
+
+    session = current_session()
+    if session is not None:
+      for doc, key, value in saved:
+        session.add(doc)
+
+    return len(saved)
+
   def delete(self, **args):
     """Deletes this object from the db.
 
@@ -295,6 +725,9 @@ class Document(EmDocument):
     Returns:
       self
     """
+    session = current_session()
+    if session is not None:
+      session.discard(self.__class__, self.key)
     self._backend.delete(self.__class__, self.key, doc=self, **args)
     self.clear(False)
     return self
@@ -24,10 +24,28 @@ except ImportError:
   except ImportError:
     import json
 
+from .compact import EMPTY_SET, data_class, slots_for
+from .compiler import compile_serializers
 from .properties.standard import BaseProperty, StringProperty, NumberProperty, ReferenceProperty, ListProperty
-from .helpers import walk_parents
+from .properties.fancy import DateTimeProperty
+from .helpers import walk_parents, mediocre_copy
 from .exceptions import ValidationError
 
+def _snapshot(value):
+  """Copies a value to compare it with later. Embedded documents are
+  replaced by their serialized form, as they are modified in place and do
+  not compare by their content."""
+  if isinstance(value, EmDocument):
+    return mediocre_copy(value.serialize())
+  if isinstance(value, list):
+    return [_snapshot(v) for v in value]
+  if isinstance(value, dict):
+    return dict((k, _snapshot(v)) for k, v in value.iteritems())
+  return value
+
+def _snapshotted(value):
+  return isinstance(value, (list, dict, EmDocument))
+
 class EmDocumentMetaclass(type):
   def __new__(cls, clsname, parents, attrs):
     if clsname in ("Document", "EmDocument"):
@@ -52,16 +70,29 @@ class EmDocumentMetaclass(type):
 
       if isinstance(attrs[name], BaseProperty):
         meta[name] = attrs.pop(name)
-        if isinstance(meta[name], (StringProperty, NumberProperty, ListProperty, ReferenceProperty)) and meta[name]._index:
+        if isinstance(meta[name], (StringProperty, NumberProperty, DateTimeProperty, ListProperty, ReferenceProperty)) and meta[name]._index:
           indexes.append(name)
 
     attrs["_meta"] = meta
     attrs["defined_properties"] = meta.keys()
     attrs["_indexes"] = indexes
-    return type.__new__(cls, clsname, parents, attrs)
+
+    if attrs.get("__compact__", any(getattr(p_cls, "__compact__", False) for p_cls in parents)):
+      attrs["__slots__"] = slots_for(parents, cls._backend_slots(parents, attrs))
+      attrs["_data_class"] = data_class(clsname, sorted(meta))
+
+    c = type.__new__(cls, clsname, parents, attrs)
+    c._compiled = compile_serializers(c)
+    return c
+
+  @staticmethod
+  def _backend_slots(parents, attrs):
+    return ()
 
   def __getattr__(self, name):
-    if hasattr(self, "_meta") and name in self._meta:
+    # EmDocument and Document have no _meta, and looking it up must not come
+    # back here.
+    if name != "_meta" and hasattr(self, "_meta") and name in self._meta:
       return self._meta[name]
     raise AttributeError("'{0}' does not exist for class '{1}'.".format(name, self.__name__))
 
@@ -77,11 +108,31 @@ class EmDocument(object):
                                  `save` for Document) and False will be returned
                                  in `is_valid`. `invalids` will return
                                  `"_extra_props"` in the list.
+    - `COMPILED_SERIALIZERS`: A boolean value indicating that `serialize`,
+                              `deserialize` and `is_valid` should use the
+                              functions generated for this class when it
+                              was created (see `kvkit.compiler`). Defaults
+                              to True. Set it to False on a class, or on
+                              EmDocument for every class, to use the
+                              generic versions instead.
+    - `__compact__`: A boolean value indicating that instances should use
+                     less memory (see `kvkit.compact`). The defined
+                     properties are stored in a list by position and the
+                     instance attributes in `__slots__`, while attribute
+                     and item access stay the same. It is inherited and
+                     must be set when the class is created. Defaults to
+                     False.
     - defined_properties: A list of defined properties. For read only.
   """
   __metaclass__ = EmDocumentMetaclass
+  __slots__ = ()
 
   DEFINED_PROPERTIES_ONLY = False
+  COMPILED_SERIALIZERS = True
+  __compact__ = False
+
+  _compiled = None
+  _data_class = dict
 
   def __init__(self, data={}):
     """Initializes a new EmDocument
@@ -99,7 +150,10 @@ class EmDocument(object):
   def _attribute_not_found(self, name):
     raise AttributeError("Attribute '{0}' not found with '{1}'.".format(name, self.__class__.__name__))
 
-  def serialize(self, dictionary=True, restricted=tuple()):
+  def _undefined_property_error(self, name):
+    raise ValidationError("Property {} is not defined and {} has DEFINED_PROPERTIES_ONLY".format(name, self.__class__.__name__))
+
+  def serialize(self, dictionary=True, restricted=tuple(), only_validate_dirty=False):
     """Serializes the object into a dictionary with all the proper conversions
 
     Args:
@@ -111,22 +165,31 @@ class EmDocument(object):
                   the user but you need to return the object to them, without
                   the token. This defaults to tuple(), which means nothing is
                   restricted.
+      only_validate_dirty: If True, only the properties modified since the
+                           document was loaded are validated. Defaults to
+                           False.
     Returns:
       A plain dictionary representation of the object after all the conversion
       to make it json friendly.
     """
     # Note that this doesn't call is_valid as it has built in validation.
 
+    to_validate = self.dirty_fields() if only_validate_dirty else self._data
+
+    if self._compiled is not None and self.COMPILED_SERIALIZERS:
+      d = self._compiled.serialize(self, restricted, to_validate)
+      return d if dictionary else json.dumps(d)
+
     d = {}
     for name, value in self._data.iteritems():
       if name in restricted:
         continue
       if name in self._meta:
-        if not self._meta[name].validate(value):
+        if name in to_validate and not self._meta[name].validate(value):
           self._validation_error(name, value)
         value = self._meta[name].to_db(value)
       elif self.DEFINED_PROPERTIES_ONLY:
-        raise ValidationError("Property {} is not defined and {} has DEFINED_PROPERTIES_ONLY".format(name, self.__class__.__name__))
+        self._undefined_property_error(name)
 
       d[name] = value
 
@@ -146,6 +209,9 @@ class EmDocument(object):
       self, with its attributes populated.
 
     """
+    if self._compiled is not None and self.COMPILED_SERIALIZERS:
+      return self._compiled.deserialize(self, data)
+
     converted_data = {}
     props_to_load = set()
 
@@ -159,7 +225,8 @@ class EmDocument(object):
       converted_data[name] = value
 
     self.merge(converted_data, True)
-    self._props_to_load = props_to_load
+    self._props_to_load = props_to_load or EMPTY_SET
+    self._mark_clean()
     return self
 
   @classmethod
@@ -181,6 +248,9 @@ class EmDocument(object):
     Returns:
       True or False
     """
+    if self._compiled is not None and self.COMPILED_SERIALIZERS:
+      return self._compiled.is_valid(self)
+
     for name in self._meta:
       if not self._validate_attribute(name):
         return False
@@ -211,6 +281,72 @@ class EmDocument(object):
           invalid.append("_extra_props")
     return invalid
 
+  def dirty_fields(self):
+    """Get the names of the attributes modified since the document was
+    loaded.
+
+    Assignments and deletions are tracked as they happen. Lists,
+    dictionaries and embedded documents are also compared against a copy
+    taken the first time they are read from the document, so in place
+    changes like `doc.tags.append("a")` are detected too.
+
+    Returns:
+      A set of attribute names. If the document was not loaded from the
+      database (or has been cleared), every attribute is considered dirty.
+    """
+    if self._dirty is None:
+      return set(self._data)
+
+    dirty = set(self._dirty)
+    if self._loaded_values:
+      for name, value in self._loaded_values.iteritems():
+        if name in dirty:
+          continue
+        try:
+          if _snapshot(self._data.get(name)) != value:
+            dirty.add(name)
+        except ValidationError:
+          # An embedded document that no longer serializes was modified.
+          dirty.add(name)
+
+    return dirty
+
+  def is_dirty(self):
+    """Test if the document has been modified since it was loaded.
+
+    Returns:
+      True or False. A document that was not loaded is always dirty.
+    """
+    return self._dirty is None or len(self.dirty_fields()) > 0
+
+  def _mark_clean(self, saved=False):
+    # Mutable values are copied when they are first read (see
+    # _handing_out), as most loaded documents never read or modify them.
+    # The values of a saved document may already be held by the caller, so
+    # they are copied right away.
+    self._dirty = EMPTY_SET
+    self._loaded_values = None
+    if saved:
+      for name, value in self._data.iteritems():
+        if _snapshotted(value) and name not in self._props_to_load:
+          self._handing_out(name, value)
+
+  def _handing_out(self, name, value):
+    # A value can only be modified in place once it has been read, so this
+    # is the last moment to copy it as it was loaded.
+    if self._loaded_values is None:
+      self._loaded_values = {}
+    elif name in self._loaded_values:
+      return
+    if name not in self._dirty:
+      self._loaded_values[name] = _snapshot(value)
+
+  def _mark_dirty(self, name):
+    if self._dirty is EMPTY_SET:
+      self._dirty = set((name, ))
+    elif self._dirty is not None:
+      self._dirty.add(name)
+
   def _validate_attribute(self, name):
     if name not in self._data:
       self._attribute_not_found(name)
@@ -261,8 +397,10 @@ class EmDocument(object):
     Returns:
       self
     """
-    self._data = {}
-    self._props_to_load = set()
+    self._data = self._data_class()
+    self._props_to_load = EMPTY_SET
+    self._dirty = None
+    self._loaded_values = None
 
     if to_default:
       for name, prop in self._meta.iteritems():
@@ -282,7 +420,7 @@ class EmDocument(object):
       value: the value of that attribute to set to.
     """
     if name[0] == "_" or name == "key":
-      self.__dict__[name] = value
+      object.__setattr__(self, name, value)
       return
 
     if name in self._meta:
@@ -290,6 +428,8 @@ class EmDocument(object):
         value = self._meta[name].on_set(value)
 
     self._data[name] = value
+    if self._dirty is not None:
+      self._mark_dirty(name)
 
   def __getattr__(self, name):
     """Get an attribute from the document.
@@ -306,7 +446,10 @@ class EmDocument(object):
       if name in self._props_to_load:
         self._data[name] = self._meta[name].from_db(self._data[name])
         self._props_to_load.discard(name)
-      return self._data[name]
+      value = self._data[name]
+      if self._dirty is not None and _snapshotted(value):
+        self._handing_out(name, value)
+      return value
     self._attribute_not_found(name)
 
   def __delattr__(self, name):
@@ -315,6 +458,9 @@ class EmDocument(object):
         self._data[name] = None
       else:
         del self._data[name]
+
+      if self._dirty is not None:
+        self._mark_dirty(name)
     else:
       self._attribute_not_found(name)
 
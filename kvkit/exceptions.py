@@ -19,3 +19,15 @@ class ValidationError(KVKitError): pass
 class NotFoundError(KVKitError): pass
 class DatabaseError(KVKitError): pass
 class NotIndexed(KVKitError): pass
+
+class BatchError(DatabaseError):
+  """Some documents of a batch could not be saved. The others were.
+
+  Attributes:
+    failed: A list of (document, exception) for the documents not saved.
+    saved: The number of documents saved.
+  """
+  def __init__(self, failed, saved):
+    DatabaseError.__init__(self, "{0} documents could not be saved.".format(len(failed)))
+    self.failed = failed
+    self.saved = saved
@@ -14,6 +14,13 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with kvkit. If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import absolute_import
+
+import heapq
+import marshal
+import struct
+import tempfile
+
 # TODO: objects will be gone in py3k? Investigate
 def walk_parents(parents, bases=("Document", "EmDocument", "type", "object")):
   """Walks through the parents and return each parent class object.
@@ -71,3 +78,71 @@ def mediocre_copy(obj):
     return dict(mediocre_copy(i) for i in obj.iteritems())
 
   return obj
+
+def _write_run(items, f):
+  for item in items:
+    data = marshal.dumps(item)
+    f.write(struct.pack(">I", len(data)))
+    f.write(data)
+  f.flush()
+  f.seek(0)
+
+
+def _read_run(f):
+  while True:
+    header = f.read(4)
+    if not header:
+      return
+    yield marshal.loads(f.read(struct.unpack(">I", header)[0]))
+
+
+def external_sort(items, memory_limit=64 * 1024 * 1024, tmpdir=None, sizeof=len):
+  """Sorts items that may not all fit in memory.
+
+  The items are sorted in chunks of about memory_limit bytes. If there is
+  more than one chunk, each is written to a temporary file and the files are
+  merged at the end.
+
+  Args:
+    items: An iterable of values that marshal can dump, such as str or
+        tuples of str.
+    memory_limit: About how many bytes of items to keep in memory.
+    tmpdir: Where to put the temporary files. Defaults to the system's.
+    sizeof: A function giving the size of an item in bytes.
+
+  Returns:
+    An iterator of the items in sorted order. The temporary files are
+    removed when it is exhausted or garbage collected.
+  """
+  runs = []
+  chunk = []
+  size = 0
+  try:
+    for item in items:
+      chunk.append(item)
+      size += sizeof(item)
+      if size >= memory_limit:
+        chunk.sort()
+        f = tempfile.TemporaryFile(dir=tmpdir)
+        runs.append(f)
+        _write_run(chunk, f)
+        chunk = []
+        size = 0
+  except:
+    for f in runs:
+      f.close()
+    raise
+
+  chunk.sort()
+  if not runs:
+    return iter(chunk)
+  return _merge_runs(runs, chunk)
+
+
+def _merge_runs(runs, chunk):
+  try:
+    for item in heapq.merge(chunk, *[_read_run(f) for f in runs]):
+      yield item
+  finally:
+    for f in runs:
+      f.close()
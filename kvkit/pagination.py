@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: kvkit.pagination
+    :synopsis: Pages of query results and their continuation tokens.
+
+.. moduleauthor:: Shuhao Wu <shuhao@shuhaowu.com>
+"""
+
+from __future__ import absolute_import
+
+import base64
+
+try:
+  # We prefer ujson, then simplejson, then json
+  import ujson as json
+except ImportError:
+  try:
+    import simplejson as json
+  except ImportError:
+    import json
+
+
+class Page(list):
+  """A page of results from a query with a ``limit``.
+
+  This is a plain list with one extra attribute, ``continuation``. Pass it
+  as ``continuation`` to the same query to get the next page. It is None if
+  this is the last page.
+  """
+  def __init__(self, items=(), continuation=None):
+    list.__init__(self, items)
+    self.continuation = continuation
+
+
+def paging_args(limit=None, reverse=False, continuation=None):
+  """Builds the keyword arguments for the backend from the paging options.
+
+  Only the options that are set are included, so backends that do not
+  support paging still work for queries that do not use it.
+  """
+  args = {}
+  if limit is not None:
+    args["limit"] = limit
+  if reverse:
+    args["reverse"] = True
+  if continuation is not None:
+    args["continuation"] = continuation
+  return args
+
+
+def encode_continuation(position):
+  """Encodes a JSON friendly position into an opaque continuation token."""
+  return base64.urlsafe_b64encode(json.dumps(position))
+
+
+def decode_continuation(continuation):
+  """Decodes a continuation token from encode_continuation.
+
+  Raises:
+    ValueError if the token is not valid.
+  """
+  try:
+    return json.loads(base64.urlsafe_b64decode(str(continuation)))
+  except (TypeError, ValueError):
+    raise ValueError("Invalid continuation '{0}'.".format(continuation))
+
+
+def paginate(entries, limit=None):
+  """Takes a page of items from an iterator of (position, item).
+
+  One item past the page is read to find out if there is a next page, in
+  which case the continuation encodes the position of the last item in this
+  page.
+
+  Args:
+    entries: An iterator of (position, item). The positions must be JSON
+        friendly.
+    limit: The page size. If None, no page is taken.
+
+  Returns:
+    A Page if limit is not None. Otherwise an iterator of all the items.
+  """
+  if limit is None:
+    return (item for _, item in entries)
+
+  items = []
+  last_position = None
+  for position, item in entries:
+    if len(items) >= limit:
+      return Page(items, encode_continuation(last_position))
+    items.append(item)
+    last_position = position
+
+  return Page(items)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: kvkit.projection
+    :synopsis: Read only records with only some of the fields of a document.
+
+.. moduleauthor:: Shuhao Wu <shuhao@shuhaowu.com>
+"""
+
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+# (document class, fields) => record class
+_record_classes = {}
+
+
+def record_class(cls, fields):
+  """Gets the record class for a projection of a document class.
+
+  The records are namedtuples with ``key`` followed by the fields, so they
+  are read only and ``record._asdict()`` gives a plain dictionary. The
+  class is created once for every document class and set of fields.
+
+  Args:
+    cls: The document class.
+    fields: A list of the names of the fields to keep.
+
+  Returns:
+    The namedtuple class.
+
+  Raises:
+    ValueError if a field is ``key``, repeated, or not a valid name.
+  """
+  fields = tuple(fields)
+  rc = _record_classes.get((cls, fields))
+  if rc is None:
+    rc = namedtuple(cls.__name__ + "Record", ("key", ) + fields)
+    _record_classes[(cls, fields)] = rc
+  return rc
+
+
+def to_record(cls, fields, key, data):
+  """Builds a record from the JSON document loaded from the backend.
+
+  Only the requested fields are converted with ``from_db``. A field that is
+  not in the data gets the default value of its property, or None if it is
+  not a defined property.
+
+  Args:
+    cls: The document class.
+    fields: A list of the names of the fields to keep.
+    key: The key of the document.
+    data: The JSON document from the backend.
+
+  Returns:
+    A record as described by ``record_class``.
+  """
+  values = [key]
+  for name in fields:
+    prop = cls._meta.get(name)
+    if name in data:
+      value = data[name]
+      if prop is not None:
+        value = prop.from_db(value)
+    else:
+      value = prop.default() if prop is not None else None
+    values.append(value)
+
+  return record_class(cls, fields)._make(values)
+
+
+def document_to_record(doc, fields):
+  """Builds a record from a loaded document, for example one in a Session."""
+  values = [doc.key]
+  for name in fields:
+    values.append(getattr(doc, name) if name in doc._data else None)
+
+  return record_class(doc.__class__, fields)._make(values)
@@ -20,7 +20,7 @@ _NOUNCE = object()
 class BaseProperty(object):
   def __init__(self, required=False, default=_NOUNCE,
                validators=[], load_on_demand=False,
-               index=False):
+               index=False, covering=None):
     """The base property that all other properties extends from.
 
     Args:
@@ -44,12 +44,18 @@ class BaseProperty(object):
           for StringProperty, NumberProperty, ListProperty, and
           ReferenceProperty. Individual backends may have more but will
           not necessarily be portable.
+      covering: A list of property names whose values are stored in the
+          index next to every entry of this property, so
+          ``Document.index(..., fields=[...])`` with only those fields
+          does not need to load the documents. Only used by backends that
+          support it (LevelDB). Defaults to None.
     """
     self.required = required
     self._default = default
     self._validators = validators
     self.load_on_demand = load_on_demand
     self._index = index
+    self._covering = tuple(covering) if covering else ()
 
   def validate(self, value):
     """Validates a value.
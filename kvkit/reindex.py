@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: kvkit.reindex
+    :synopsis: Rebuilds or verifies the indexes of a document class from the
+               command line.
+
+.. moduleauthor:: Shuhao Wu <shuhao@shuhaowu.com>
+
+Usage::
+
+    python -m kvkit.reindex [--verify | --repair] [--batch-size N] [--memory-limit MB] module:Class
+
+The module is imported and ``Class.rebuild_indexes`` is called. With ``--verify``,
+``Class.verify_indexes`` is called instead and the problems found are
+printed for each field, and ``--repair`` also fixes them. The exit status is
+1 if problems were found and not repaired. Progress is printed as it goes. With
+LevelDB, nothing else can have the db open meanwhile. To rebuild while the
+application is running, call ``rebuild_indexes`` from the application.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import importlib
+import sys
+
+
+def load_class(path):
+  """Imports a class given as "package.module:Class"."""
+  module_name, _, name = path.partition(":")
+  if not name:
+    raise ValueError("Expected module:Class, got '{0}'.".format(path))
+
+  cls = importlib.import_module(module_name)
+  for attr in name.split("."):
+    cls = getattr(cls, attr)
+  return cls
+
+
+def print_progress(out=None):
+  """Makes a progress callback for rebuild_indexes that prints the rate."""
+  def progress(stage, count, elapsed):
+    stream = sys.stdout if out is None else out
+    rate = count / elapsed if elapsed > 0 else 0
+    stream.write("{0}: {1} ({2:.0f}/s)\n".format(stage, count, rate))
+    stream.flush()
+  return progress
+
+
+def print_report(report, out=None):
+  """Prints an IndexReport of verify_indexes."""
+  stream = sys.stdout if out is None else out
+  stream.write("Checked {0} documents and {1} index entries in {2:.1f}s ({3:.0f} documents/s).\n".format(
+      report.documents, report.entries, report.elapsed, report.rate))
+
+  fields = set()
+  for kind in report.KINDS:
+    fields.update(getattr(report, kind))
+
+  if not fields:
+    stream.write("No problems found.\n")
+    return
+
+  stream.write("{0:<20} {1:>10} {2:>10} {3:>10} {4:>10}\n".format("field", *report.KINDS))
+  for field in sorted(fields):
+    counts = [getattr(report, kind).get(field, 0) for kind in report.KINDS]
+    stream.write("{0:<20} {1:>10} {2:>10} {3:>10} {4:>10}\n".format(field, *counts))
+
+  if report.repaired:
+    stream.write("Repaired {0} entries.\n".format(report.repaired))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m kvkit.reindex",
+                                   description="Rebuilds or verifies the indexes of a document class.")
+  parser.add_argument("cls", metavar="module:Class", help="the document class")
+  mode = parser.add_mutually_exclusive_group()
+  mode.add_argument("--verify", action="store_true", help="only check the indexes against the documents")
+  mode.add_argument("--repair", action="store_true", help="check the indexes and fix the problems found")
+  parser.add_argument("--batch-size", type=int, default=10000,
+                      help="entries per write and documents between progress reports")
+  parser.add_argument("--memory-limit", type=int, default=64,
+                      help="megabytes of entries to sort in memory before using temporary files")
+  parser.add_argument("--tmpdir", default=None, help="where to put the temporary files")
+  args = parser.parse_args(argv)
+
+  cls = load_class(args.cls)
+  options = {
+    "batch_size": args.batch_size,
+    "memory_limit": args.memory_limit * 1024 * 1024,
+    "tmpdir": args.tmpdir,
+    "progress": print_progress(),
+  }
+
+  if args.verify or args.repair:
+    report = cls.verify_indexes(repair=args.repair, **options)
+    print_report(report)
+    return 0 if report.ok or args.repair else 1
+
+  count = cls.rebuild_indexes(**options)
+  print "Indexed {0} documents of {1}.".format(count, cls.__name__)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: kvkit.server
+    :synopsis: A storage daemon that serves document classes to other
+               processes over a Unix socket.
+
+.. moduleauthor:: Shuhao Wu <shuhao@shuhaowu.com>
+
+LevelDB only lets one process open a db. This server is that process for
+the classes given to it, and the ``kvkit.backends.leveldb_client`` backend
+sends their reads and writes to it, so any number of processes can share
+the data::
+
+    python -m kvkit.server --socket /var/run/blog.sock blog.models:Post blog.models:Comment
+
+The socket is created readable and writable by its owner only, as anyone
+who can connect can read and write all the documents of these classes.
+
+Every message is a frame: the length of the payload as 4 bytes, big endian,
+then the payload encoded with marshal. A request is (id, operation, class
+name, arguments) and each response is (id, status, value). The requests on
+a connection are answered in order, so a client can send several before
+reading the responses. The results of queries are streamed, as responses
+with the MORE status holding a list of up to ``chunk_size`` items, followed
+by an OK response with the continuation of the page, if any.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import marshal
+import os
+import signal
+import socket
+import SocketServer
+import struct
+import sys
+
+from .pagination import Page
+from .reindex import load_class
+
+# The statuses of responses.
+OK = 0
+MORE = 1
+ERROR = 2
+
+_HEADER = struct.Struct(">I")
+
+# The operations of requests, besides "ping", which needs no class.
+OPERATIONS = frozenset([
+  "get",
+  "get_many",
+  "save_many",
+  "delete_many",
+  "index",
+  "index_keys_only",
+  "index_terms",
+  "list_all",
+  "list_all_keys",
+])
+
+# The largest frame accepted, so a corrupt length does not make the reader
+# allocate gigabytes.
+MAX_FRAME = 256 * 1024 * 1024
+
+
+def write_frame(f, payload):
+  """Writes a frame to a file. It is not flushed."""
+  data = marshal.dumps(payload, 2)
+  f.write(_HEADER.pack(len(data)))
+  f.write(data)
+
+
+def read_frame(f):
+  """Reads a frame from a file.
+
+  Returns:
+    The payload, or None if the file ended before the frame started.
+
+  Raises:
+    IOError if the file ended in the middle of a frame or the frame is too
+    large.
+  """
+  header = f.read(_HEADER.size)
+  if not header:
+    return None
+
+  if len(header) < _HEADER.size:
+    raise IOError("Connection closed in the middle of a frame.")
+
+  length = _HEADER.unpack(header)[0]
+  if length > MAX_FRAME:
+    raise IOError("Frame of {0} bytes is larger than the limit.".format(length))
+
+  data = f.read(length)
+  if len(data) < length:
+    raise IOError("Connection closed in the middle of a frame.")
+  return marshal.loads(data)
+
+
+def _trim(data, fields):
+  if fields is None:
+    return data
+  return dict((name, data[name]) for name in fields if name in data)
+
+
+def _documents(results, fields):
+  # The backend objects stay in this process.
+  for key, data, _ in results:
+    yield key, _trim(data, fields)
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+  # Responses are buffered and flushed once complete, or after every chunk.
+  wbufsize = -1
+
+  def handle(self):
+    try:
+      while True:
+        request = read_frame(self.rfile)
+        if request is None:
+          return
+        self.server.dispatch(request, self.wfile)
+    except (IOError, ValueError, EOFError):
+      # The client went away or sent garbage. Either way the connection is
+      # done.
+      return
+
+
+class StorageServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Serves the documents of some classes over a Unix socket.
+
+  Each connection is served by its own thread. The classes are found by
+  their names, and their backends must be thread safe and have
+  ``write_many``, like ``kvkit.backends.leveldb``.
+  """
+  daemon_threads = True
+
+  def __init__(self, path, classes, chunk_size=100, mode=0600):
+    """Binds the socket.
+
+    Args:
+      path: The path of the socket. A file already there is removed.
+      classes: The document classes to serve.
+      chunk_size: The number of query results in each frame.
+      mode: The permissions of the socket.
+    """
+    self.classes = dict((cls.__name__, cls) for cls in classes)
+    self.chunk_size = chunk_size
+    if os.path.exists(path):
+      os.unlink(path)
+
+    SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+    os.chmod(path, mode)
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    if os.path.exists(self.server_address):
+      os.unlink(self.server_address)
+
+  def dispatch(self, request, out):
+    request_id, op, name, args = request
+    try:
+      if op == "ping":
+        result = None
+      elif op not in OPERATIONS:
+        raise ValueError("Unknown operation '{0}'.".format(op))
+      else:
+        cls = self.classes.get(name)
+        if cls is None:
+          raise ValueError("Class '{0}' is not served.".format(name))
+        result = getattr(self, "_" + op)(cls, out, request_id, *args)
+    except socket.error:
+      # Writing a chunk of results failed, so the client is gone.
+      raise
+    except Exception as e:
+      write_frame(out, (request_id, ERROR, (type(e).__name__, unicode(e))))
+    else:
+      write_frame(out, (request_id, OK, result))
+    out.flush()
+
+  def _stream(self, out, request_id, results):
+    """Sends the results of a query in chunks, then returns the
+    continuation of the page, if any."""
+    chunk = []
+    for item in results:
+      chunk.append(item)
+      if len(chunk) == self.chunk_size:
+        write_frame(out, (request_id, MORE, chunk))
+        out.flush()
+        chunk = []
+
+    if chunk:
+      write_frame(out, (request_id, MORE, chunk))
+    return results.continuation if isinstance(results, Page) else None
+
+  def _get(self, cls, out, request_id, key, kwargs):
+    data, _ = cls._backend.get(cls, key, **kwargs)
+    return _trim(data, kwargs.get("fields"))
+
+  def _get_many(self, cls, out, request_id, keys, kwargs):
+    fields = kwargs.get("fields")
+    return [None if result is None else _trim(result[0], fields)
+            for result in cls._backend.get_many(cls, keys, **kwargs)]
+
+  def _save_many(self, cls, out, request_id, items):
+    cls._backend.write_many(cls, items)
+
+  def _delete_many(self, cls, out, request_id, keys):
+    return cls._backend.delete_many(cls, keys)
+
+  def _index(self, cls, out, request_id, field, start_value, end_value, kwargs):
+    results = cls._backend.index(cls, field, start_value, end_value, **kwargs)
+    return self._stream(out, request_id, _keep_page(_documents(results, kwargs.get("fields")), results))
+
+  def _index_keys_only(self, cls, out, request_id, field, start_value, end_value, kwargs):
+    return self._stream(out, request_id, cls._backend.index_keys_only(cls, field, start_value, end_value, **kwargs))
+
+  def _index_terms(self, cls, out, request_id, field, start_value, end_value, kwargs):
+    if not hasattr(cls._backend, "index_terms"):
+      raise NotImplementedError("The backend of '{0}' cannot read index values.".format(cls.__name__))
+    return self._stream(out, request_id, cls._backend.index_terms(cls, field, start_value, end_value, **kwargs))
+
+  def _list_all(self, cls, out, request_id, start_value, end_value, kwargs):
+    results = cls._backend.list_all(cls, start_value, end_value, **kwargs)
+    return self._stream(out, request_id, _keep_page(_documents(results, kwargs.get("fields")), results))
+
+  def _list_all_keys(self, cls, out, request_id, start_value, end_value, kwargs):
+    return self._stream(out, request_id, cls._backend.list_all_keys(cls, start_value, end_value, **kwargs))
+
+
+def _keep_page(items, results):
+  """Keeps the continuation of a Page of results after transforming them."""
+  if isinstance(results, Page):
+    return Page(items, results.continuation)
+  return items
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m kvkit.server",
+                                   description="Serves document classes over a Unix socket.")
+  parser.add_argument("classes", metavar="module:Class", nargs="+", help="the document classes to serve")
+  parser.add_argument("--socket", required=True, help="the path of the socket")
+  parser.add_argument("--chunk-size", type=int, default=100, help="query results per frame")
+  args = parser.parse_args(argv)
+
+  classes = [load_class(path) for path in args.classes]
+  # Fail now rather than on the first request if a db cannot be opened.
+  for cls in classes:
+    if hasattr(cls, "open_leveldb_connections"):
+      cls.open_leveldb_connections()
+
+  server = StorageServer(args.socket, classes, args.chunk_size)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: kvkit.session
+    :synopsis: An identity map so the same document is only loaded once.
+
+.. moduleauthor:: Shuhao Wu <shuhao@shuhaowu.com>
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+_local = threading.local()
+
+
+def current_session():
+  """Gets the innermost session active in this thread.
+
+  Returns:
+    The Session, or None if there is no active session.
+  """
+  sessions = getattr(_local, "sessions", None)
+  return sessions[-1] if sessions else None
+
+
+class Session(object):
+  """An identity map of documents keyed by (class, key).
+
+  While a session is active (with the ``with`` statement), ``Document.get``,
+  ``Document.get_many`` and therefore ``ReferenceProperty`` return the
+  instance already loaded in this session instead of going to the backend.
+  Saving a document puts it in the session and deleting it takes it out.
+
+  Sessions are scoped to the thread that entered them and can be nested, in
+  which case the innermost one is used. A typical use is one session per web
+  request::
+
+      with Session() as session:
+        user = User.get(user_key)
+        # ... User.get(user_key) returns the same object from here on.
+
+  Attributes:
+    hits: The number of gets answered from the session.
+    misses: The number of gets that had to go to the backend.
+  """
+
+  def __init__(self):
+    self._documents = {}
+    self.hits = 0
+    self.misses = 0
+
+  def __enter__(self):
+    if not hasattr(_local, "sessions"):
+      _local.sessions = []
+    _local.sessions.append(self)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    _local.sessions.remove(self)
+    return False
+
+  def get(self, cls, key):
+    """Gets a document from the session and records the hit or miss.
+
+    Args:
+      cls: The document class.
+      key: The key of the document.
+
+    Returns:
+      The document, or None if it is not in the session.
+    """
+    doc = self._documents.get((cls, key))
+    if doc is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return doc
+
+  def add(self, doc):
+    """Puts a document in the session, replacing any with the same key."""
+    self._documents[(doc.__class__, doc.key)] = doc
+
+  def discard(self, cls, key):
+    """Takes a document out of the session if it is there."""
+    self._documents.pop((cls, key), None)
+
+  def clear(self):
+    """Takes every document out of the session. Does not reset the counters."""
+    self._documents = {}
+
+  def __contains__(self, doc):
+    return self._documents.get((doc.__class__, doc.key)) is doc
+
+  def __len__(self):
+    return len(self._documents)
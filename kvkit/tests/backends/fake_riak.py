@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""A stand-in for a Riak node that runs in a thread of this process.
+
+It answers the part of the Riak HTTP API that the riak backend uses
+through riak-python-client: getting, storing and deleting objects with
+their links, metadata and secondary indexes, exact and range index
+queries including ``$bucket`` and ``$key``, ``return_terms``,
+``max_results`` with continuations, streamed index queries and key lists.
+There are no siblings, everything is kept in memory, and the last write
+wins::
+
+    server = FakeRiakServer(latency=0.002, error_rate=0.01).start()
+    bucket = server.client().bucket("posts")
+    ...
+    server.stop()
+
+Every request for data waits ``latency`` seconds, plus a random part of
+``jitter``, like a round trip to a cluster, and fails with a 503 with a
+probability of ``error_rate``. ``requests`` counts the requests served by
+kind, so tests can check how many round trips something took.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import BaseHTTPServer
+from email.utils import formatdate
+import json
+import random
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+# What GET / answers, which riak-python-client uses to find the paths.
+RESOURCES = {
+  "riak_kv_wm_buckets": "/buckets",
+  "riak_kv_wm_index": "/buckets",
+  "riak_kv_wm_keylist": "/buckets",
+  "riak_kv_wm_link_walker": "/riak",
+  "riak_kv_wm_mapred": "/mapred",
+  "riak_kv_wm_ping": "/ping",
+  "riak_kv_wm_props": "/buckets",
+  "riak_kv_wm_raw": "/riak",
+  "riak_kv_wm_stats": "/stats",
+}
+
+# The version that is reported. It has paging, return_terms and streamed
+# index queries, and no bucket types.
+VERSION = "1.4.12"
+
+_BOUNDARY = "kvkitfakeriak"
+
+# The links of an object to its bucket, which Riak adds to every response
+# and which are not stored.
+_UP_LINK = re.compile(r'rel="up"')
+
+
+class _Object(object):
+  def __init__(self, data, content_type, indexes, links, meta, vclock):
+    self.data = data
+    self.content_type = content_type
+    # (field, term) pairs.
+    self.indexes = indexes
+    self.links = links
+    self.meta = meta
+    self.vclock = vclock
+    self.last_modified = formatdate(usegmt=True)
+
+
+class _HTTPError(Exception):
+  def __init__(self, status, message):
+    Exception.__init__(self, message)
+    self.status = status
+
+
+def _term(field, value):
+  if field.endswith("_int"):
+    try:
+      return int(value)
+    except ValueError:
+      raise _HTTPError(400, "Invalid integer term '{0}' for {1}.".format(value, field))
+  return value
+
+
+def _encode_continuation(term, key):
+  return base64.urlsafe_b64encode(json.dumps([term, key]))
+
+
+def _decode_continuation(continuation):
+  try:
+    term, key = json.loads(base64.urlsafe_b64decode(continuation.encode("ascii")))
+  except (ValueError, TypeError):
+    raise _HTTPError(400, "Invalid continuation.")
+  return term, key
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # Keeps the connections of the client's pool open between requests.
+  protocol_version = "HTTP/1.1"
+  # Responses are sent whole, as a small write after the headers waits for
+  # the client's delayed ack.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self._dispatch("GET")
+
+  def do_PUT(self):
+    self._dispatch("PUT")
+
+  def do_POST(self):
+    self._dispatch("POST")
+
+  def do_DELETE(self):
+    self._dispatch("DELETE")
+
+  def _dispatch(self, method):
+    url = urlparse.urlsplit(self.path)
+    self.params = dict(urlparse.parse_qsl(url.query))
+    path = [urllib.unquote_plus(part).decode("utf-8") for part in url.path.split("/")[1:] if part]
+    if path[:1] == ["types"]:
+      path = path[2:]
+
+    body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+    try:
+      if not path:
+        self._send_json(200, RESOURCES)
+      elif path == ["ping"]:
+        self._send(200, "OK", "text/plain")
+      elif path == ["stats"]:
+        self._send_json(200, {"riak_kv_version": VERSION})
+      elif len(path) >= 2 and path[0] in ("buckets", "riak"):
+        self._bucket(method, path[0], path[1], path[2:], body)
+      else:
+        raise _HTTPError(404, "Not found.")
+    except _HTTPError as e:
+      self._send(e.status, str(e) + "\n", "text/plain")
+
+  def _bucket(self, method, prefix, bucket, rest, body):
+    server = self.server
+    if prefix == "riak":
+      rest = ["keys"] + rest
+
+    if rest == ["props"]:
+      if method == "GET":
+        self._send_json(200, {"props": {"name": bucket, "n_val": 3, "allow_mult": False, "last_write_wins": False}})
+      else:
+        self._send(204)
+      return
+
+    if rest[:1] == ["index"] and len(rest) in (3, 4) and method == "GET":
+      server.delay("index")
+      field = rest[1]
+      end = rest[3] if len(rest) == 4 else None
+      self._index(bucket, field, rest[2], end)
+      return
+
+    if rest == ["keys"] and method == "GET":
+      server.delay("keys")
+      keys = server.keys(bucket)
+      if self.params.get("keys") == "stream":
+        chunk = server.stream_chunk_size
+        self._send_chunked("application/json",
+                           [json.dumps({"keys": keys[i:i + chunk]}) for i in xrange(0, len(keys), chunk)] +
+                           [json.dumps({"keys": []})])
+      else:
+        self._send_json(200, {"keys": keys})
+      return
+
+    if rest == ["keys"] and method == "POST":
+      server.delay("put")
+      key = uuid.uuid4().hex.decode("ascii")
+      obj = self._store(bucket, key, body)
+      self._send_object(201, bucket, key, obj, self.params.get("returnbody") == "true",
+                        {"Location": "/{0}/{1}/keys/{2}".format(prefix, urllib.quote_plus(bucket.encode("utf-8")),
+                                                                key)})
+      return
+
+    if len(rest) != 2 or rest[0] != "keys":
+      raise _HTTPError(404, "Not found.")
+
+    key = rest[1]
+    if method == "GET":
+      server.delay("get")
+      obj = server.get(bucket, key)
+      if obj is None:
+        raise _HTTPError(404, "not found")
+      self._send_object(200, bucket, key, obj, True)
+    elif method in ("PUT", "POST"):
+      server.delay("put")
+      if self.headers.get("If-None-Match") == "*" and server.get(bucket, key) is not None:
+        raise _HTTPError(412, "The object already exists.")
+      obj = self._store(bucket, key, body)
+      returnbody = self.params.get("returnbody") == "true"
+      self._send_object(200 if returnbody else 204, bucket, key, obj, returnbody)
+    elif method == "DELETE":
+      server.delay("delete")
+      if not server.delete(bucket, key):
+        raise _HTTPError(404, "not found")
+      self._send(204)
+    else:
+      raise _HTTPError(405, "Method not allowed.")
+
+  def _store(self, bucket, key, body):
+    indexes = set()
+    meta = {}
+    for name in self.headers.keys():
+      if name.startswith("x-riak-index-"):
+        field = name[len("x-riak-index-"):]
+        for value in ", ".join(self.headers.getheaders(name)).split(","):
+          indexes.add((field, _term(field, value.strip().decode("utf-8"))))
+      elif name.startswith("x-riak-meta-"):
+        meta[name] = self.headers.get(name)
+
+    links = [link.strip() for link in ", ".join(self.headers.getheaders("Link")).split(",")
+             if link.strip() and not _UP_LINK.search(link)]
+    content_type = self.headers.get("Content-Type", "application/octet-stream")
+    return self.server.put(bucket, key, body, content_type, indexes, links, meta)
+
+  def _send_object(self, status, bucket, key, obj, with_body, headers=None):
+    headers = dict(headers or {})
+    headers["X-Riak-Vclock"] = obj.vclock
+    headers["Last-Modified"] = obj.last_modified
+    headers["ETag"] = '"{0}"'.format(obj.vclock)
+    headers["Link"] = ", ".join(obj.links + ['</buckets/{0}>; rel="up"'.format(urllib.quote_plus(bucket.encode("utf-8")))])
+    for name, value in obj.meta.iteritems():
+      headers[name] = value
+
+    by_field = {}
+    for field, term in obj.indexes:
+      by_field.setdefault(field, []).append(unicode(term).encode("utf-8"))
+    for field, terms in by_field.iteritems():
+      headers["X-Riak-Index-" + field] = ", ".join(sorted(terms))
+
+    self._send(status, obj.data if with_body else "", obj.content_type, headers)
+
+  def _index(self, bucket, field, start, end):
+    params = self.params
+    # Riak only sends the terms of range queries, as those of an exact match
+    # are all the same.
+    return_terms = params.get("return_terms") == "true" and end is not None
+    max_results = int(params["max_results"]) if params.get("max_results") else None
+    term_regex = re.compile(params["term_regex"]) if params.get("term_regex") else None
+
+    results = self.server.query(bucket, field, start, end, term_regex)
+    if params.get("continuation"):
+      after = tuple(_decode_continuation(params["continuation"]))
+      results = [result for result in results if result > after]
+
+    continuation = None
+    if max_results is not None and len(results) >= max_results:
+      # Like Riak, a full page has a continuation even if nothing is after it.
+      results = results[:max_results]
+      continuation = _encode_continuation(*results[-1])
+
+    if return_terms:
+      items = [{unicode(term): key} for term, key in results]
+      name = "results"
+    else:
+      items = [key for _, key in results]
+      name = "keys"
+
+    if params.get("stream") != "true":
+      document = {name: items}
+      if continuation is not None:
+        document["continuation"] = continuation
+      self._send_json(200, document)
+      return
+
+    chunk = self.server.stream_chunk_size
+    documents = [{name: items[i:i + chunk]} for i in xrange(0, len(items), chunk)]
+    if continuation is not None:
+      documents.append({"continuation": continuation})
+
+    parts = []
+    for document in documents:
+      parts.append("\r\n--{0}\r\nContent-Type: application/json\r\n\r\n{1}".format(_BOUNDARY, json.dumps(document)))
+    parts.append("\r\n--{0}--\r\n".format(_BOUNDARY))
+    self._send_chunked("multipart/mixed; boundary=" + _BOUNDARY, parts)
+
+  def _send(self, status, body="", content_type=None, headers=None):
+    self.send_response(status)
+    if content_type is not None:
+      self.send_header("Content-Type", content_type)
+    for name, value in (headers or {}).iteritems():
+      self.send_header(name, value)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _send_json(self, status, document):
+    self._send(status, json.dumps(document), "application/json")
+
+  def _send_chunked(self, content_type, parts):
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Transfer-Encoding", "chunked")
+    self.end_headers()
+    for part in parts:
+      self.wfile.write("{0:x}\r\n{1}\r\n".format(len(part), part))
+      self.wfile.flush()
+    self.wfile.write("0\r\n\r\n")
+
+
+class FakeRiakServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """An in memory Riak node that speaks HTTP.
+
+  Each connection is served by its own thread.
+  """
+  daemon_threads = True
+
+  def __init__(self, address=("127.0.0.1", 0), latency=0.0, jitter=0.0, error_rate=0.0, seed=None,
+               stream_chunk_size=100):
+    """Binds the socket.
+
+    Args:
+      address: The (host, port) to listen on. The default port of 0 picks
+               a free one.
+      latency: The seconds every request for data waits before it is
+               answered.
+      jitter: Up to this many more seconds are waited, picked at random
+              for every request.
+      error_rate: The fraction of the requests for data answered with a
+                  503 instead.
+      seed: The seed of the random numbers of the jitter and errors.
+      stream_chunk_size: The number of keys in each message of a streamed
+                         query.
+    """
+    BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.stream_chunk_size = stream_chunk_size
+    self.requests = {}
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._vclocks = 0
+    self._thread = None
+    self.clear()
+
+  @property
+  def host(self):
+    return self.server_address[0]
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  def start(self):
+    """Serves requests in a thread until stop is called."""
+    # Polls often so that stop does not hold up the tests.
+    self._thread = threading.Thread(target=self.serve_forever, args=(0.05, ))
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+    self._thread.join()
+
+  def handle_error(self, request, client_address):
+    # Clients closing their pooled connections are not worth a traceback.
+    if not isinstance(sys.exc_info()[1], socket.error):
+      BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+  def client(self, **args):
+    """A RiakClient for this server. Needs riak-python-client."""
+    import riak
+    return riak.RiakClient(protocol="http", host=self.host, http_port=self.port, **args)
+
+  def clear(self):
+    """Deletes every object and resets the counts of requests."""
+    with self._lock:
+      # bucket -> key -> _Object
+      self._buckets = {}
+      # (bucket, field) -> term -> set of keys
+      self._indexes = {}
+      self.requests = {}
+
+  def delay(self, kind):
+    """Counts a request for data, then waits or fails like it is told to."""
+    with self._lock:
+      self.requests[kind] = self.requests.get(kind, 0) + 1
+      wait = self.latency + self._random.random() * self.jitter
+      fail = self._random.random() < self.error_rate
+
+    if wait:
+      time.sleep(wait)
+    if fail:
+      raise _HTTPError(503, "Injected error.")
+
+  def get(self, bucket, key):
+    with self._lock:
+      return self._buckets.get(bucket, {}).get(key)
+
+  def put(self, bucket, key, data, content_type, indexes, links, meta):
+    with self._lock:
+      self._vclocks += 1
+      obj = _Object(data, content_type, indexes, links, meta, base64.b64encode("fake:{0}".format(self._vclocks)))
+      self._unindex(bucket, key)
+      self._buckets.setdefault(bucket, {})[key] = obj
+      for field, term in indexes:
+        self._indexes.setdefault((bucket, field), {}).setdefault(term, set()).add(key)
+      return obj
+
+  def delete(self, bucket, key):
+    with self._lock:
+      if key not in self._buckets.get(bucket, {}):
+        return False
+      self._unindex(bucket, key)
+      del self._buckets[bucket][key]
+      return True
+
+  def _unindex(self, bucket, key):
+    obj = self._buckets.get(bucket, {}).get(key)
+    if obj is None:
+      return
+
+    for field, term in obj.indexes:
+      terms = self._indexes[(bucket, field)]
+      terms[term].discard(key)
+      if not terms[term]:
+        del terms[term]
+
+  def keys(self, bucket):
+    with self._lock:
+      return list(self._buckets.get(bucket, {}))
+
+  def query(self, bucket, field, start, end=None, term_regex=None):
+    """Returns the sorted (term, key) pairs matching an index query."""
+    with self._lock:
+      if field in ("$bucket", "$key"):
+        keys = self._buckets.get(bucket, {})
+        # The value of a $bucket query is not looked at.
+        if field == "$bucket":
+          results = [(key, key) for key in keys]
+        elif end is None:
+          results = [(key, key) for key in keys if key == start]
+        else:
+          results = [(key, key) for key in keys if start <= key <= end]
+      else:
+        terms = self._indexes.get((bucket, field), {})
+        start = _term(field, start)
+        if end is None:
+          results = [(start, key) for key in terms.get(start, ())]
+        else:
+          end = _term(field, end)
+          results = [(term, key) for term, keys in terms.iteritems() if start <= term <= end for key in keys]
+
+    if term_regex is not None:
+      results = [(term, key) for term, key in results if term_regex.match(unicode(term))]
+    results.sort()
+    return results
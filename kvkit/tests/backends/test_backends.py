@@ -24,7 +24,7 @@ try:
 except ImportError:
   pass
 
-from ...backends import leveldb, slow_memory
+from ...backends import cached, leveldb, slow_memory
 from ...backends import riak as riak_backend
 from ...document import Document
 from ...exceptions import NotFoundError
@@ -92,6 +92,26 @@ def create_testcase(BaseDocument, SimpleDocument, DocumentWithIndexes, name, cle
       with self.assertRaises(NotFoundError):
         doc.reload()
 
+    def test_delete_many(self):
+      self.assertEquals(0, backend.delete_many(DocumentWithIndexes, ["non-existent"]))
+
+      doc1 = DocumentWithIndexes(data={"string": "shared", "list": [1, 2]}).save()
+      doc2 = DocumentWithIndexes(data={"string": "shared", "list": [2]}).save()
+      doc3 = DocumentWithIndexes(data={"string": "shared"}).save()
+
+      self.assertEquals(2, backend.delete_many(DocumentWithIndexes, [doc1.key, doc2.key, doc1.key, "non-existent"]))
+
+      with self.assertRaises(NotFoundError):
+        backend.get(DocumentWithIndexes, doc1.key)
+
+      with self.assertRaises(NotFoundError):
+        backend.get(DocumentWithIndexes, doc2.key)
+
+      results = list(backend.index_keys_only(DocumentWithIndexes, "string", "shared"))
+      self.assertEquals([doc3.key], results)
+      results = list(backend.index_keys_only(DocumentWithIndexes, "list", 2))
+      self.assertEquals(0, len(results))
+
     def test_get(self):
       with self.assertRaises(NotFoundError):
         backend.get(SimpleDocument, "non-existent")
@@ -100,6 +120,21 @@ def create_testcase(BaseDocument, SimpleDocument, DocumentWithIndexes, name, cle
       v, _ = backend.get(SimpleDocument, doc.key)
       self.assertEquals(doc.serialize(), v)
 
+    def test_get_many(self):
+      doc1 = SimpleDocument(data={"number": 1}).save()
+      doc2 = SimpleDocument(data={"number": 2}).save()
+      other = DocumentWithIndexes().save()
+
+      results = backend.get_many(SimpleDocument, [doc2.key, "non-existent", doc1.key, other.key, doc2.key])
+      self.assertEquals(5, len(results))
+      self.assertEquals(doc2.serialize(), results[0][0])
+      self.assertEquals(None, results[1])
+      self.assertEquals(doc1.serialize(), results[2][0])
+      self.assertEquals(None, results[3])
+      self.assertEquals(doc2.serialize(), results[4][0])
+
+      self.assertEquals([], backend.get_many(SimpleDocument, []))
+
     def test_index(self):
 
       # Testing no indexed
@@ -217,6 +252,27 @@ def create_testcase(BaseDocument, SimpleDocument, DocumentWithIndexes, name, cle
       self.assertEquals(1, len(results))
       self.assertEquals(doc7.key, results[0])
 
+    def test_index_terms(self):
+      if not hasattr(backend, "index_terms"):
+        self.skipTest("index_terms is optional")
+
+      DocumentWithIndexes("t1", data={"string": "abc", "number": 4, "list": ["a", "b", "z"]}).save()
+      DocumentWithIndexes("t2", data={"string": "bcd", "number": 5.5, "list": ["b"]}).save()
+      DocumentWithIndexes("t3", data={"string": "abc", "number": 6}).save()
+
+      self.assertEquals([("abc", "t1"), ("abc", "t3")], list(DocumentWithIndexes.index_terms("string", "abc")))
+      self.assertEquals([(4.0, "t1"), (5.5, "t2")], list(DocumentWithIndexes.index_terms("number", 4, 5.5)))
+
+      # Every value in the range comes with its document.
+      terms = list(DocumentWithIndexes.index_terms("list", "a", "b"))
+      self.assertEquals([("a", "t1"), ("b", "t1"), ("b", "t2")], terms)
+
+      page = DocumentWithIndexes.index_terms("string", "abc", "bcd", limit=2)
+      self.assertEquals([("abc", "t1"), ("abc", "t3")], list(page))
+      page = DocumentWithIndexes.index_terms("string", "abc", "bcd", limit=2, continuation=page.continuation)
+      self.assertEquals([("bcd", "t2")], list(page))
+      self.assertEquals(None, page.continuation)
+
     # def test_init_class(self):
     # def test_init_document(self):
     # These methods do not exist because they are tested during the course of
@@ -280,6 +336,50 @@ def create_testcase(BaseDocument, SimpleDocument, DocumentWithIndexes, name, cle
       self.assertTrue(doc1.key in results)
       self.assertTrue(doc2.key in results)
 
+    def test_list_all_keys_paging(self):
+      keys = ["k1", "k2", "k3", "k4", "k5"]
+      for key in keys:
+        SimpleDocument(key).save()
+
+      page = backend.list_all_keys(SimpleDocument, limit=2)
+      self.assertEquals(["k1", "k2"], list(page))
+      self.assertNotEquals(None, page.continuation)
+
+      page = backend.list_all_keys(SimpleDocument, limit=2, continuation=page.continuation)
+      self.assertEquals(["k3", "k4"], list(page))
+
+      page = backend.list_all_keys(SimpleDocument, limit=2, continuation=page.continuation)
+      self.assertEquals(["k5"], list(page))
+      self.assertEquals(None, page.continuation)
+
+      try:
+        page = backend.list_all_keys(SimpleDocument, limit=3, reverse=True)
+      except NotImplementedError:
+        return
+
+      self.assertEquals(["k5", "k4", "k3"], list(page))
+      page = backend.list_all_keys(SimpleDocument, limit=3, reverse=True, continuation=page.continuation)
+      self.assertEquals(["k2", "k1"], list(page))
+      self.assertEquals(None, page.continuation)
+
+    def test_index_paging(self):
+      for key in ("i1", "i2", "i3"):
+        DocumentWithIndexes(key, data={"string": "paged", "list": [1, 2]}).save()
+      DocumentWithIndexes("i4", data={"string": "other"}).save()
+
+      page = backend.index(DocumentWithIndexes, "string", "paged", limit=2)
+      self.assertEquals(["i1", "i2"], [k for k, _, _ in page])
+      self.assertEquals("paged", page[0][1]["string"])
+
+      page = backend.index(DocumentWithIndexes, "string", "paged", limit=2, continuation=page.continuation)
+      self.assertEquals(["i3"], [k for k, _, _ in page])
+      self.assertEquals(None, page.continuation)
+
+      # Documents matching more than one value in the range only show up once
+      # within a page.
+      page = backend.index_keys_only(DocumentWithIndexes, "list", 1, 2, limit=10)
+      self.assertEquals(["i1", "i2", "i3"], sorted(page))
+
     # Seems a bit repetitive :P
     def test_save(self):
       doc1 = SimpleDocument("test-key", data={"number": 1})
@@ -289,6 +389,49 @@ def create_testcase(BaseDocument, SimpleDocument, DocumentWithIndexes, name, cle
       doc = SimpleDocument.get("test-key")
       self.assertEquals(1, doc.number)
 
+    def test_save_many(self):
+      doc1 = DocumentWithIndexes(data={"string": "shared", "list": [1, 2]})
+      doc2 = DocumentWithIndexes(data={"string": "shared", "list": [2, 3]})
+      doc3 = DocumentWithIndexes(data={"string": "other"})
+      backend.save_many(DocumentWithIndexes, [(doc, doc.key, doc.serialize()) for doc in (doc1, doc2, doc3)])
+
+      for doc in (doc1, doc2, doc3):
+        v, _ = backend.get(DocumentWithIndexes, doc.key)
+        self.assertEquals(doc.serialize(), v)
+
+      results = list(backend.index_keys_only(DocumentWithIndexes, "string", "shared"))
+      self.assertEquals(2, len(results))
+      self.assertTrue(doc1.key in results)
+      self.assertTrue(doc2.key in results)
+
+      results = list(backend.index_keys_only(DocumentWithIndexes, "list", 2))
+      self.assertEquals(2, len(results))
+
+      doc2.string = "other"
+      doc2.list = [3]
+      backend.save_many(DocumentWithIndexes, [(doc2, doc2.key, doc2.serialize())])
+
+      results = list(backend.index_keys_only(DocumentWithIndexes, "string", "shared"))
+      self.assertEquals([doc1.key], results)
+
+      results = list(backend.index_keys_only(DocumentWithIndexes, "string", "other"))
+      self.assertEquals(2, len(results))
+
+      results = list(backend.index_keys_only(DocumentWithIndexes, "list", 2))
+      self.assertEquals([doc1.key], results)
+
+    def test_save_loaded_document_indexes(self):
+      doc = DocumentWithIndexes(data={"string": "abc", "list": [1, 2], "number": 1}).save()
+      doc = DocumentWithIndexes.get(doc.key)
+      doc.number = 2
+      doc.list.append(3)
+      doc.save()
+
+      self.assertEquals([doc.key], list(backend.index_keys_only(DocumentWithIndexes, "string", "abc")))
+      self.assertEquals([doc.key], list(backend.index_keys_only(DocumentWithIndexes, "number", 2.0)))
+      self.assertEquals(0, len(list(backend.index_keys_only(DocumentWithIndexes, "number", 1.0))))
+      self.assertEquals([doc.key], list(backend.index_keys_only(DocumentWithIndexes, "list", 3)))
+
     def test_save_with_key_change(self):
       doc1 = SimpleDocument("test-key", data={"number": 1})
       data = doc1.serialize()
@@ -323,6 +466,21 @@ SlowMemoryBackendTest = create_testcase(SlowMemoryBaseDocument,
                                         "SlowMemoryBackendTest",
                                         slow_memory.cleardb)
 
+# Cached slow memory tests
+
+cached_slow_memory = cached.CachedBackend(slow_memory, cache_indexes=True)
+CachedBaseDocument, CachedSimpleDocument, CachedDocumentWithIndexes = create_base_documents(cached_slow_memory)
+
+def cached_slow_memory_clear():
+  slow_memory.cleardb()
+  cached_slow_memory.clear_cache()
+
+CachedSlowMemoryBackendTest = create_testcase(CachedBaseDocument,
+                                              CachedSimpleDocument,
+                                              CachedDocumentWithIndexes,
+                                              "CachedSlowMemoryBackendTest",
+                                              cached_slow_memory_clear)
+
 # Leveldb tests
 
 if leveldb.available:
@@ -339,9 +497,10 @@ if leveldb.available:
     SimpleDocument.close_leveldb_connections()
     DocumentWithIndexes.close_leveldb_connections()
 
-    shutil.rmtree(SimpleDocument._leveldb_options["db"])
-    shutil.rmtree(DocumentWithIndexes._leveldb_options["db"])
-    shutil.rmtree(DocumentWithIndexes._leveldb_options["indexdb"])
+    # The dbs are opened lazily, so they may not have been created yet.
+    shutil.rmtree(SimpleDocument._leveldb_options["db"], ignore_errors=True)
+    shutil.rmtree(DocumentWithIndexes._leveldb_options["db"], ignore_errors=True)
+    shutil.rmtree(DocumentWithIndexes._leveldb_options["indexdb"], ignore_errors=True)
 
     SimpleDocument.open_leveldb_connections()
     DocumentWithIndexes.open_leveldb_connections()
@@ -352,6 +511,26 @@ if leveldb.available:
                                        "LeveldbBackendTest",
                                        leveldb_clear)
 
+  SharedLevelDBBaseDocument, SharedSimpleDocument, SharedDocumentWithIndexes = create_base_documents(leveldb,
+      (None, "_leveldb_options", "_leveldb_options"),
+      (None, {"shared": "dbs/test_shared"}, {"shared": "dbs/test_shared"})
+  )
+
+  def shared_leveldb_clear():
+    SharedSimpleDocument.close_leveldb_connections()
+    SharedDocumentWithIndexes.close_leveldb_connections()
+
+    shutil.rmtree("dbs/test_shared", ignore_errors=True)
+
+    SharedSimpleDocument.open_leveldb_connections()
+    SharedDocumentWithIndexes.open_leveldb_connections()
+
+  SharedLeveldbBackendTest = create_testcase(SharedLevelDBBaseDocument,
+                                             SharedSimpleDocument,
+                                             SharedDocumentWithIndexes,
+                                             "SharedLeveldbBackendTest",
+                                             shared_leveldb_clear)
+
 if riak_backend.available:
   client = riak.RiakClient()
   simple_bucket = client.bucket("test_kvkit_simple_document")
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import time
+import unittest
+
+from ...backends import cached, slow_memory
+from ...document import Document
+from ...exceptions import NotFoundError
+from ...properties.standard import StringProperty, ListProperty
+
+backend = cached.CachedBackend(slow_memory, max_entries=3, cache_indexes=True)
+
+class CachedDocument(Document):
+  _backend = backend
+
+  name = StringProperty(index=True)
+  tags = ListProperty()
+
+class ProjectingBackend(object):
+  """A backend that answers projection queries itself, like LevelDB with a
+  covering index."""
+  supports_projection = True
+
+  def __init__(self):
+    self.queries = []
+
+  def __getattr__(self, name):
+    return getattr(slow_memory, name)
+
+  def index(self, cls, field, start_value, end_value=None, **args):
+    self.queries.append(args)
+    return [("k1", dict((name, "meow") for name in args.get("fields", ["name", "tags"])), None)]
+
+class CachedBackendTest(unittest.TestCase):
+  def tearDown(self):
+    slow_memory.cleardb()
+    backend.clear_cache()
+
+  def test_read_through(self):
+    hits = backend.stats()["documents"]["hits"]
+    doc = CachedDocument(data={"name": "meow"}).save()
+    # Bypass the cache to prove the reads come from memory.
+    slow_memory.delete(CachedDocument, doc.key)
+
+    loaded = CachedDocument.get(doc.key)
+    self.assertEquals("meow", loaded.name)
+
+    # Mutating a loaded document must not change the cached copy.
+    loaded.tags.append("changed")
+    self.assertEquals([], CachedDocument.get(doc.key).tags)
+
+    self.assertEquals(hits + 2, backend.stats()["documents"]["hits"])
+
+    backend.clear_cache()
+    with self.assertRaises(NotFoundError):
+      CachedDocument.get(doc.key)
+
+  def test_eviction(self):
+    before = backend.stats()["documents"]["evictions"]
+    docs = [CachedDocument().save() for i in xrange(5)]
+    stats = backend.stats()["documents"]
+    self.assertEquals(3, stats["entries"])
+    self.assertEquals(before + 2, stats["evictions"])
+    self.assertFalse((CachedDocument.__name__, docs[0].key) in backend.documents)
+    self.assertTrue((CachedDocument.__name__, docs[4].key) in backend.documents)
+
+  def test_delete_invalidates(self):
+    doc = CachedDocument().save()
+    doc.delete()
+    with self.assertRaises(NotFoundError):
+      CachedDocument.get(doc.key)
+
+  def test_index_cache(self):
+    doc = CachedDocument(data={"name": "meow"}).save()
+    self.assertEquals([doc.key], CachedDocument.index_keys_only("name", "meow"))
+    self.assertEquals([doc.key], CachedDocument.index_keys_only("name", "meow"))
+    self.assertEquals(1, backend.stats()["indexes"]["entries"])
+
+    # Changing a field that is not indexed keeps the index results.
+    doc.tags = ["a"]
+    doc.save()
+    self.assertEquals(1, backend.stats()["indexes"]["entries"])
+
+    doc.name = "quack"
+    doc.save()
+    self.assertEquals(0, backend.stats()["indexes"]["entries"])
+    self.assertEquals([], CachedDocument.index_keys_only("name", "meow"))
+
+  def test_projection(self):
+    doc = CachedDocument(data={"name": "meow", "tags": ["a"]}).save()
+    slow_memory.delete(CachedDocument, doc.key)
+
+    data, _ = backend.get(CachedDocument, doc.key, fields=["name"])
+    self.assertEquals({"name": "meow"}, data)
+
+    record = CachedDocument.get(doc.key, fields=["tags"])
+    self.assertEquals(["a"], record.tags)
+    record.tags.append("b")
+    self.assertEquals(["a"], CachedDocument.get(doc.key).tags)
+
+  def test_projected_index(self):
+    projecting = ProjectingBackend()
+    wrapper = cached.CachedBackend(projecting)
+    results = list(wrapper.index(CachedDocument, "name", "meow", fields=["name"]))
+    self.assertEquals([("k1", {"name": "meow"}, None)], results)
+    self.assertEquals(["name"], projecting.queries[0]["fields"])
+    # Only a part of the document was read, so it is not cached.
+    self.assertEquals(0, len(wrapper.documents))
+
+    list(wrapper.index(CachedDocument, "name", "meow"))
+    self.assertEquals(1, len(wrapper.documents))
+
+  def test_ttl(self):
+    cache = cached.LRUCache(ttl=0.01)
+    cache.put("k", {"a": 1})
+    self.assertEquals({"a": 1}, cache.get("k"))
+    time.sleep(0.02)
+    self.assertEquals(None, cache.get("k"))
+
+  def test_max_bytes(self):
+    cache = cached.LRUCache(max_bytes=20)
+    cache.put("a", {"v": "0123456789"})
+    cache.put("b", {"v": "0123456789"})
+    self.assertFalse("a" in cache)
+    self.assertTrue("b" in cache)
+    self.assertEquals(1, cache.stats()["evictions"])
+
+if __name__ == "__main__":
+  unittest.main()
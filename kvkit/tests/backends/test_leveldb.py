@@ -0,0 +1,932 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from datetime import datetime
+from StringIO import StringIO
+import gc
+import json
+import os
+import shutil
+import sys
+import unittest
+import weakref
+
+from ... import reindex
+from ...backends import leveldb
+from ...document import Document
+from ...properties import DateTimeProperty, ListProperty, NumberProperty, StringProperty
+
+if leveldb.available:
+  import plyvel
+
+DB_PATH = "dbs/test_leveldb_indexes"
+INDEXDB_PATH = "dbs/test_leveldb_indexes.indexes"
+
+def make_document_class(**options):
+  opts = {"db": DB_PATH, "indexdb": INDEXDB_PATH}
+  opts.update(options)
+
+  class IndexedDocument(Document):
+    _backend = leveldb
+    _leveldb_options = opts
+
+    status = StringProperty(index=True)
+    tags = ListProperty(index=True)
+    score = NumberProperty(index=True)
+    when = DateTimeProperty(index=True, default=None)
+
+  return IndexedDocument
+
+def remove_dbs():
+  for path in (DB_PATH, INDEXDB_PATH):
+    if os.path.exists(path):
+      shutil.rmtree(path)
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBRebuildTest(unittest.TestCase):
+  def setUp(self):
+    self.cls = None
+    remove_dbs()
+
+    db = plyvel.DB(DB_PATH, create_if_missing=True)
+    db.put("a", json.dumps({"status": "active", "tags": ["x", "y"], "score": 10}))
+    db.put("b", json.dumps({"status": "active", "tags": ["y"], "score": 9}))
+    db.close()
+
+  def tearDown(self):
+    if self.cls is not None:
+      self.cls.close_leveldb_connections()
+
+  def make_version_1(self):
+    indexdb = plyvel.DB(INDEXDB_PATH, create_if_missing=True)
+    indexdb.put("status~active", json.dumps(["a", "b"]))
+    indexdb.put("tags~x", json.dumps(["a"]))
+    indexdb.put("tags~y", json.dumps(["a", "b"]))
+    indexdb.close()
+
+  def make_version_2(self):
+    indexdb = plyvel.DB(INDEXDB_PATH, create_if_missing=True)
+    indexdb.put(leveldb._VERSION_KEY, "2")
+    for entry in ("status\x00active\x00a", "status\x00active\x00b", "score\x0010\x00a", "score\x009\x00b"):
+      indexdb.put(entry, "")
+    indexdb.close()
+
+  def test_old_layouts_refused(self):
+    self.make_version_1()
+    cls = make_document_class()
+    with self.assertRaises(RuntimeError):
+      cls.open_leveldb_connections()
+    # Using the class tries to open it again.
+    with self.assertRaises(RuntimeError):
+      cls.get("a")
+
+    remove_dbs()
+    self.make_version_2()
+    with self.assertRaises(RuntimeError):
+      make_document_class(lazy=False)
+
+  def test_rebuild_on_open(self):
+    self.make_version_1()
+    self.cls = make_document_class(rebuild_indexes=True)
+    self.assertEquals(["a", "b"], list(self.cls.index_keys_only("tags", "y")))
+    self.assertEquals(["a"], list(self.cls.index_keys_only("tags", "x")))
+    self.assertEquals(["b", "a"], list(self.cls.index_keys_only("score", 0, 100)))
+
+    self.cls.close_leveldb_connections()
+    self.cls = make_document_class()
+    self.assertEquals(["a", "b"], list(self.cls.index_keys_only("status", "active")))
+
+  def test_rebuild(self):
+    self.make_version_2()
+    self.cls = make_document_class(rebuild_indexes=True)
+    self.assertEquals(2, leveldb.rebuild_indexes(self.cls, batch_size=1))
+    self.assertEquals(["b", "a"], list(self.cls.index_keys_only("score", 0, 100)))
+    self.assertEquals(["a", "b"], list(self.cls.index_keys_only("status", "active")))
+
+  def unindexed_document(self):
+    # Only the rebuilt index has it.
+    leveldb._data_db(self.cls).put("d", json.dumps({"status": "active", "tags": ["y"], "score": 1}))
+
+  def test_rebuild_during_query(self):
+    self.make_version_2()
+    self.cls = make_document_class(rebuild_indexes=True)
+    self.unindexed_document()
+    it = self.cls.index_keys_only("status", "active")
+    self.assertEquals("a", next(it))
+
+    # The old index is still read by the query, so it is not replaced yet,
+    # and documents saved meanwhile go to both.
+    self.assertEquals(3, self.cls.rebuild_indexes())
+    self.cls(key="c", data={"status": "active", "tags": ["z"], "score": 1}).save()
+    self.assertTrue(os.path.exists(INDEXDB_PATH + ".rebuild"))
+    self.assertEquals(["c"], list(self.cls.index_keys_only("tags", "z")))
+    with self.assertRaises(RuntimeError):
+      self.cls.rebuild_indexes()
+
+    self.assertEquals(["b"], list(it))
+    self.assertFalse(os.path.exists(INDEXDB_PATH + ".rebuild"))
+    self.assertFalse(os.path.exists(INDEXDB_PATH + ".old"))
+    self.assertEquals(["a", "b", "c", "d"], list(self.cls.index_keys_only("status", "active")))
+    self.assertEquals(["c"], list(self.cls.index_keys_only("tags", "z")))
+
+  def test_rebuild_during_snapshot(self):
+    self.make_version_2()
+    self.cls = make_document_class(rebuild_indexes=True)
+    self.unindexed_document()
+    with self.cls.snapshot():
+      self.cls.rebuild_indexes()
+      self.assertEquals(["a", "b"], list(self.cls.index_keys_only("tags", "y")))
+
+    self.assertEquals(["a", "b", "d"], list(self.cls.index_keys_only("tags", "y")))
+
+  def test_close_during_query(self):
+    self.make_version_2()
+    self.cls = make_document_class(rebuild_indexes=True)
+    self.unindexed_document()
+    it = self.cls.index_keys_only("status", "active")
+    next(it)
+    self.cls.rebuild_indexes()
+
+    # Closing ends the query and replaces the index.
+    self.cls.close_leveldb_connections()
+    self.assertFalse(os.path.exists(INDEXDB_PATH + ".rebuild"))
+    self.assertEquals(["a", "b", "d"], list(self.cls.index_keys_only("tags", "y")))
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBIndexTest(unittest.TestCase):
+  def setUp(self):
+    remove_dbs()
+    self.cls = make_document_class()
+
+  def tearDown(self):
+    self.cls.close_leveldb_connections()
+
+  def save(self, key, **data):
+    return self.cls(key=key, data=data).save()
+
+  def test_encoding_order(self):
+    values = [float("-inf"), -1e100, -10, -9.5, -1, -0.0, 0, 1e-300, 1, 9, 9.5, 10, 1e100, float("inf"),
+              "", "\x00", "\x00\x00", "a", "a\x00", "a\x00b", "ab", "a~b", u"é"]
+    encoded = [leveldb._encode_value(value) for value in values]
+    self.assertEquals(sorted(encoded), encoded)
+    self.assertEquals(leveldb._encode_value(0.0), leveldb._encode_value(-0.0))
+    self.assertEquals(leveldb._encode_value(3), leveldb._encode_value(3.0))
+
+    for value in ("ab", "a\x00b", u"é", 10, -2.5):
+      entry = leveldb._index_entry("field", value, "some\x00key")
+      self.assertEquals("some\x00key", leveldb._entry_key(entry, "field"))
+      self.assertEquals(value, leveldb._entry_value(entry, "field"))
+
+    for value in values:
+      self.assertEquals(value, leveldb._entry_value(leveldb._index_entry("field", value, "k"), "field"))
+
+  def test_numeric_ranges(self):
+    for i, score in enumerate([-10, -9.5, -1, 0, 1, 2, 9, 10, 11, 100]):
+      self.save("k{0}".format(i), score=score)
+
+    self.assertEquals(["k5", "k6", "k7", "k8"], list(self.cls.index_keys_only("score", 2, 11)))
+    self.assertEquals(["k0", "k1", "k2", "k3"], list(self.cls.index_keys_only("score", -10, 0)))
+    self.assertEquals(["k1", "k2"], list(self.cls.index_keys_only("score", "-9.5", -0.5)))
+    self.assertEquals(["k7"], list(self.cls.index_keys_only("score", 10)))
+    self.assertEquals(["k7"], list(self.cls.index_keys_only("score", 10.0)))
+    self.assertEquals(["k9", "k8"], list(self.cls.index_keys_only("score", 10.5, 1000, reverse=True)))
+
+    page = self.cls.index_keys_only("score", -100, 100, limit=4)
+    self.assertEquals(["k0", "k1", "k2", "k3"], page)
+    page = self.cls.index_keys_only("score", -100, 100, limit=4, continuation=page.continuation)
+    self.assertEquals(["k4", "k5", "k6", "k7"], page)
+
+  def test_string_collisions(self):
+    self.save("k1", status="ab")
+    self.save("k2", status="a~b")
+    self.save("k3", status="a")
+    self.save("k4", status="a\x00b")
+    self.save("k5", status=u"actif é", tags=["y", "z"])
+
+    self.assertEquals(["k1"], list(self.cls.index_keys_only("status", "ab")))
+    self.assertEquals(["k2"], list(self.cls.index_keys_only("status", "a~b")))
+    self.assertEquals(["k3"], list(self.cls.index_keys_only("status", "a")))
+    self.assertEquals(["k4"], list(self.cls.index_keys_only("status", "a\x00b")))
+    self.assertEquals(["k5"], list(self.cls.index_keys_only("status", u"actif é")))
+    self.assertEquals(["k3", "k4", "k1", "k5"], list(self.cls.index_keys_only("status", "a", "actif é")))
+    self.assertEquals(["k5"], list(self.cls.index_keys_only("tags", "z")))
+
+    doc = self.cls.get("k5")
+    doc.tags = ["y"]
+    doc.save()
+    self.assertEquals([], list(self.cls.index_keys_only("tags", "z")))
+    self.assertEquals(["k5"], list(self.cls.index_keys_only("tags", "a", "y")))
+
+  def test_datetime_ranges(self):
+    self.save("k1", when=datetime(2013, 5, 1, 12))
+    self.save("k2", when=datetime(2013, 5, 2, 12))
+    self.save("k3", when=datetime(2014, 1, 1))
+
+    self.assertEquals(["k1", "k2"], list(self.cls.index_keys_only("when", datetime(2013, 5, 1), datetime(2013, 5, 3))))
+    self.assertEquals(["k3"], list(self.cls.index_keys_only("when", datetime(2014, 1, 1))))
+    self.assertEquals(["k2", "k3"], [doc.key for doc in self.cls.index("when", datetime(2013, 5, 2), datetime(2015, 1, 1))])
+
+  def test_compact_document(self):
+    class CompactDocument(Document):
+      __compact__ = True
+      _backend = leveldb
+      _leveldb_options = {"db": DB_PATH, "indexdb": INDEXDB_PATH}
+
+      status = StringProperty(index=True)
+
+    try:
+      CompactDocument(key="k1", data={"status": "a"}).save()
+      doc = CompactDocument.get("k1")
+      # The indexes kept by the backend have a slot, so no __dict__ is made.
+      self.assertFalse(any(isinstance(r, dict) and r is not doc._leveldb_old_indexes for r in gc.get_referents(doc)))
+
+      doc.status = "b"
+      doc.save()
+      self.assertEquals([], list(CompactDocument.index_keys_only("status", "a")))
+      self.assertEquals(["k1"], list(CompactDocument.index_keys_only("status", "b")))
+    finally:
+      CompactDocument.close_leveldb_connections()
+
+  def test_lazy_list_modified_in_place(self):
+    class LazyDocument(Document):
+      _backend = leveldb
+      _leveldb_options = {"db": DB_PATH, "indexdb": INDEXDB_PATH}
+
+      tags = ListProperty(index=True, load_on_demand=True)
+
+    try:
+      LazyDocument(key="k1", data={"tags": ["t"]}).save()
+      doc = LazyDocument.get("k1")
+      doc.tags.append("u")
+      doc.save()
+      self.assertEquals(["k1"], list(LazyDocument.index_keys_only("tags", "u")))
+    finally:
+      LazyDocument.close_leveldb_connections()
+
+  def test_index_terms(self):
+    self.save("k1", score=-9.5, when=datetime(2013, 5, 1, 12))
+    self.save("k2", score=10, when=datetime(2014, 1, 1))
+    self.save("k3", status=u"actif é", tags=["y", "z"])
+
+    self.assertEquals([(-9.5, "k1"), (10.0, "k2")], list(self.cls.index_terms("score", -100, 100)))
+    self.assertEquals([(10.0, "k2"), (-9.5, "k1")], list(self.cls.index_terms("score", -100, 100, reverse=True)))
+    self.assertEquals([(datetime(2014, 1, 1), "k2")], list(self.cls.index_terms("when", datetime(2014, 1, 1))))
+    self.assertEquals([(u"actif é", "k3")], list(self.cls.index_terms("status", "a", "b")))
+    self.assertEquals([("y", "k3"), ("z", "k3")], list(self.cls.index_terms("tags", "a", "z")))
+
+def check_snapshot(test, cls):
+  for key in ("a", "b", "c"):
+    cls(key=key, data={"title": "t" + key}).save()
+
+  with cls.snapshot():
+    keys = cls.index_keys_only("title", "a", "z")
+    docs = cls.index("title", "a", "z")
+    page = cls.list_all(limit=2)
+    next(keys)
+    next(docs)
+
+    doc = cls.get("a")
+    doc.title = "changed"
+    doc.save()
+    cls.delete_key("b")
+    cls(key="d", data={"title": "td"}).save()
+
+    with cls.snapshot():
+      test.assertEquals("ta", cls.get("a").title)
+
+    test.assertEquals("ta", cls.get("a").title)
+    test.assertEquals(["ta", "tb", "tc"], [d.title for d in cls.get_many(["a", "b", "c", "d"])])
+    test.assertEquals(["b", "c"], list(keys))
+    test.assertEquals(["tb", "tc"], [d.title for d in docs])
+    test.assertEquals(["a", "b", "c"], list(cls.list_all_keys()))
+    test.assertEquals(["c"], [d.key for d in cls.list_all(continuation=page.continuation)])
+    test.assertEquals(["a", "b", "c"], list(cls.index_keys_only("title", "ta", "tc")))
+    test.assertEquals([], list(cls.index_keys_only("title", "changed")))
+
+  test.assertEquals("changed", cls.get("a").title)
+  test.assertEquals(["a", "c", "d"], list(cls.list_all_keys()))
+  test.assertEquals(["a"], list(cls.index_keys_only("title", "changed")))
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBSnapshotTest(unittest.TestCase):
+  def setUp(self):
+    remove_dbs()
+
+    class Post(Document):
+      _backend = leveldb
+      _leveldb_options = {"db": DB_PATH, "indexdb": INDEXDB_PATH}
+
+      title = StringProperty(index=True)
+
+    self.Post = Post
+
+  def tearDown(self):
+    self.Post.close_leveldb_connections()
+
+  def test_snapshot(self):
+    check_snapshot(self, self.Post)
+
+  def test_deleted_documents_skipped(self):
+    self.Post(key="a", data={"title": "ta"}).save()
+    self.Post(key="b", data={"title": "tb"}).save()
+    docs = self.Post.index("title", "ta", "tb")
+    self.Post._leveldb_meta["db"].delete("a")
+    self.assertEquals(["b"], [d.key for d in docs])
+
+# Set by LevelDBOnlineRebuildTest for kvkit.reindex to find.
+REINDEX_CLASS = None
+
+def check_online_rebuild(test, make_class):
+  Post = make_class(False)
+  for i in xrange(20):
+    Post(key="k{0:02d}".format(i), data={"title": "t{0}".format(i % 4)}).save()
+  Post.close_leveldb_connections()
+
+  # index=True added to a property that already has values.
+  test.Post = Post = make_class(True)
+  test.assertEquals([], list(Post.index_keys_only("title", "t0")))
+
+  writes = []
+  def progress(stage, count, elapsed):
+    writes.append((stage, count))
+    if (stage, count) == ("read", 5):
+      # Before the entries of the snapshot are written.
+      doc = Post.get("k00")
+      doc.title = "changed"
+      doc.save()
+      Post.delete_key("k01")
+    elif (stage, count) == ("write", 10):
+      # After some of the entries of the snapshot are written.
+      doc = Post.get("k19")
+      doc.title = "changed"
+      doc.save()
+      Post.delete_many(["k02", "k03"])
+      Post(key="new", data={"title": "t0"}).save()
+
+  test.assertEquals(20, Post.rebuild_indexes(batch_size=1, memory_limit=10, progress=progress))
+  test.assertEquals(("read", 20), writes[19])
+  test.assertEquals(("write", 20), writes[-1])
+
+  test.assertEquals(["k04", "k08", "k12", "k16", "new"], list(Post.index_keys_only("title", "t0")))
+  test.assertEquals(["k05", "k09", "k13", "k17"], list(Post.index_keys_only("title", "t1")))
+  test.assertEquals(["k06", "k10", "k14", "k18"], list(Post.index_keys_only("title", "t2")))
+  test.assertEquals(["k07", "k11", "k15"], list(Post.index_keys_only("title", "t3")))
+  test.assertEquals(["k00", "k19"], list(Post.index_keys_only("title", "changed")))
+
+  # The new index is kept after reopening.
+  Post.close_leveldb_connections()
+  test.Post = Post = make_class(True)
+  test.assertEquals(["k00", "k19"], list(Post.index_keys_only("title", "changed")))
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBOnlineRebuildTest(unittest.TestCase):
+  def setUp(self):
+    remove_dbs()
+    if os.path.exists(SHARED_PATH):
+      shutil.rmtree(SHARED_PATH)
+    self.Post = None
+
+  def tearDown(self):
+    global REINDEX_CLASS
+    REINDEX_CLASS = None
+    if self.Post is not None:
+      self.Post.close_leveldb_connections()
+
+  def make_class(self, options):
+    def make(indexed):
+      class Post(Document):
+        _backend = leveldb
+        _leveldb_options = options
+
+        title = StringProperty(index=indexed)
+
+      return Post
+    return make
+
+  def test_separate_dbs(self):
+    check_online_rebuild(self, self.make_class({"db": DB_PATH, "indexdb": INDEXDB_PATH}))
+    self.assertFalse(os.path.exists(INDEXDB_PATH + ".rebuild"))
+    self.assertFalse(os.path.exists(INDEXDB_PATH + ".old"))
+
+  def test_shared_db(self):
+    check_online_rebuild(self, self.make_class({"shared": SHARED_PATH}))
+    root = self.Post._leveldb_meta["shared"]
+    self.assertEquals("j", root.get("Post" + leveldb._INDEX_NAME_KEY))
+    with root.iterator(include_value=False, prefix="Post\x00i") as it:
+      self.assertEquals([], list(it))
+
+    self.Post.rebuild_indexes()
+    self.assertEquals("i", root.get("Post" + leveldb._INDEX_NAME_KEY))
+    self.assertEquals(["k00", "k19"], list(self.Post.index_keys_only("title", "changed")))
+
+  def test_interrupted_swap(self):
+    self.Post = self.make_class({"db": DB_PATH, "indexdb": INDEXDB_PATH})(True)
+    self.Post(key="a", data={"title": "ta"}).save()
+    self.Post.rebuild_indexes()
+    self.Post.close_leveldb_connections()
+
+    # As if the process died between the two renames.
+    os.rename(INDEXDB_PATH, INDEXDB_PATH + ".rebuild")
+    self.Post.open_leveldb_connections()
+    self.assertEquals(["a"], list(self.Post.index_keys_only("title", "ta")))
+
+  def test_failed_rebuild(self):
+    self.Post = self.make_class({"db": DB_PATH, "indexdb": INDEXDB_PATH})(True)
+    self.Post(key="a", data={"title": "ta"}).save()
+
+    def progress(stage, count, elapsed):
+      raise KeyboardInterrupt
+
+    with self.assertRaises(KeyboardInterrupt):
+      self.Post.rebuild_indexes(progress=progress)
+
+    self.assertFalse(os.path.exists(INDEXDB_PATH + ".rebuild"))
+    self.Post(key="b", data={"title": "ta"}).save()
+    self.assertEquals(["a", "b"], list(self.Post.index_keys_only("title", "ta")))
+
+  def test_reindex_command(self):
+    global REINDEX_CLASS
+    Post = self.make_class({"db": DB_PATH, "indexdb": INDEXDB_PATH})(False)
+    Post(key="a", data={"title": "ta"}).save()
+    Post.close_leveldb_connections()
+    REINDEX_CLASS = self.Post = self.make_class({"db": DB_PATH, "indexdb": INDEXDB_PATH})(True)
+
+    out = StringIO()
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+      reindex.main([__name__ + ":REINDEX_CLASS", "--batch-size", "1"])
+    finally:
+      sys.stdout = stdout
+
+    self.assertTrue("read: 1 (" in out.getvalue())
+    self.assertTrue("Indexed 1 documents of Post." in out.getvalue())
+    self.assertEquals(["a"], list(self.Post.index_keys_only("title", "ta")))
+
+class NoReads(object):
+  def __getattr__(self, name):
+    raise AssertionError("The data db was read.")
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBCoveringTest(unittest.TestCase):
+  def setUp(self):
+    remove_dbs()
+
+    class Person(Document):
+      _backend = leveldb
+      _leveldb_options = {"db": DB_PATH, "indexdb": INDEXDB_PATH}
+
+      name = StringProperty(index=True, covering=["name", "updated"])
+      tags = ListProperty(index=True, covering=["name"])
+      updated = DateTimeProperty(default=None)
+      bio = StringProperty()
+
+    self.Person = Person
+
+  def tearDown(self):
+    self.Person.close_leveldb_connections()
+
+  def without_data_db(self, f):
+    meta = self.Person._leveldb_meta
+    db = meta["db"]
+    meta["db"] = NoReads()
+    try:
+      return f()
+    finally:
+      meta["db"] = db
+
+  def test_covered_queries(self):
+    when = datetime(2013, 5, 1, 12)
+    self.Person(key="a", data={"name": "alice", "tags": ["x", "y"], "updated": when, "bio": "long"}).save()
+    self.Person(key="b", data={"name": "bob", "tags": ["y"], "bio": "long"}).save()
+
+    records = self.without_data_db(lambda: list(self.Person.index("name", "a", "z", fields=["name", "updated"])))
+    self.assertEquals([("a", "alice", when), ("b", "bob", None)], records)
+
+    records = self.without_data_db(lambda: list(self.Person.index("tags", "x", "y", fields=["name"])))
+    self.assertEquals([("a", "alice"), ("b", "bob")], records)
+
+    page = self.without_data_db(lambda: self.Person.index("name", "a", "z", fields=["updated"], limit=1))
+    self.assertEquals([("a", when)], page)
+    page = self.without_data_db(lambda: self.Person.index("name", "a", "z", fields=["updated"], limit=1,
+                                                          continuation=page.continuation))
+    self.assertEquals([("b", None)], page)
+
+    # Not covered, so the documents are loaded.
+    self.assertEquals([("a", "long")], list(self.Person.index("name", "alice", fields=["bio"])))
+    self.assertEquals(["alice"], [doc.name for doc in self.Person.index("name", "alice")])
+
+  def test_covered_values_updated(self):
+    doc = self.Person(key="a", data={"name": "alice", "tags": ["x"]}).save()
+    doc = self.Person.get("a")
+    doc.updated = datetime(2014, 1, 1)
+    doc.save()
+
+    records = self.without_data_db(lambda: list(self.Person.index("name", "alice", fields=["updated"])))
+    self.assertEquals([("a", datetime(2014, 1, 1))], records)
+
+    doc.name = "alicia"
+    doc.tags = ["x", "z"]
+    self.Person.save_many([doc])
+    self.assertEquals([], list(self.Person.index("name", "alice", fields=["name"])))
+    records = self.without_data_db(lambda: list(self.Person.index("tags", "x", "z", fields=["name"])))
+    self.assertEquals([("a", "alicia")], records)
+
+    doc.delete()
+    self.assertEquals([], list(self.Person.index("tags", "x", "z", fields=["name"])))
+
+  def test_write_many(self):
+    leveldb.write_many(self.Person, [("a", {"name": "alice", "tags": ["x"]}), ("b", {"name": "bob"})])
+    leveldb.write_many(self.Person, [
+      ("a", {"name": "alice", "tags": ["x", "y"], "updated": 1}),
+      ("b", {"name": "bobby"}),
+      ("b", {"name": "robert"}),
+    ])
+
+    records = self.without_data_db(lambda: list(self.Person.index("name", "a", "z", fields=["updated"])))
+    self.assertEquals([("a", datetime.utcfromtimestamp(1)), ("b", None)], records)
+    self.assertEquals(["b"], list(self.Person.index_keys_only("name", "robert")))
+    self.assertEquals([], list(self.Person.index_keys_only("name", "bobby")))
+    self.assertEquals(["a"], list(self.Person.index_keys_only("tags", "y")))
+    self.assertTrue(self.Person.verify_indexes().ok)
+
+  def test_entries_without_values(self):
+    self.Person(key="a", data={"name": "alice"}).save()
+    # As written before covering was added to the property.
+    self.Person._leveldb_meta["indexdb"].put(leveldb._index_entry("name", "alice", "a"), "")
+    self.assertEquals([("a", "alice")], list(self.Person.index("name", "alice", fields=["name"])))
+
+    self.Person.rebuild_indexes(memory_limit=1)
+    records = self.without_data_db(lambda: list(self.Person.index("name", "alice", fields=["name"])))
+    self.assertEquals([("a", "alice")], records)
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBVerifyTest(unittest.TestCase):
+  def setUp(self):
+    global REINDEX_CLASS
+    remove_dbs()
+
+    class Person(Document):
+      _backend = leveldb
+      _leveldb_options = {"db": DB_PATH, "indexdb": INDEXDB_PATH}
+
+      name = StringProperty(index=True, covering=["age"])
+      tags = ListProperty(index=True)
+      age = NumberProperty()
+
+    REINDEX_CLASS = self.Person = Person
+    for i in xrange(10):
+      Person(key="k{0}".format(i), data={"name": "n{0}".format(i), "tags": ["x", "y", "x"], "age": i}).save()
+
+  def tearDown(self):
+    global REINDEX_CLASS
+    REINDEX_CLASS = None
+    self.Person.close_leveldb_connections()
+
+  def corrupt(self):
+    idb = self.Person._leveldb_meta["indexdb"]
+    entry = leveldb._index_entry
+    idb.delete(entry("name", "n1", "k1"))
+    idb.delete(entry("tags", "y", "k2"))
+    idb.put(entry("name", "n0", "gone"), "")
+    idb.put(entry("tags", "z", "k3"), "")
+    idb.put(entry("age", 4, "k4"), "")
+    idb.put(entry("name", "old", "k5"), "")
+    idb.put(entry("name", "n6", "k6"), json.dumps({"age": 100}))
+
+  def test_verify(self):
+    report = self.Person.verify_indexes(batch_size=3)
+    self.assertTrue(report.ok)
+    self.assertEquals(10, report.documents)
+    self.assertEquals(30, report.entries)
+
+    self.corrupt()
+    report = self.Person.verify_indexes(memory_limit=10)
+    self.assertFalse(report.ok)
+    self.assertEquals({"name": 1, "tags": 1}, report.missing)
+    self.assertEquals({"name": 1, "tags": 1, "age": 1}, report.stale)
+    self.assertEquals({"name": 1}, report.duplicate)
+    self.assertEquals({"name": 1}, report.outdated)
+    self.assertEquals(0, report.repaired)
+    self.assertTrue(report.rate > 0)
+
+    report = self.Person.verify_indexes(repair=True, batch_size=2)
+    self.assertEquals(7, report.repaired)
+    self.assertTrue(self.Person.verify_indexes().ok)
+    self.assertEquals(["k1"], list(self.Person.index_keys_only("name", "n1")))
+    self.assertEquals([("k6", 6)], list(self.Person.index("name", "n6", fields=["age"])))
+
+  def test_verify_changed_value(self):
+    idb = self.Person._leveldb_meta["indexdb"]
+    idb.delete(leveldb._index_entry("name", "n2", "k2"))
+    idb.put(leveldb._index_entry("name", "old", "k2"), "")
+
+    # Indexed with its old value only, so that entry is stale rather than
+    # an extra one.
+    report = self.Person.verify_indexes()
+    self.assertEquals({"name": 1}, report.missing)
+    self.assertEquals({"name": 1}, report.stale)
+    self.assertEquals({}, report.duplicate)
+
+    self.assertEquals(2, self.Person.verify_indexes(repair=True).repaired)
+    self.assertEquals(["k2"], list(self.Person.index_keys_only("name", "n2")))
+    self.assertEquals([], list(self.Person.index_keys_only("name", "old")))
+
+  def test_repair_uses_current_documents(self):
+    self.corrupt()
+    progress = []
+    def changing(stage, count, elapsed):
+      progress.append(stage)
+      if progress == ["read"]:
+        # After the snapshot: k1 no longer has n1, which is missing from the
+        # snapshot's index, so it must not be added back.
+        doc = self.Person.get("k1")
+        doc.name = "renamed"
+        doc.save()
+
+    report = self.Person.verify_indexes(repair=True, progress=changing)
+    self.assertEquals(7, report.repaired)
+    self.assertEquals([], list(self.Person.index_keys_only("name", "n1")))
+    self.assertEquals(["k1"], list(self.Person.index_keys_only("name", "renamed")))
+    self.assertTrue(self.Person.verify_indexes().ok)
+
+  def test_command(self):
+    self.corrupt()
+    out = StringIO()
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+      self.assertEquals(1, reindex.main([__name__ + ":REINDEX_CLASS", "--verify"]))
+      self.assertEquals(0, reindex.main([__name__ + ":REINDEX_CLASS", "--repair"]))
+      self.assertEquals(0, reindex.main([__name__ + ":REINDEX_CLASS", "--verify"]))
+    finally:
+      sys.stdout = stdout
+
+    output = out.getvalue()
+    self.assertTrue("Checked 10 documents and 32 index entries" in output)
+    self.assertTrue("documents/s" in output)
+    self.assertTrue("name                          1          1          1          1" in output)
+    self.assertTrue("Repaired 7 entries." in output)
+    self.assertTrue(output.endswith("No problems found.\n"))
+
+SHARED_PATH = "dbs/test_leveldb_shared"
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBSharedTest(unittest.TestCase):
+  def setUp(self):
+    if os.path.exists(SHARED_PATH):
+      shutil.rmtree(SHARED_PATH)
+
+    class Post(Document):
+      _backend = leveldb
+      _leveldb_options = {"shared": SHARED_PATH}
+
+      title = StringProperty(index=True)
+
+    class Comment(Document):
+      _backend = leveldb
+      _leveldb_options = {"shared": SHARED_PATH, "prefix": "c"}
+
+      title = StringProperty(index=True)
+
+    self.Post = Post
+    self.Comment = Comment
+
+  def tearDown(self):
+    self.Post.close_leveldb_connections()
+    self.Comment.close_leveldb_connections()
+
+  def test_one_db(self):
+    # Nothing is opened until the classes are used.
+    self.assertEquals(0, leveldb._db_users(SHARED_PATH))
+    self.Post.open_leveldb_connections()
+    self.Comment.warmup_leveldb()
+    self.assertTrue(self.Post._leveldb_meta["shared"] is self.Comment._leveldb_meta["shared"])
+    self.assertEquals(2, leveldb._db_users(SHARED_PATH))
+
+    self.Comment.close_leveldb_connections()
+    self.assertEquals(1, leveldb._db_users(SHARED_PATH))
+    self.Comment.close_leveldb_connections()
+    self.assertEquals(1, leveldb._db_users(SHARED_PATH))
+
+    self.Post.close_leveldb_connections()
+    self.assertEquals(0, leveldb._db_users(SHARED_PATH))
+
+    self.Post.open_leveldb_connections()
+    self.Comment.open_leveldb_connections()
+    self.assertEquals(2, leveldb._db_users(SHARED_PATH))
+
+  def test_prefixes(self):
+    self.Post(key="a", data={"title": "hello"}).save()
+    self.Post(key="b", data={"title": "world"}).save()
+    self.Comment(key="a", data={"title": "hello"}).save()
+
+    self.assertEquals(["a", "b"], list(self.Post.list_all_keys()))
+    self.assertEquals(["a"], list(self.Comment.list_all_keys()))
+    self.assertEquals(["a", "b"], list(self.Post.index_keys_only("title", "a", "z")))
+    self.assertEquals(["a"], list(self.Comment.index_keys_only("title", "a", "z")))
+
+    self.Post.delete_key("a")
+    self.assertEquals("hello", self.Comment.get("a").title)
+    self.assertEquals([], list(self.Post.index_keys_only("title", "hello")))
+    self.assertEquals(["a"], list(self.Comment.index_keys_only("title", "hello")))
+
+    with self.Post._leveldb_meta["shared"].iterator(include_value=False) as it:
+      keys = list(it)
+    self.assertTrue(all(k.startswith("Post\x00") or k.startswith("c\x00") for k in keys))
+
+  def test_snapshot(self):
+    check_snapshot(self, self.Post)
+    self.assertEquals([], list(self.Comment.list_all_keys()))
+
+  def test_atomic_writes(self):
+    writes = []
+    shared = leveldb._connected(self.Post)["shared"]
+
+    class CountingDB(object):
+      def write_batch(self, **args):
+        wb = shared.write_batch(**args)
+        writes.append(wb)
+        return wb
+
+    self.Post._leveldb_meta["shared"] = CountingDB()
+    try:
+      doc = self.Post(data={"title": "hello"}).save()
+      doc.delete()
+    finally:
+      self.Post._leveldb_meta["shared"] = shared
+
+    self.assertEquals(2, len(writes))
+    self.assertEquals([], list(self.Post.list_all_keys()))
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBTuningTest(unittest.TestCase):
+  def setUp(self):
+    remove_dbs()
+    self.Tuned = make_document_class(lru_cache_size=1024 * 1024, bloom_filter_bits=10,
+                                     indexdb_options={"bloom_filter_bits": 0})
+
+  def tearDown(self):
+    self.Tuned.close_leveldb_connections()
+
+  def test_options(self):
+    self.assertEquals({"lru_cache_size": 1024 * 1024, "bloom_filter_bits": 10},
+                      leveldb._db_options(self.Tuned, "db"))
+    self.assertEquals({"lru_cache_size": 1024 * 1024, "bloom_filter_bits": 0},
+                      leveldb._db_options(self.Tuned, "indexdb"))
+
+    self.Tuned(key="a", data={"status": "draft", "score": 1}).save()
+    self.assertEquals(["a"], list(self.Tuned.index_keys_only("status", "draft")))
+
+  def test_subclass_shares_dbs(self):
+    class Child(self.Tuned):
+      pass
+
+    try:
+      self.assertTrue(leveldb._data_db(Child) is leveldb._data_db(self.Tuned))
+      self.assertEquals(2, leveldb._db_users(DB_PATH))
+      self.assertEquals(2, leveldb._db_users(INDEXDB_PATH))
+
+      Child(key="a", data={"status": "draft"}).save()
+      self.assertEquals("draft", self.Tuned.get("a").status)
+
+      # The index db is used by both, so neither can rebuild or repair it.
+      with self.assertRaises(ValueError):
+        Child.rebuild_indexes()
+      with self.assertRaises(ValueError):
+        self.Tuned.verify_indexes(repair=True)
+      self.assertEquals(["a"], list(self.Tuned.index_keys_only("status", "draft")))
+      self.assertEquals({}, self.Tuned.verify_indexes().missing)
+    finally:
+      Child.close_leveldb_connections()
+
+    self.assertEquals(1, leveldb._db_users(DB_PATH))
+    self.assertEquals("draft", self.Tuned.get("a").status)
+
+  def test_rebuild_keeps_entries_of_other_classes(self):
+    class Child(self.Tuned):
+      extra = StringProperty(index=True)
+
+    try:
+      Child(key="c", data={"status": "draft", "extra": "y"}).save()
+      with self.assertRaises(ValueError):
+        self.Tuned.rebuild_indexes()
+      self.assertEquals(["c"], list(Child.index_keys_only("extra", "y")))
+    finally:
+      Child.close_leveldb_connections()
+
+    # Alone, the class with all the indexes can rebuild them.
+    self.Tuned.close_leveldb_connections()
+    Child.open_leveldb_connections()
+    try:
+      self.assertEquals(1, Child.rebuild_indexes())
+      self.assertEquals(["c"], list(Child.index_keys_only("extra", "y")))
+    finally:
+      Child.close_leveldb_connections()
+
+  def test_conflicting_options(self):
+    self.Tuned.open_leveldb_connections()
+    with self.assertRaises(ValueError):
+      make_document_class(lru_cache_size=2 * 1024 * 1024).open_leveldb_connections()
+
+    self.assertEquals(1, leveldb._db_users(DB_PATH))
+    self.assertEquals(1, leveldb._db_users(INDEXDB_PATH))
+
+  def test_rebuild_keeps_options(self):
+    self.Tuned(key="a", data={"status": "draft"}).save()
+    self.assertEquals(1, self.Tuned.rebuild_indexes())
+    self.assertEquals(1, leveldb._db_users(INDEXDB_PATH))
+    self.assertEquals(leveldb._db_options(self.Tuned, "indexdb"),
+                      leveldb._open_dbs[os.path.abspath(INDEXDB_PATH)][2])
+    self.assertEquals(["a"], list(self.Tuned.index_keys_only("status", "draft")))
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBLazyOpenTest(unittest.TestCase):
+  def setUp(self):
+    remove_dbs()
+    self.cls = make_document_class()
+    # So open_all and close_all leave the classes of the other tests alone.
+    self.classes = leveldb._classes
+    leveldb._classes = weakref.WeakSet([self.cls])
+
+  def tearDown(self):
+    leveldb._classes = self.classes
+    self.cls.close_leveldb_connections()
+
+  def in_child(self, function):
+    pid = os.fork()
+    if pid == 0:
+      try:
+        function()
+      except BaseException:
+        os._exit(1)
+      os._exit(0)
+    self.assertEquals(0, os.waitpid(pid, 0)[1])
+
+  def test_opened_on_first_use(self):
+    self.assertEquals(0, leveldb._db_users(DB_PATH))
+    self.assertFalse(self.cls in leveldb.open_latencies())
+
+    self.cls(key="a", data={"status": "draft"}).save()
+    self.assertEquals(1, leveldb._db_users(DB_PATH))
+    self.assertTrue(leveldb.open_latencies()[self.cls] >= 0)
+
+    # Opening again does nothing.
+    self.cls.open_leveldb_connections()
+    self.assertEquals(1, leveldb._db_users(DB_PATH))
+
+    leveldb.close_all()
+    self.assertEquals(0, leveldb._db_users(DB_PATH))
+    self.assertEquals("draft", self.cls.get("a").status)
+
+    leveldb.close_all()
+    leveldb.open_all()
+    self.assertEquals(1, leveldb._db_users(INDEXDB_PATH))
+    self.cls.warmup_leveldb(fill_cache=True)
+    self.assertEquals(["a"], list(self.cls.index_keys_only("status", "draft")))
+
+  @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+  def test_fork_after_close(self):
+    self.cls(key="a", data={"status": "draft"}).save()
+    leveldb.close_all()
+
+    def child():
+      doc = self.cls.get("a")
+      doc.status = "published"
+      doc.save()
+      self.cls.close_leveldb_connections()
+
+    self.in_child(child)
+    self.assertEquals("published", self.cls.get("a").status)
+    self.assertEquals(["a"], list(self.cls.index_keys_only("status", "published")))
+
+  @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+  def test_fork_while_open(self):
+    self.cls(key="a", data={"status": "draft"}).save()
+
+    def child():
+      # The parent's handles are not this process' to use or close.
+      assert leveldb._db_users(DB_PATH) == 0
+      self.cls.close_leveldb_connections()
+
+    self.in_child(child)
+    self.assertEquals(1, leveldb._db_users(DB_PATH))
+    self.assertEquals("draft", self.cls.get("a").status)
+
+if __name__ == "__main__":
+  unittest.main()
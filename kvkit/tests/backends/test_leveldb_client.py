@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import threading
+import unittest
+
+from .test_backends import create_base_documents, create_testcase
+from ...backends import leveldb, leveldb_client
+from ...document import Document
+from ...exceptions import DatabaseError, NotFoundError
+from ...properties import NumberProperty, StringProperty
+from ...server import StorageServer
+
+SOCKET_PATH = "dbs/test_leveldb_client.sock"
+SIMPLE_PATH = "dbs/test_leveldb_client_simple"
+INDEXED_PATH = "dbs/test_leveldb_client_indexed"
+
+_server = None
+
+if leveldb.available:
+  # What the server serves, and the classes of the same names talking to it.
+  _, ServerSimpleDocument, ServerDocumentWithIndexes = create_base_documents(leveldb,
+      (None, "_leveldb_options", "_leveldb_options"),
+      (None, {"db": SIMPLE_PATH}, {"db": INDEXED_PATH, "indexdb": INDEXED_PATH + ".indexes"})
+  )
+
+  ClientBaseDocument, ClientSimpleDocument, ClientDocumentWithIndexes = create_base_documents(leveldb_client,
+      (None, "_leveldb_client_options", "_leveldb_client_options"),
+      (None, {"socket": SOCKET_PATH}, {"socket": SOCKET_PATH})
+  )
+
+  def remove_dbs():
+    ServerSimpleDocument.close_leveldb_connections()
+    ServerDocumentWithIndexes.close_leveldb_connections()
+    for path in (SIMPLE_PATH, INDEXED_PATH, INDEXED_PATH + ".indexes"):
+      if os.path.exists(path):
+        shutil.rmtree(path)
+
+  # Defined here so the server of this module is up for it.
+  class LeveldbClientBackendTest(create_testcase(ClientBaseDocument,
+                                                 ClientSimpleDocument,
+                                                 ClientDocumentWithIndexes,
+                                                 "LeveldbClientBackendTest",
+                                                 remove_dbs)):
+    pass
+
+def setUpModule():
+  global _server
+  if not leveldb.available:
+    return
+
+  remove_dbs()
+  # Small chunks so that query results take several frames.
+  _server = StorageServer(SOCKET_PATH, [ServerSimpleDocument, ServerDocumentWithIndexes], chunk_size=2)
+  thread = threading.Thread(target=_server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+def tearDownModule():
+  if _server is not None:
+    _server.shutdown()
+    _server.server_close()
+    leveldb_client.close_all()
+    remove_dbs()
+
+@unittest.skipUnless(leveldb.available, "plyvel is not installed")
+class LevelDBClientTest(unittest.TestCase):
+  def setUp(self):
+    class SmallBatches(Document):
+      _backend = leveldb_client
+      _leveldb_client_options = {"socket": SOCKET_PATH, "name": "DocumentWithIndexes", "batch_size": 2}
+
+      string = StringProperty(index=True)
+      number = NumberProperty(index=True)
+
+    self.cls = SmallBatches
+
+  def tearDown(self):
+    remove_dbs()
+
+  def idle_connections(self):
+    return len(leveldb_client._pool(self.cls)._idle)
+
+  def test_pipelined_batches(self):
+    docs = [self.cls(key="k{0}".format(i), data={"string": "s", "number": i}) for i in xrange(5)]
+    self.cls.save_many(docs)
+
+    keys = ["k4", "missing", "k0", "k2", "k4"]
+    self.assertEquals(["k4", "k0", "k2", "k4"], [doc.key for doc in self.cls.get_many(keys)])
+    self.assertEquals(5, len(list(self.cls.index_keys_only("string", "s"))))
+    self.assertEquals(3, self.cls.delete_many(["k0", "k1", "k1", "k2", "missing"]))
+    self.assertEquals(["k3", "k4"], sorted(self.cls.list_all_keys()))
+
+  def test_large_batches(self):
+    class LargeBatches(Document):
+      _backend = leveldb_client
+      _leveldb_client_options = {"socket": SOCKET_PATH, "name": "DocumentWithIndexes", "batch_size": 200,
+                                 "timeout": 10}
+
+      string = StringProperty(index=True)
+      number = NumberProperty(index=True)
+
+    # Each response to get_many is larger than the socket buffers, and so
+    # are all the requests together.
+    payload = "x" * 1024
+    keys = ["{0:0120d}".format(i) for i in xrange(4000)]
+    LargeBatches.save_many([LargeBatches(key=key, data={"string": payload, "number": 1}) for key in keys])
+
+    docs = LargeBatches.get_many(keys)
+    self.assertEquals(keys, [doc.key for doc in docs])
+    self.assertEquals(payload, docs[-1].string)
+    self.assertEquals(4000, LargeBatches.delete_many(keys))
+
+  def test_streaming(self):
+    for i in xrange(7):
+      self.cls(key="k{0}".format(i), data={"string": "s", "number": i}).save()
+
+    self.assertEquals(7, len(list(self.cls.index("number", 0, 10))))
+    self.assertEquals(1, self.idle_connections())
+
+    page = self.cls.index("number", 0, 10, limit=3)
+    self.assertEquals(["k0", "k1", "k2"], [doc.key for doc in page])
+    page = self.cls.index("number", 0, 10, limit=3, continuation=page.continuation)
+    self.assertEquals(["k3", "k4", "k5"], [doc.key for doc in page])
+
+    records = list(self.cls.index("number", 5, 6, fields=["number"]))
+    self.assertEquals([5, 6], [record.number for record in records])
+
+    # A query left half read cannot give its connection back.
+    results = self.cls.index_keys_only("number", 0, 10)
+    self.assertEquals("k0", next(results))
+    results.close()
+    self.assertEquals(0, self.idle_connections())
+    self.assertEquals(7, len(list(self.cls.list_all_keys())))
+    self.assertEquals(1, self.idle_connections())
+
+  def test_errors(self):
+    with self.assertRaises(NotFoundError):
+      self.cls.get("missing")
+
+    with self.assertRaises(ValueError):
+      list(self.cls.index_keys_only("number", 0, 10, limit=1, continuation="garbage"))
+
+    class NotServed(Document):
+      _backend = leveldb_client
+      _leveldb_client_options = {"socket": SOCKET_PATH}
+
+    with self.assertRaises(ValueError):
+      NotServed.get("a")
+
+    class NoServer(Document):
+      _backend = leveldb_client
+      _leveldb_client_options = {"socket": "dbs/test_no_server.sock"}
+
+    with self.assertRaises(DatabaseError):
+      leveldb_client.ping(NoServer)
+
+    # The connection is still in sync after errors.
+    leveldb_client.ping(self.cls)
+    self.assertEquals(1, self.idle_connections())
+
+  def test_stale_copies(self):
+    doc = self.cls(key="a", data={"string": "first"}).save()
+    other = self.cls.get("a")
+    doc.string = "second"
+    doc.save()
+    other.number = 1
+    other.save()
+
+    # The server diffs the indexes against what is stored, not against what
+    # the copy it got was loaded with.
+    self.assertEquals([], list(self.cls.index_keys_only("string", "second")))
+    self.assertEquals(["a"], list(self.cls.index_keys_only("string", "first")))
+    self.assertEquals(1, len(list(self.cls.index_keys_only("string", "", "zzz"))))
+
+  @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+  def test_processes(self):
+    self.cls(key="parent", data={"string": "p"}).save()
+
+    pids = []
+    for i in xrange(3):
+      pid = os.fork()
+      if pid == 0:
+        try:
+          for j in xrange(10):
+            self.cls(key="c{0}-{1}".format(i, j), data={"string": "c", "number": j}).save()
+        except BaseException:
+          os._exit(1)
+        os._exit(0)
+      pids.append(pid)
+
+    for pid in pids:
+      self.assertEquals(0, os.waitpid(pid, 0)[1])
+
+    self.assertEquals(30, len(list(self.cls.index_keys_only("string", "c"))))
+    self.assertEquals("p", self.cls.get("parent").string)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,573 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import httplib
+import json
+import random
+import threading
+import time
+import unittest
+
+from .fake_riak import FakeRiakServer
+from .test_backends import create_base_documents, create_testcase
+from ...backends import cached, riak
+from ...document import Document
+from ...exceptions import BatchError, NotFoundError, ValidationError
+from ...properties import ListProperty, NumberProperty, StringProperty
+
+class FakeObject(object):
+  def __init__(self, key, data=None, bucket=None):
+    self.key = key
+    self.data = data
+    self.exists = data is not None
+    self.bucket = bucket
+
+  def store(self, **args):
+    self.bucket.store(self, args)
+
+class FakePage(list):
+  continuation = None
+
+class FakeStream(object):
+  """A streamed index page, which sends its keys in lists of two and gives
+  its connection back when the iteration ends, like an IndexPage."""
+  def __init__(self, page):
+    self.page = page
+    self.continuation = None
+    self.released = 0
+
+  def __iter__(self):
+    try:
+      for i in xrange(0, len(self.page), 2):
+        yield self.page[i:i + 2]
+      self.continuation = self.page.continuation
+    finally:
+      self.close()
+
+  def close(self):
+    self.released += 1
+
+class FakeBucket(object):
+  """The part of a RiakBucket that fetching index results uses, with a
+  random delay on every get to shuffle the order they complete in."""
+  def __init__(self, objects, max_delay=0.005):
+    self.objects = objects
+    self.max_delay = max_delay
+    self.gets = 0
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.fail = set()
+    self.streams = []
+    self.stores = []
+    self._storing = set()
+    self._lock = threading.Lock()
+
+  def new(self, key):
+    return FakeObject(key, bucket=self)
+
+  def store(self, robj, args):
+    with self._lock:
+      if id(robj) in self._storing:
+        raise AssertionError("{0} is stored twice at once".format(robj.key))
+      self._storing.add(id(robj))
+      self.stores.append((robj.key, args))
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    try:
+      time.sleep(random.random() * self.max_delay)
+      if robj.key in self.fail:
+        raise IOError("failed to store " + robj.key)
+      self.objects[robj.key] = robj.data
+    finally:
+      with self._lock:
+        self.in_flight -= 1
+        self._storing.discard(id(robj))
+
+  def get(self, key, **args):
+    with self._lock:
+      self.gets += 1
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    try:
+      time.sleep(random.random() * self.max_delay)
+      if key in self.fail:
+        raise IOError("failed to get " + key)
+      return FakeObject(key, self.objects.get(key))
+    finally:
+      with self._lock:
+        self.in_flight -= 1
+
+  def get_index(self, field, start_value, end_value=None, max_results=None, continuation=None,
+                return_terms=False, **args):
+    if field == "$bucket":
+      keys = sorted(self.objects)
+    else:
+      name = field[:-len("_bin")]
+      keys = sorted(k for k, data in self.objects.iteritems() if data[name] == start_value)
+
+    if continuation is not None:
+      keys = [k for k in keys if k > continuation]
+
+    page = FakePage(keys[:max_results] if max_results is not None else keys)
+    if max_results is not None and len(keys) > max_results:
+      page.continuation = page[-1]
+    if return_terms:
+      page[:] = [(self.objects[k][name], k) for k in page]
+    return page
+
+  def stream_index(self, *args, **kwargs):
+    stream = FakeStream(self.get_index(*args, **kwargs))
+    self.streams.append((kwargs.get("max_results"), stream))
+    return stream
+
+class NotStreamingBucket(FakeBucket):
+  """A bucket of a client before 2.0, which had no stream_index."""
+  def __getattribute__(self, name):
+    if name == "stream_index":
+      raise AttributeError(name)
+    return FakeBucket.__getattribute__(self, name)
+
+class FakeBucketTestCase(unittest.TestCase):
+  def make_class(self, count=50, bucket_class=None, **options):
+    objects = dict(("k{0:03d}".format(i), {"name": "even" if i % 2 == 0 else "odd"}) for i in xrange(count))
+    self.bucket = (bucket_class or FakeBucket)(objects)
+    opts = {"bucket": self.bucket}
+    opts.update(options)
+
+    class Item(Document):
+      _backend = riak
+      _riak_options = opts
+
+      name = StringProperty(index=True)
+      views = NumberProperty()
+
+    return Item
+
+class RiakFetchTest(FakeBucketTestCase):
+  def test_ordered(self):
+    cls = self.make_class()
+    self.assertEquals(sorted(self.bucket.objects), [doc.key for doc in cls.list_all()])
+    self.assertEquals(["k{0:03d}".format(i) for i in xrange(1, 50, 2)], [doc.key for doc in cls.index("name", "odd")])
+    self.assertTrue(self.bucket.max_in_flight > 1)
+
+  def test_unordered(self):
+    cls = self.make_class()
+    keys = [doc.key for doc in cls.list_all(ordered=False)]
+    self.assertEquals(sorted(self.bucket.objects), sorted(keys))
+
+  def test_read_ahead(self):
+    cls = self.make_class(fetch_threads=8, read_ahead=3)
+    results = cls.list_all()
+    self.assertEquals("k000", next(results).key)
+    time.sleep(0.05)
+    # One fetch was used and three more were sent to replace it.
+    self.assertTrue(self.bucket.gets <= 4)
+
+    self.assertEquals(49, len(list(results)))
+    self.assertTrue(self.bucket.max_in_flight <= 3)
+
+  def test_paging_and_missing(self):
+    cls = self.make_class(count=10)
+    # Deleted after the index was queried.
+    original = self.bucket.get_index
+    self.bucket.get_index = lambda *args, **kwargs: FakePage(list(original(*args, **kwargs)) + ["gone"])
+    self.assertEquals(10, len(list(cls.list_all())))
+
+    self.bucket.get_index = original
+    page = cls.list_all(limit=4)
+    self.assertEquals(["k000", "k001", "k002", "k003"], [doc.key for doc in page])
+    page = cls.list_all(limit=4, continuation=page.continuation)
+    self.assertEquals(["k004", "k005", "k006", "k007"], [doc.key for doc in page])
+
+  def test_errors(self):
+    cls = self.make_class()
+    self.bucket.fail.add("k010")
+    with self.assertRaises(IOError):
+      list(cls.list_all())
+
+    # The pool still works.
+    self.bucket.fail.clear()
+    self.assertEquals(50, len(list(cls.list_all(ordered=False))))
+
+  def test_streamed_pages(self):
+    cls = self.make_class(count=10, index_page_size=3)
+    self.assertEquals(sorted(self.bucket.objects), list(cls.list_all_keys()))
+    self.assertEquals([3, 3, 3, 3], [max_results for max_results, _ in self.bucket.streams])
+
+    # Resumed from the continuation of a page.
+    page = cls.list_all_keys(limit=4)
+    self.assertEquals(["k000", "k001", "k002", "k003"], list(page))
+    self.assertEquals(["k004", "k005", "k006", "k007", "k008", "k009"],
+                      list(cls.list_all_keys(continuation=page.continuation)))
+
+    # A query that is not read to the end stops its stream.
+    keys = cls.list_all_keys()
+    self.assertEquals("k000", next(keys))
+    keys.close()
+    # Every connection was given back once.
+    self.assertEquals(set([1]), set(stream.released for _, stream in self.bucket.streams))
+
+  def test_adjacent_duplicates(self):
+    cls = self.make_class(count=4)
+    original = self.bucket.get_index
+    self.bucket.get_index = lambda *args, **kwargs: FakePage(["k000", "k000", "k001", "k001", "k000"])
+    self.assertEquals(["k000", "k001", "k000"], list(cls.list_all_keys()))
+
+  def test_without_streaming(self):
+    cls = self.make_class(count=4, bucket_class=NotStreamingBucket)
+    page = cls.list_all_keys(limit=2)
+    self.assertEquals(["k000", "k001"], list(page))
+    self.assertEquals(["k002", "k003"], list(cls.list_all_keys(continuation=page.continuation)))
+
+  def test_index_terms(self):
+    cls = self.make_class(count=6, index_page_size=2)
+    expected = [("even", "k000"), ("even", "k002"), ("even", "k004")]
+    self.assertEquals(expected, list(cls.index_terms("name", "even")))
+    self.assertEquals([2, 2], [max_results for max_results, _ in self.bucket.streams])
+
+    page = cls.index_terms("name", "even", limit=2)
+    self.assertEquals(expected[:2], list(page))
+    self.assertEquals(expected[2:], list(cls.index_terms("name", "even", continuation=page.continuation)))
+
+    # Only the index was read.
+    self.assertEquals(0, self.bucket.gets)
+
+class RiakStoreTest(FakeBucketTestCase):
+  def test_save_many(self):
+    cls = self.make_class(count=0, store_window=4)
+    docs = [cls(key="k{0:02d}".format(i), data={"name": "n"}) for i in xrange(30)]
+    self.assertEquals(30, cls.save_many(docs))
+
+    self.assertEquals(30, len(self.bucket.objects))
+    self.assertEquals([("name_bin", "n")], docs[0]._backend_obj.indexes)
+    self.assertTrue(1 < self.bucket.max_in_flight <= 4)
+    self.assertEquals(30, riak.store_counters(cls)["stored"])
+    self.assertFalse(docs[0].is_dirty())
+
+  def test_failures(self):
+    cls = self.make_class(count=0)
+    docs = [cls(key="k{0:02d}".format(i), data={"name": "n"}) for i in xrange(10)]
+    self.bucket.fail.update(["k03", "k07"])
+
+    with self.assertRaises(BatchError) as context:
+      cls.save_many(docs, batch_size=4)
+
+    self.assertEquals(8, context.exception.saved)
+    self.assertEquals(["k03", "k07"], sorted(doc.key for doc, _ in context.exception.failed))
+    self.assertTrue(all(isinstance(error, IOError) for _, error in context.exception.failed))
+    # The batches after a failure are still written.
+    self.assertEquals(8, len(self.bucket.objects))
+    self.assertTrue(docs[3].is_dirty())
+    self.assertFalse(docs[4].is_dirty())
+
+    counters = riak.store_counters(cls)
+    self.assertEquals((8, 2), (counters["stored"], counters["failed"]))
+    self.assertTrue(counters["seconds"] > 0)
+
+  def test_batch(self):
+    cls = self.make_class(count=0, store_window=3)
+    doc = cls(key="again", data={"name": "first"})
+
+    with riak.Batch(cls) as batch:
+      for i in xrange(10):
+        batch.save(cls(key="k{0:02d}".format(i), data={"name": "n"}))
+      batch.save(doc)
+      doc.name = "second"
+      # Waits for the first store of the same document.
+      batch.save(doc)
+
+      with self.assertRaises(ValidationError):
+        batch.save(cls(key="bad", data={"views": "many"}))
+
+    self.assertEquals(12, batch.stored)
+    self.assertEquals([], batch.failed)
+    self.assertTrue(batch.rate > 0)
+    self.assertEquals("second", self.bucket.objects["again"]["name"])
+    self.assertFalse("bad" in self.bucket.objects)
+
+  def test_return_body(self):
+    cls = self.make_class(count=0)
+    cls(key="a", data={"name": "n"}).save()
+    # The fake bucket does not say whether it allows siblings.
+    self.assertEquals({}, self.bucket.stores[-1][1])
+
+    self.bucket.allow_mult = False
+    cls = self.make_class(count=0)
+    self.bucket.allow_mult = False
+    cls.save_many([cls(key="a", data={"name": "n"})])
+    self.assertEquals({"return_body": False}, self.bucket.stores[-1][1])
+    cls(key="a", data={"name": "n"}).save(return_body=True)
+    self.assertEquals({"return_body": True}, self.bucket.stores[-1][1])
+
+    cls = self.make_class(count=0, return_body=True)
+    self.bucket.allow_mult = False
+    cls(key="a", data={"name": "n"}).save()
+    self.assertEquals({}, self.bucket.stores[-1][1])
+
+class RiakCachedTest(FakeBucketTestCase):
+  def test_save_after_cache_hit(self):
+    self.make_class(count=0)
+
+    class CachedItem(Document):
+      _backend = cached.CachedBackend(riak)
+      _riak_options = {"bucket": self.bucket}
+
+      name = StringProperty(index=True)
+
+    CachedItem(key="a", data={"name": "one"}).save()
+    gets = self.bucket.gets
+
+    for loaded in (CachedItem.get("a"), CachedItem.get_many(["a"])[0]):
+      loaded.name = "two"
+      loaded.save()
+      self.assertEquals("two", self.bucket.objects["a"]["name"])
+
+    # The document came from the cache.
+    self.assertEquals(gets, self.bucket.gets)
+
+class FakeRiakServerTest(unittest.TestCase):
+  def setUp(self):
+    self.server = FakeRiakServer(stream_chunk_size=2).start()
+    self.connection = httplib.HTTPConnection(self.server.host, self.server.port)
+
+  def tearDown(self):
+    self.connection.close()
+    self.server.stop()
+
+  def request(self, method, path, body=None, headers={}):
+    self.connection.request(method, path, body, headers)
+    response = self.connection.getresponse()
+    return response.status, response, response.read()
+
+  def put(self, key, data, **indexes):
+    headers = {"Content-Type": "application/json"}
+    for field, values in indexes.iteritems():
+      headers["X-Riak-Index-" + field] = ", ".join(str(v) for v in values)
+    status, _, _ = self.request("PUT", "/buckets/items/keys/" + key, json.dumps(data), headers)
+    self.assertEquals(204, status)
+
+  def query(self, path):
+    status, _, body = self.request("GET", "/buckets/items/index/" + path)
+    self.assertEquals(200, status)
+    return json.loads(body)
+
+  def test_objects(self):
+    self.assertEquals("/buckets", json.loads(self.request("GET", "/")[2])["riak_kv_wm_buckets"])
+    self.assertEquals(404, self.request("GET", "/buckets/items/keys/a")[0])
+
+    headers = {
+      "Content-Type": "application/json",
+      "X-Riak-Index-tags_bin": "x, y",
+      "X-Riak-Meta-Owner": "me",
+      "Link": '</buckets/other/keys/b>; riaktag="friend", </buckets/items>; rel="up"',
+    }
+    status, response, body = self.request("PUT", "/buckets/items/keys/a?returnbody=true", '{"n": 1}', headers)
+    self.assertEquals(200, status)
+    self.assertEquals('{"n": 1}', body)
+    vclock = response.getheader("X-Riak-Vclock")
+
+    status, response, body = self.request("GET", "/buckets/items/keys/a")
+    self.assertEquals(200, status)
+    self.assertEquals('{"n": 1}', body)
+    self.assertEquals("application/json", response.getheader("Content-Type"))
+    self.assertEquals("x, y", response.getheader("X-Riak-Index-tags_bin"))
+    self.assertEquals("me", response.getheader("X-Riak-Meta-Owner"))
+    self.assertEquals('</buckets/other/keys/b>; riaktag="friend", </buckets/items>; rel="up"',
+                      response.getheader("Link"))
+    self.assertEquals(vclock, response.getheader("X-Riak-Vclock"))
+
+    self.put("a", {"n": 2})
+    self.assertNotEquals(vclock, self.request("GET", "/buckets/items/keys/a")[1].getheader("X-Riak-Vclock"))
+    self.assertEquals(412, self.request("PUT", "/buckets/items/keys/a", "{}", {"If-None-Match": "*"})[0])
+
+    self.assertEquals(204, self.request("DELETE", "/buckets/items/keys/a")[0])
+    self.assertEquals(404, self.request("DELETE", "/buckets/items/keys/a")[0])
+    self.assertEquals(404, self.request("GET", "/buckets/items/keys/a")[0])
+    self.assertEquals({"get": 4, "put": 3, "delete": 2}, self.server.requests)
+
+  def test_indexes(self):
+    self.put("a", {}, tags_bin=["x", "y"], n_int=[9])
+    self.put("b", {}, tags_bin=["y"], n_int=[10])
+    self.put("c", {}, tags_bin=["z"], n_int=[100])
+
+    self.assertEquals({"keys": ["a", "b"]}, self.query("tags_bin/y"))
+    # The terms of an exact match are not sent.
+    self.assertEquals({"keys": ["a", "b"]}, self.query("tags_bin/y?return_terms=true"))
+    self.assertEquals({"keys": ["a", "a", "b"]}, self.query("tags_bin/x/y"))
+    # Integers are compared as numbers.
+    self.assertEquals({"keys": ["a", "b"]}, self.query("n_int/5/50"))
+    self.assertEquals({"results": [{"10": "b"}, {"100": "c"}]}, self.query("n_int/10/100?return_terms=true"))
+    self.assertEquals({"keys": ["a", "b", "c"]}, self.query("$bucket/_"))
+    self.assertEquals({"keys": ["b", "c"]}, self.query("$key/b/c"))
+    self.assertEquals({"keys": ["b"]}, self.query("tags_bin/a/z?term_regex=y&max_results=5&continuation=" +
+                                                 self.query("tags_bin/a/z?max_results=2")["continuation"]))
+    self.assertEquals(400, self.request("GET", "/buckets/items/index/n_int/x")[0])
+
+    # Replacing and deleting an object updates the indexes.
+    self.put("a", {}, tags_bin=["z"])
+    self.request("DELETE", "/buckets/items/keys/c")
+    self.assertEquals({"keys": ["a"]}, self.query("tags_bin/z"))
+    self.assertEquals({"keys": ["b"]}, self.query("n_int/0/1000?max_results=5"))
+
+  def test_pages(self):
+    for i in xrange(5):
+      self.put("k{0}".format(i), {}, group_bin=["g"])
+
+    page = self.query("group_bin/g?max_results=2")
+    self.assertEquals(["k0", "k1"], page["keys"])
+    page = self.query("group_bin/g?max_results=2&continuation=" + page["continuation"])
+    self.assertEquals(["k2", "k3"], page["keys"])
+    page = self.query("group_bin/g?max_results=2&continuation=" + page["continuation"])
+    self.assertEquals({"keys": ["k4"]}, page)
+
+    status, response, body = self.request("GET", "/buckets/items/index/group_bin/g?stream=true&max_results=3")
+    self.assertTrue(response.getheader("Content-Type").startswith("multipart/mixed; boundary="))
+    boundary = response.getheader("Content-Type").split("=")[1]
+    parts = [json.loads(part.split("\r\n\r\n")[1]) for part in body.split("\r\n--" + boundary)[1:-1]]
+    self.assertEquals([{"keys": ["k0", "k1"]}, {"keys": ["k2"]}], parts[:2])
+    self.assertTrue("continuation" in parts[2])
+
+    status, response, body = self.request("GET", "/buckets/items/keys?keys=stream")
+    self.assertEquals(200, status)
+    self.assertEquals(["k0", "k1", "k2", "k3", "k4"], sorted(json.loads(self.request("GET", "/buckets/items/keys?keys=true")[2])["keys"]))
+
+  def test_latency_and_errors(self):
+    slow = FakeRiakServer(latency=0.05, error_rate=1.0).start()
+    try:
+      connection = httplib.HTTPConnection(slow.host, slow.port)
+      start = time.time()
+      connection.request("GET", "/buckets/items/keys/a")
+      response = connection.getresponse()
+      response.read()
+      self.assertEquals(503, response.status)
+      self.assertTrue(time.time() - start >= 0.05)
+
+      # Requests that are not for data are never slowed down or failed.
+      connection.request("GET", "/ping")
+      self.assertEquals(200, connection.getresponse().status)
+      connection.close()
+    finally:
+      slow.stop()
+
+_server = None
+
+if riak.available:
+  # Bound now so that the buckets know where it is, and started with the
+  # tests of this module.
+  _server = FakeRiakServer()
+  _client = _server.client()
+
+  RiakBaseDocument, RiakSimpleDocument, RiakDocumentWithIndexes = create_base_documents(riak,
+      (None, "_riak_options", "_riak_options"),
+      (None, {"bucket": _client.bucket("simple")}, {"bucket": _client.bucket("indexed")})
+  )
+
+  class FakeRiakBackendTest(create_testcase(RiakBaseDocument,
+                                            RiakSimpleDocument,
+                                            RiakDocumentWithIndexes,
+                                            "FakeRiakBackendTest",
+                                            lambda: _server.clear())):
+    @unittest.skip("Riak does not say whether a deleted key existed.")
+    def test_delete_many(self):
+      pass
+
+def setUpModule():
+  if _server is not None:
+    _server.start()
+
+def tearDownModule():
+  if _server is not None:
+    _server.stop()
+
+@unittest.skipUnless(riak.available, "riak-python-client is not installed")
+class FakeRiakDocumentTest(unittest.TestCase):
+  def setUp(self):
+    _server.clear()
+
+    class Post(Document):
+      _backend = riak
+      _riak_options = {"bucket": _client.bucket("posts"), "index_page_size": 2}
+
+      title = StringProperty(index=True)
+      tags = ListProperty(index=True)
+      views = NumberProperty(index=True, integer=True)
+
+    self.cls = Post
+
+  def test_documents(self):
+    doc = self.cls(key="a", data={"title": "hello", "tags": ["x", "y"], "views": 3}).save()
+    other = self.cls(key="b", data={"title": "world", "views": 30}).save()
+    doc.add_link(other, "next").save()
+
+    loaded = self.cls.get("a")
+    self.assertEquals("hello", loaded.title)
+    self.assertEquals([("posts", "b", "next")], loaded.links)
+
+    self.assertEquals(["a"], [d.key for d in self.cls.index("title", "hello")])
+    self.assertEquals(["a", "b"], list(self.cls.index_keys_only("views", 1, 100)))
+    self.assertEquals(["a"], list(self.cls.index_keys_only("tags", "x", "y")))
+    self.assertEquals(["a", "b"], sorted(doc.key for doc in self.cls.list_all()))
+    self.assertEquals(["a", "b"], [d.key for d in self.cls.get_many(["a", "b", "missing"]) if d is not None])
+
+    self.assertEquals([(3, "a"), (30, "b")], list(self.cls.index_terms("views", 1, 100)))
+    self.assertEquals([("x", "a"), ("y", "a")], list(self.cls.index_terms("tags", "x", "y")))
+
+    page = self.cls.list_all_keys(limit=1)
+    self.assertEquals(["a"], list(page))
+    self.assertEquals(["b"], list(self.cls.list_all_keys(continuation=page.continuation)))
+
+    other.delete()
+    with self.assertRaises(NotFoundError):
+      self.cls.get("b")
+
+  def test_cached(self):
+    class CachedPost(Document):
+      _backend = cached.CachedBackend(riak)
+      _riak_options = {"bucket": _client.bucket("posts")}
+
+      title = StringProperty(index=True)
+
+    CachedPost(key="a", data={"title": "hello"}).save()
+    CachedPost(key="b", data={"title": "world"}).save()
+    doc = CachedPost.get("a")
+    doc.title = "changed"
+    doc.add_link(CachedPost.get("b"), "next")
+    doc.save()
+
+    CachedPost._backend.clear_cache()
+    loaded = CachedPost.get("a")
+    self.assertEquals("changed", loaded.title)
+    self.assertEquals([("posts", "b", "next")], loaded.links)
+
+  def test_save_many(self):
+    docs = [self.cls(key="k{0:02d}".format(i), data={"title": "t", "views": i}) for i in xrange(20)]
+    self.assertEquals(20, self.cls.save_many(docs))
+    self.assertEquals(20, len(list(self.cls.index_keys_only("title", "t"))))
+    self.assertEquals(20, riak.store_counters(self.cls)["stored"])
+
+    # The bucket does not allow siblings, so the objects were not sent back,
+    # and saving again without their vclocks is fine.
+    self.assertEquals(None, docs[0]._backend_obj.vclock)
+    docs[0].title = "changed"
+    docs[0].save()
+    self.assertEquals("changed", self.cls.get("k00").title)
+
+if __name__ == "__main__":
+  unittest.main()
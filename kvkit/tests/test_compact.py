@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import unittest
+
+from ..backends import slow_memory
+from ..compact import CompactData, data_class
+from ..document import Document
+from ..emdocument import EmDocument
+from ..exceptions import ValidationError
+from ..properties import (
+    EmDocumentProperty,
+    ListProperty,
+    NumberProperty,
+    StringProperty
+)
+
+class CompactEmDocument(EmDocument):
+  __compact__ = True
+
+  name = StringProperty(required=True)
+  tags = ListProperty()
+
+class CompactDocument(Document):
+  __compact__ = True
+  _backend = slow_memory
+
+  name = StringProperty(index=True)
+  count = NumberProperty(integer=True)
+  em = EmDocumentProperty(CompactEmDocument)
+
+class CompactChildDocument(CompactDocument):
+  extra = StringProperty()
+
+class PlainDocument(Document):
+  _backend = slow_memory
+
+  name = StringProperty()
+
+class CompactFromPlainDocument(PlainDocument):
+  __compact__ = True
+
+  count = NumberProperty()
+
+class CompactDataTest(unittest.TestCase):
+  def test_mapping(self):
+    data = data_class("Test", ["a", "b"])()
+    self.assertEquals(0, len(data))
+    self.assertFalse("a" in data)
+    with self.assertRaises(KeyError):
+      data["a"]
+
+    data["a"] = None
+    data["c"] = 3
+    self.assertTrue("a" in data)
+    self.assertEquals(None, data["a"])
+    self.assertEquals(3, data.get("c"))
+    self.assertEquals("default", data.get("b", "default"))
+    self.assertEquals(2, len(data))
+    self.assertEquals({"a": None, "c": 3}, dict(data.iteritems()))
+    self.assertEquals(set(["a", "c"]), set(data))
+    self.assertEquals(data, {"a": None, "c": 3})
+
+    del data["a"]
+    del data["c"]
+    self.assertEquals(0, len(data))
+    with self.assertRaises(KeyError):
+      del data["b"]
+
+class CompactTest(unittest.TestCase):
+  def tearDown(self):
+    slow_memory.cleardb()
+
+  def test_no_dict(self):
+    doc = CompactEmDocument()
+    self.assertFalse(hasattr(doc, "__dict__") and doc.__dict__)
+    self.assertTrue(isinstance(doc._data, CompactData))
+    self.assertTrue(isinstance(CompactDocument()._data, CompactData))
+    self.assertTrue(isinstance(CompactChildDocument()._data, CompactData))
+    self.assertTrue(isinstance(CompactFromPlainDocument()._data, CompactData))
+    self.assertEquals(dict, type(PlainDocument()._data))
+
+  def test_access(self):
+    doc = CompactEmDocument({"name": "meow"})
+    self.assertEquals("meow", doc.name)
+    self.assertEquals("meow", doc["name"])
+    self.assertEquals([], doc.tags)
+
+    doc.other = 1
+    doc["another"] = 2
+    self.assertEquals(1, doc.other)
+    self.assertEquals(2, doc.another)
+    self.assertEquals({"name": u"meow", "tags": [], "other": 1, "another": 2}, doc.serialize())
+
+    del doc.other
+    with self.assertRaises(AttributeError):
+      doc.other
+
+    del doc.name
+    self.assertEquals(None, doc.name)
+    self.assertFalse(doc.is_valid())
+    with self.assertRaises(ValidationError):
+      doc.serialize()
+
+    with self.assertRaises(AttributeError):
+      doc.not_an_attribute
+
+  def test_dirty(self):
+    doc = CompactEmDocument.load({"name": "meow", "tags": ["a"]})
+    self.assertFalse(doc.is_dirty())
+    doc.tags.append("b")
+    self.assertEquals(set(["tags"]), doc.dirty_fields())
+    doc.name = "quack"
+    self.assertEquals(set(["name", "tags"]), doc.dirty_fields())
+
+  def test_save_and_get(self):
+    doc = CompactChildDocument(data={"name": "meow", "count": 2, "extra": "x"})
+    doc.em = CompactEmDocument({"name": "embedded"})
+    doc.undefined = "yes"
+    doc.save()
+
+    loaded = CompactChildDocument.get(doc.key)
+    self.assertEquals(doc.key, loaded.key)
+    self.assertEquals("meow", loaded.name)
+    self.assertEquals(2, loaded.count)
+    self.assertEquals("x", loaded.extra)
+    self.assertEquals("embedded", loaded.em.name)
+    self.assertEquals("yes", loaded.undefined)
+    self.assertEquals(doc.serialize(), loaded.serialize())
+
+    self.assertEquals([doc.key], CompactChildDocument.index_keys_only("name", "meow"))
+    self.assertEquals("meow", CompactFromPlainDocument(data={"name": "meow"}).save().name)
+
+if __name__ == "__main__":
+  unittest.main()
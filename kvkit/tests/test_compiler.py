@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import unittest
+
+from ..emdocument import EmDocument
+from ..exceptions import ValidationError
+from ..properties import (
+    BaseProperty,
+    BooleanProperty,
+    DictProperty,
+    EmDocumentProperty,
+    ListProperty,
+    NumberProperty,
+    StringProperty
+)
+
+class UpperProperty(BaseProperty):
+  def on_set(self, value):
+    return None if value is None else value.upper()
+
+class Embedded(EmDocument):
+  name = StringProperty(required=True)
+
+class MixedDocument(EmDocument):
+  s = StringProperty()
+  i = NumberProperty(integer=True)
+  f = NumberProperty()
+  b = BooleanProperty()
+  d = DictProperty()
+  l = ListProperty()
+  sr = StringProperty(required=True)
+  sv = StringProperty(validators=lambda v: v == "valid")
+  up = UpperProperty()
+  em = EmDocumentProperty(Embedded)
+  lazy = EmDocumentProperty(Embedded, load_on_demand=True)
+
+class DefinedOnlyDocument(EmDocument):
+  DEFINED_PROPERTIES_ONLY = True
+
+  prop = StringProperty()
+
+class SetattrDocument(EmDocument):
+  prop = StringProperty()
+
+  def __setattr__(self, name, value):
+    EmDocument.__setattr__(self, name, value)
+
+def generic(cls):
+  # A subclass is compiled on its own, so turn it off for this one only.
+  return type("Generic" + cls.__name__, (cls, ), {"COMPILED_SERIALIZERS": False})
+
+class CompilerTest(unittest.TestCase):
+  def both(self, cls, data):
+    return cls(data), generic(cls)(data)
+
+  def test_compiled(self):
+    self.assertNotEquals(None, MixedDocument._compiled)
+    # The standard conversions are inlined.
+    self.assertTrue("unicode(value)" in MixedDocument._compiled.source)
+    # Overriding __setattr__ falls back to the generic versions.
+    self.assertEquals(None, SetattrDocument._compiled)
+
+  def test_serialize(self):
+    data = {
+      "s": 1, "i": "2", "f": 3, "b": 0, "d": {"a": 1}, "l": (1, 2),
+      "sr": "x", "sv": "valid", "up": "meow", "em": Embedded({"name": "e"}),
+      "extra": "yes",
+    }
+    compiled, plain = self.both(MixedDocument, data)
+    self.assertEquals(plain.serialize(), compiled.serialize())
+    self.assertEquals(u"1", compiled.serialize()["s"])
+    self.assertEquals(2, compiled.serialize()["i"])
+    self.assertEquals(3.0, compiled.serialize()["f"])
+    self.assertEquals(False, compiled.serialize()["b"])
+    self.assertEquals("MEOW", compiled.serialize()["up"])
+    self.assertEquals({"name": "e"}, compiled.serialize()["em"])
+    self.assertEquals("yes", compiled.serialize()["extra"])
+
+    restricted = ("s", "extra")
+    self.assertEquals(plain.serialize(restricted=restricted), compiled.serialize(restricted=restricted))
+    self.assertFalse("s" in compiled.serialize(restricted=restricted))
+    self.assertFalse("extra" in compiled.serialize(restricted=restricted))
+
+  def test_validation(self):
+    for cls in (MixedDocument, generic(MixedDocument)):
+      doc = cls({"sr": "x"})
+      self.assertTrue(doc.is_valid())
+      doc.serialize()
+
+      doc.sv = "invalid"
+      self.assertFalse(doc.is_valid())
+      with self.assertRaises(ValidationError):
+        doc.serialize()
+
+      doc.sv = None
+      doc.d = "not a dict"
+      self.assertFalse(doc.is_valid())
+      with self.assertRaises(ValidationError):
+        doc.serialize()
+
+      doc.d = {}
+      doc.em = Embedded()
+      self.assertFalse(doc.is_valid())
+
+    for cls in (DefinedOnlyDocument, generic(DefinedOnlyDocument)):
+      doc = cls({"prop": "a"})
+      self.assertTrue(doc.is_valid())
+      doc.other = 1
+      self.assertFalse(doc.is_valid())
+      with self.assertRaises(ValidationError):
+        doc.serialize()
+
+  def test_deserialize(self):
+    for cls in (MixedDocument, generic(MixedDocument)):
+      data = {"s": u"a", "i": 1, "up": "meow", "em": {"name": "e"}, "lazy": {"name": "l"}, "extra": [1]}
+      doc = cls.load(data)
+      self.assertEquals(u"a", doc.s)
+      self.assertEquals(1, doc.i)
+      self.assertEquals([], doc.l)
+      self.assertEquals("MEOW", doc.up)
+      self.assertTrue(isinstance(doc.em, Embedded))
+      self.assertEquals({"name": "l"}, doc._data["lazy"])
+      self.assertEquals("l", doc.lazy.name)
+      self.assertEquals([1], doc.extra)
+      self.assertFalse(doc.is_dirty())
+
+      doc.extra.append(2)
+      self.assertEquals(set(["extra"]), doc.dirty_fields())
+
+  def test_switch(self):
+    compiled = MixedDocument._compiled
+    MixedDocument._compiled = compiled._replace(serialize=None, deserialize=None, is_valid=None)
+    EmDocument.COMPILED_SERIALIZERS = False
+    try:
+      doc = MixedDocument.load({"sr": "x"})
+      self.assertTrue(doc.is_valid())
+      self.assertEquals(u"x", doc.serialize()["sr"])
+    finally:
+      EmDocument.COMPILED_SERIALIZERS = True
+      MixedDocument._compiled = compiled
+
+if __name__ == "__main__":
+  unittest.main()
@@ -98,6 +98,88 @@ class BasicDocumentTest(unittest.TestCase):
     with self.assertRaises(NotFoundError):
       doc2.reload()
 
+  def test_get_many(self):
+    doc1 = SimpleDocument(data={"s": "one", "sr": "required"}).save()
+    doc2 = SimpleDocument(data={"s": "two", "sr": "required"}).save()
+
+    docs = SimpleDocument.get_many([doc2.key, "non-existent", doc1.key])
+    self.assertEquals(2, len(docs))
+    self.assertEquals(doc2.key, docs[0].key)
+    self.assertEquals("two", docs[0].s)
+    self.assertEquals(doc1.key, docs[1].key)
+    self.assertEquals("one", docs[1].s)
+
+    docs = SimpleDocument.get_many([doc2.key, "non-existent"], missing="none")
+    self.assertEquals(2, len(docs))
+    self.assertEquals("two", docs[0].s)
+    self.assertEquals(None, docs[1])
+
+    with self.assertRaises(NotFoundError):
+      SimpleDocument.get_many([doc1.key, "non-existent"], missing="raise")
+
+    with self.assertRaises(ValueError):
+      SimpleDocument.get_many([doc1.key], missing="wut")
+
+  def test_save_many(self):
+    docs = [SomeDocument(data={"test_str_index": "meow"}) for i in xrange(5)]
+    self.assertEquals(5, SomeDocument.save_many(docs, batch_size=2))
+
+    keys = SomeDocument.index_keys_only("test_str_index", "meow")
+    self.assertEquals(sorted(doc.key for doc in docs), sorted(keys))
+
+    valid = SimpleDocument(data={"sr": "required"})
+    invalid = SimpleDocument()
+    with self.assertRaises(ValidationError):
+      SimpleDocument.save_many([valid, invalid])
+
+    with self.assertRaises(NotFoundError):
+      SimpleDocument.get(valid.key)
+
+  def test_delete_many(self):
+    docs = [SomeDocument(data={"test_number_index": i}).save() for i in xrange(5)]
+    self.assertEquals(3, SomeDocument.delete_many([d.key for d in docs[:3]] + ["non-existent"], batch_size=2))
+    self.assertEquals(2, len(SomeDocument.list_all_keys()))
+
+    SomeDocument.delete_key(docs[3].key)
+    self.assertEquals([docs[4].key], SomeDocument.list_all_keys())
+
+  def test_delete_where(self):
+    docs = [SomeDocument(data={"test_number_index": i}).save() for i in xrange(5)]
+    self.assertEquals(3, SomeDocument.delete_where("test_number_index", 1, 3, batch_size=2))
+    keys = SomeDocument.list_all_keys()
+    self.assertEquals(sorted([docs[0].key, docs[4].key]), sorted(keys))
+
+  def test_save_only_if_dirty(self):
+    doc = SimpleDocument(data={"s": "one", "sr": "required"})
+    self.assertTrue(doc.is_dirty())
+    doc.save(only_if_dirty=True)
+    self.assertFalse(doc.is_dirty())
+
+    loaded = SimpleDocument.get(doc.key)
+    doc.s = "two"
+    doc.save()
+
+    # Nothing changed on the loaded copy, so it should not be written.
+    loaded.save(only_if_dirty=True)
+    self.assertEquals("two", SimpleDocument.get(doc.key).s)
+
+    loaded.l.append(1)
+    loaded.save(only_if_dirty=True)
+    self.assertEquals([1], SimpleDocument.get(doc.key).l)
+    self.assertEquals("one", SimpleDocument.get(doc.key).s)
+
+  def test_save_only_if_dirty_held_value(self):
+    doc = SimpleDocument(data={"sr": "required", "l": [1]})
+    l = doc.l
+    doc.save()
+    self.assertFalse(doc.is_dirty())
+
+    # The list was read before the save and is modified after it.
+    l.append(2)
+    self.assertTrue(doc.is_dirty())
+    doc.save(only_if_dirty=True)
+    self.assertEquals([1, 2], SimpleDocument.get(doc.key).l)
+
   def test_document_mixin_indexes_inheritance(self):
     doc = DocumentWithMixin()
     doc.test = "test"
@@ -305,5 +387,67 @@ class BasicDocumentTest(unittest.TestCase):
 
     self.assertEquals(6, i)
 
+  def test_snapshot_not_supported(self):
+    with self.assertRaises(NotImplementedError):
+      SomeDocument.snapshot()
+
+  def test_paging(self):
+    for i in xrange(1, 6):
+      SomeDocument(str(i), data={"test_str_index": "paged"}).save()
+
+    page = SomeDocument.list_all(limit=2)
+    self.assertEquals(["1", "2"], [doc.key for doc in page])
+    self.assertEquals("paged", page[0].test_str_index)
+
+    keys = []
+    continuation = None
+    while True:
+      page = SomeDocument.index_keys_only("test_str_index", "paged", limit=2, continuation=continuation)
+      keys.extend(page)
+      continuation = page.continuation
+      if continuation is None:
+        break
+
+    self.assertEquals(["1", "2", "3", "4", "5"], keys)
+
+    page = SomeDocument.index("test_str_index", "paged", limit=2, reverse=True)
+    self.assertEquals(["5", "4"], [doc.key for doc in page])
+    page = SomeDocument.index_keys_only("test_str_index", "paged", limit=4, reverse=True, continuation=page.continuation)
+    self.assertEquals(["3", "2", "1"], list(page))
+
+    with self.assertRaises(ValueError):
+      SomeDocument.list_all_keys(limit=2, continuation="not a token")
+
+  def test_projection(self):
+    ref = SomeDocument("ref").save()
+    doc = DocumentWithRef("doc", data={"ref": ref}).save()
+    SomeDocument("1", data={"test_str_index": "meow", "test_number_index": 1}).save()
+    SomeDocument("2", data={"test_str_index": "meow", "test_number_index": 2}).save()
+
+    record = SomeDocument.get("1", fields=["test_number_index"])
+    self.assertEquals("1", record.key)
+    self.assertEquals(1, record.test_number_index)
+    self.assertFalse(hasattr(record, "test_str_index"))
+    self.assertEquals({"key": "1", "test_number_index": 1}, dict(record._asdict()))
+    with self.assertRaises(AttributeError):
+      record.test_number_index = 3
+
+    # Only the requested fields are converted.
+    record = DocumentWithRef.get("doc", fields=["ref"])
+    self.assertEquals(ref.key, record.ref.key)
+
+    records = list(SomeDocument.index("test_str_index", "meow", fields=["test_number_index"]))
+    self.assertEquals([("1", 1), ("2", 2)], sorted(records))
+
+    page = SomeDocument.list_all(limit=2, fields=["test_str_index"])
+    self.assertEquals([("1", "meow"), ("2", "meow")], list(page))
+    self.assertNotEquals(None, page.continuation)
+
+    records = SomeDocument.get_many(["2", "missing", "1"], missing="none", fields=["test_str_index"])
+    self.assertEquals([("2", "meow"), None, ("1", "meow")], records)
+
+    with self.assertRaises(NotFoundError):
+      SomeDocument.get("missing", fields=["test_str_index"])
+
 if __name__ == "__main__":
   unittest.main()
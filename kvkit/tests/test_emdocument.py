@@ -35,6 +35,13 @@ class SimpleDocument(EmDocument):
   sv = StringProperty(validators=lambda v: v == "valid")
   sd = StringProperty(default="default")
 
+class Address(EmDocument):
+  city = StringProperty()
+
+class NestedDocument(EmDocument):
+  address = EmDocumentProperty(Address)
+  lazy = ListProperty(load_on_demand=True)
+
 class DefinedOnlyDocument(EmDocument):
   DEFINED_PROPERTIES_ONLY = True
 
@@ -194,6 +201,64 @@ class EmDocumentTest(unittest.TestCase):
     self.assertFalse("sv" in serialized)
     self.assertTrue("sd" in serialized)
 
+  def test_dirty_fields(self):
+    doc = SimpleDocument()
+    self.assertTrue(doc.is_dirty())
+    self.assertEquals(set(SimpleDocument.defined_properties), doc.dirty_fields())
+
+    doc = SimpleDocument.load({"i": 5, "sr": "required", "l": [1], "prop": "test"})
+    self.assertFalse(doc.is_dirty())
+    self.assertEquals(set(), doc.dirty_fields())
+
+    doc.i = 6
+    del doc.prop
+    self.assertEquals(set(["i", "prop"]), doc.dirty_fields())
+
+    doc.l.append(2)
+    self.assertEquals(set(["i", "prop", "l"]), doc.dirty_fields())
+
+    doc.merge({"s": "meow"})
+    self.assertTrue("s" in doc.dirty_fields())
+
+    doc.clear()
+    self.assertTrue(doc.is_dirty())
+
+  def test_dirty_fields_in_place(self):
+    doc = NestedDocument.load({"address": {"city": "x"}, "lazy": ["a"]})
+    self.assertEquals(set(), doc.dirty_fields())
+
+    doc.address.city = "y"
+    self.assertEquals(set(["address"]), doc.dirty_fields())
+
+    # Values loaded on demand are compared from when they are loaded.
+    doc.lazy.append("b")
+    self.assertEquals(set(["address", "lazy"]), doc.dirty_fields())
+
+  def test_dirty_fields_copied_when_read(self):
+    doc = NestedDocument.load({"address": {"city": "x"}, "lazy": ["a"]})
+    # Nothing is copied until a mutable value is read.
+    self.assertEquals(None, doc._loaded_values)
+
+    address = doc.address
+    self.assertEquals(["address"], list(doc._loaded_values))
+    self.assertEquals(set(), doc.dirty_fields())
+
+    address.city = "y"
+    doc.address
+    self.assertEquals(set(["address"]), doc.dirty_fields())
+
+  def test_only_validate_dirty(self):
+    # sv is invalid but was loaded, so it is assumed to be valid.
+    doc = SimpleDocument.load({"sr": "required", "sv": "invalid"})
+    with self.assertRaises(ValidationError):
+      doc.serialize()
+
+    self.assertEquals("invalid", doc.serialize(only_validate_dirty=True)["sv"])
+
+    doc.sr = None
+    with self.assertRaises(ValidationError):
+      doc.serialize(only_validate_dirty=True)
+
   def test_override_document(self):
     self.assertTrue(isinstance(OverrideDocument._meta["prop"], NumberProperty))
 
@@ -16,9 +16,10 @@
 
 from __future__ import absolute_import
 
+import random
 import unittest
 
-from ..helpers import walk_parents, mediocre_copy
+from ..helpers import external_sort, walk_parents, mediocre_copy
 
 class Document(object):
   # Just to test
@@ -68,3 +69,13 @@ class HelpersTest(unittest.TestCase):
     self.assertFalse(l3c[1][1] is l3[1][1])
     self.assertFalse(l3c[2][1] is l3[2][1])
     self.assertFalse(l3c[3][1] is l3[3][1])
+
+  def test_external_sort(self):
+    items = ["".join(chr(random.randint(0, 255)) for _ in xrange(random.randint(0, 20))) for _ in xrange(1000)]
+    self.assertEquals(sorted(items), list(external_sort(items)))
+    # Spills to many files.
+    self.assertEquals(sorted(items), list(external_sort(iter(items), memory_limit=100)))
+    self.assertEquals([], list(external_sort([], memory_limit=1)))
+
+    pairs = [(item, str(i)) for i, item in enumerate(items)]
+    self.assertEquals(sorted(pairs), list(external_sort(pairs, memory_limit=100, sizeof=lambda pair: len(pair[0]))))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# This file is part of kvkit
+#
+# kvkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kvkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with kvkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import threading
+import unittest
+
+from ..document import Document
+from ..exceptions import NotFoundError
+from ..properties import StringProperty, ReferenceProperty
+from ..session import Session, current_session
+
+from ..backends import slow_memory
+
+class BaseDocument(Document):
+  _backend = slow_memory
+
+class Account(BaseDocument):
+  name = StringProperty()
+
+class User(BaseDocument):
+  account = ReferenceProperty(Account)
+
+class SessionTest(unittest.TestCase):
+  def tearDown(self):
+    slow_memory.cleardb()
+
+  def test_identity(self):
+    account = Account(data={"name": "meow"}).save()
+
+    with Session() as session:
+      a1 = Account.get(account.key)
+      a2 = Account.get(account.key)
+      self.assertTrue(a1 is a2)
+      self.assertEquals(1, session.hits)
+      self.assertEquals(1, session.misses)
+
+    a3 = Account.get(account.key)
+    self.assertFalse(a1 is a3)
+    self.assertEquals(None, current_session())
+
+  def test_reference(self):
+    account = Account(data={"name": "meow"}).save()
+    u1 = User(data={"account": account}).save()
+    u2 = User(data={"account": account}).save()
+
+    with Session() as session:
+      loaded = Account.get(account.key)
+      users = User.get_many([u1.key, u2.key])
+      self.assertTrue(users[0].account is loaded)
+      self.assertTrue(users[1].account is loaded)
+      self.assertEquals(2, session.hits)
+
+      self.assertTrue(users[0] is User.get(u1.key))
+
+  def test_save_delete(self):
+    with Session() as session:
+      account = Account(data={"name": "meow"}).save()
+      self.assertTrue(account in session)
+      self.assertTrue(account is Account.get(account.key))
+
+      account.delete()
+      self.assertFalse(account in session)
+      with self.assertRaises(NotFoundError):
+        Account.get(account.key)
+
+      account = Account().save()
+      Account.delete_key(account.key)
+      self.assertFalse(account in session)
+
+  def test_thread_scoped(self):
+    account = Account().save()
+    seen = []
+
+    def run():
+      seen.append(current_session())
+
+    with Session() as session:
+      Account.get(account.key)
+      t = threading.Thread(target=run)
+      t.start()
+      t.join()
+
+    self.assertEquals([None], seen)
+
+  def test_nested(self):
+    with Session() as outer:
+      with Session() as inner:
+        self.assertTrue(current_session() is inner)
+      self.assertTrue(current_session() is outer)
+
+if __name__ == "__main__":
+  unittest.main()